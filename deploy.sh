@@ -1,7 +1,7 @@
 #!/bin/bash
 
 # EHMS MyClub API - Cloud Functions Deployment Script
-# This script deploys the function and sets up the Cloud Scheduler
+# This script deploys the function and its job worker and sets up the Cloud Scheduler
 
 set -e  # Exit on error
 
@@ -9,6 +9,9 @@ set -e  # Exit on error
 PROJECT_ID="your-gcp-project-id"
 REGION="us-central1"
 FUNCTION_NAME="ehms-mc-api"
+WORKER_NAME="${FUNCTION_NAME}-worker"  # Runs asynchronous jobs (?async=1)
+STATE_BUCKET="${PROJECT_ID}-ehms-state"  # Shared STATE_DIR of the function and its worker
+STATE_MOUNT="/mnt/ehms_state"
 SERVICE_ACCOUNT="ehms-mc-api@${PROJECT_ID}.iam.gserviceaccount.com"
 MC_TOKEN_SECRET="mc-token"  # Name of secret in Secret Manager
 BIGQUERY_DATASET="ehms_myclub"
@@ -31,7 +34,65 @@ if [ "$PROJECT_ID" = "your-gcp-project-id" ]; then
     exit 1
 fi
 
-echo -e "${GREEN}Step 1: Deploying Cloud Function...${NC}"
+# Job records and other state are shared through a Cloud Storage bucket
+# mounted as STATE_DIR; the run lock lives in BigQuery since the function and
+# its worker run on separate instances
+COMMON_ENV="GCP_PROJECT_ID=${PROJECT_ID},BIGQUERY_DATASET_ID=${BIGQUERY_DATASET},STATE_DIR=${STATE_MOUNT},RUN_LOCK=bigquery"
+
+# Mount the state bucket on a deployed function (gen2 functions are Cloud Run services)
+mount_state_bucket() {
+    gcloud run services update "$1" \
+        --region=${REGION} \
+        --add-volume=name=ehms-state,type=cloud-storage,bucket=${STATE_BUCKET} \
+        --add-volume-mount=volume=ehms-state,mount-path=${STATE_MOUNT} \
+        --project=${PROJECT_ID}
+}
+
+echo -e "${GREEN}Step 1: Creating state bucket...${NC}"
+if ! gcloud storage buckets describe gs://${STATE_BUCKET} --project=${PROJECT_ID} &>/dev/null; then
+    gcloud storage buckets create gs://${STATE_BUCKET} --location=${REGION} --project=${PROJECT_ID}
+fi
+gcloud storage buckets add-iam-policy-binding gs://${STATE_BUCKET} \
+    --member="serviceAccount:${SERVICE_ACCOUNT}" \
+    --role="roles/storage.objectAdmin" \
+    --project=${PROJECT_ID}
+
+echo ""
+echo -e "${GREEN}Step 2: Deploying job worker function...${NC}"
+# Asynchronous jobs run here instead of a background thread of the trigger,
+# whose CPU is throttled once it has sent its 202 response
+gcloud functions deploy ${WORKER_NAME} \
+    --gen2 \
+    --runtime=python313 \
+    --region=${REGION} \
+    --source=. \
+    --entry-point=run_pipeline_worker \
+    --trigger-http \
+    --no-allow-unauthenticated \
+    --set-env-vars "${COMMON_ENV}" \
+    --set-secrets "MC_TOKEN=${MC_TOKEN_SECRET}:latest" \
+    --service-account=${SERVICE_ACCOUNT} \
+    --timeout=540s \
+    --memory=512MB \
+    --max-instances=1 \
+    --project=${PROJECT_ID}
+mount_state_bucket ${WORKER_NAME}
+
+# The trigger calls the worker with the service account's ID token
+gcloud functions add-invoker-policy-binding ${WORKER_NAME} \
+    --region=${REGION} \
+    --member="serviceAccount:${SERVICE_ACCOUNT}" \
+    --project=${PROJECT_ID}
+
+WORKER_URL=$(gcloud functions describe ${WORKER_NAME} \
+    --region=${REGION} \
+    --gen2 \
+    --format="value(serviceConfig.uri)" \
+    --project=${PROJECT_ID})
+echo "Worker URL: ${WORKER_URL}"
+
+echo ""
+echo -e "${GREEN}Step 3: Deploying Cloud Function...${NC}"
 gcloud functions deploy ${FUNCTION_NAME} \
     --gen2 \
     --runtime=python313 \
@@ -40,16 +101,17 @@ gcloud functions deploy ${FUNCTION_NAME} \
     --entry-point=run_pipeline \
     --trigger-http \
     --no-allow-unauthenticated \
-    --set-env-vars "GCP_PROJECT_ID=${PROJECT_ID},BIGQUERY_DATASET_ID=${BIGQUERY_DATASET}" \
+    --set-env-vars "${COMMON_ENV},JOB_DISPATCHER=http,JOB_WORKER_URL=${WORKER_URL}" \
     --set-secrets "MC_TOKEN=${MC_TOKEN_SECRET}:latest" \
     --service-account=${SERVICE_ACCOUNT} \
     --timeout=540s \
     --memory=512MB \
     --max-instances=1 \
     --project=${PROJECT_ID}
+mount_state_bucket ${FUNCTION_NAME}
 
 echo ""
-echo -e "${GREEN}Step 2: Getting function URL...${NC}"
+echo -e "${GREEN}Step 4: Getting function URL...${NC}"
 FUNCTION_URL=$(gcloud functions describe ${FUNCTION_NAME} \
     --region=${REGION} \
     --gen2 \
@@ -59,7 +121,7 @@ FUNCTION_URL=$(gcloud functions describe ${FUNCTION_NAME} \
 echo "Function URL: ${FUNCTION_URL}"
 echo ""
 
-echo -e "${GREEN}Step 3: Creating/Updating Cloud Scheduler job...${NC}"
+echo -e "${GREEN}Step 5: Creating/Updating Cloud Scheduler job...${NC}"
 # Check if scheduler job exists
 if gcloud scheduler jobs describe ${FUNCTION_NAME}-daily --location=${REGION} --project=${PROJECT_ID} &>/dev/null; then
     echo "Scheduler job exists, updating..."
@@ -87,6 +149,7 @@ echo -e "${GREEN}Deployment Complete!${NC}"
 echo -e "${GREEN}========================================${NC}"
 echo ""
 echo "Function deployed: ${FUNCTION_URL}"
+echo "Job worker deployed: ${WORKER_URL}"
 echo "Schedule: ${SCHEDULE}"
 echo ""
 echo -e "${BLUE}Test the function manually:${NC}"
@@ -3,20 +3,118 @@ Cloud Functions entry point for EHMS MyClub API pipeline.
 This function is triggered by Cloud Scheduler to run the data pipeline daily.
 """
 import functions_framework
-from src import initialise
-from src.logger import log, error
 import sys
 import os
 
-# Add src to path for imports
+# Add src to path for imports (the src modules import each other by bare name)
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
 
+from src import initialise
+from src import jobs
+from src import fanout
+from src import tenant_runs
+# Bare imports: the metrics registry, tracing context and active tenant must be
+# the ones the src modules use
+import metrics
+import run_lock
+import run_stats
+import tenants
+import tracing
+from src.logger import log, error
+
+
+def _pipeline_params(request):
+    """
+    Read pipeline parameters from the request query string.
+
+    Returns:
+        dict: 'interval', the pipeline 'mode', 'shards', 'budget',
+              'profile', 'memory' and 'tenant' if given, plus any targeted
+              refresh parameters present
+    """
+    # Get optional interval parameter from request (default 60 days)
+    interval = 60
+    if request.args and 'interval' in request.args:
+        try:
+            interval = int(request.args.get('interval'))
+            log(f"Using custom interval: {interval} days")
+        except ValueError:
+            log(f"Invalid interval parameter, using default: {interval} days")
+
+    params = {'interval': interval}
+    if request.args and request.args.get('mode') in jobs.PIPELINE_MODES:
+        params['mode'] = request.args.get('mode')
+        if request.args.get('shards'):
+            params['shards'] = request.args.get('shards')
+        if request.args.get('budget'):
+            params['budget'] = request.args.get('budget')
+    if request.args and request.args.get('profile'):
+        params['profile'] = request.args.get('profile')
+    if request.args and request.args.get('memory'):
+        params['memory'] = request.args.get('memory')
+    if request.args and request.args.get('tenant'):
+        params['tenant'] = request.args.get('tenant')
+    for key in initialise.TARGETED_PARAMS:
+        if request.args and request.args.get(key):
+            params[key] = request.args.get(key)
+    return params
+
+
+def _already_running(holder, attach=False):
+    """
+    Build the response for a run refused because another run holds the lock.
+
+    Args:
+        holder (dict): The live lease (see src/run_lock.py)
+        attach (bool): Answer like an accepted async job, with the running
+                       job's id to poll, if the holder is a job
+
+    Returns:
+        Response tuple with the holder, its job record and status code
+    """
+    job_id = holder.get('job_id')
+    job = jobs.get_job(job_id) if job_id else None
+    log(f"Pipeline already running (job {job_id or 'n/a'}, lease until {holder.get('expires_at')})")
+    response = {
+        'status': 'already_running',
+        'message': 'A pipeline run is already in progress',
+        'job_id': job_id,
+        'job': job,
+        'lock': holder,
+    }
+    return response, 202 if attach and job else 409
+
+
+def _is_async(request):
+    """Return True if the caller asked for job mode (?mode=async or ?async=1)."""
+    if not request.args:
+        return False
+    return (
+        request.args.get('mode') == 'async'
+        or request.args.get('async', '').lower() in ('1', 'true', 'yes')
+    )
+
 
 @functions_framework.http
 def run_pipeline(request):
     """
     HTTP Cloud Function entry point.
 
+    With ?mode=async the pipeline is submitted as a background job and the
+    response is returned immediately with status 202 and the job id; poll
+    `pipeline_status` for progress. With ?mode=fanout the extraction is
+    partitioned across workers (see src/fanout.py, optional ?shards=N), and
+    with ?mode=rebuild all tables are rebuilt from the full history.
+    ?profile=1 profiles the run (see src/profiling.py), and ?tenant=<name>
+    runs it for a configured club (see src/tenants.py). A W3C traceparent
+    header is continued by the run's tracing spans (see src/tracing.py).
+
+    Only one run per club is in progress at a time (see src/run_lock.py):
+    while another run holds the lock, the response has status
+    'already_running' with the running job's record; async requests are
+    attached to that job (202 with its job_id) instead of submitting a
+    new one.
+
     Args:
         request (flask.Request): The request object.
 
@@ -26,21 +124,34 @@ def run_pipeline(request):
     try:
         log("Starting EHMS MyClub API pipeline...")
 
-        # Get optional interval parameter from request (default 60 days)
-        interval = 60
-        if request.args and 'interval' in request.args:
-            try:
-                interval = int(request.args.get('interval'))
-                log(f"Using custom interval: {interval} days")
-            except ValueError:
-                log(f"Invalid interval parameter, using default: {interval} days")
+        params = _pipeline_params(request)
+        traceparent = request.headers.get('traceparent') if request.headers else None
+
+        with tracing.span("run_pipeline", traceparent=traceparent, **params):
+            if _is_async(request):
+                with tenants.activate(params.get('tenant') or tenants.DEFAULT_TENANT):
+                    holder = run_lock.holder()
+                if holder:
+                    return _already_running(holder, attach=True)
+                job_id = jobs.submit(params, traceparent=tracing.current_traceparent())
+                return {
+                    'status': 'accepted',
+                    'message': 'Pipeline job submitted',
+                    'job_id': job_id,
+                }, 202
 
-        # Run the pipeline
-        initialise.run(interval=interval)
+            # Incremental, targeted, fan-out or rebuild run depending on the parameters
+            summary = jobs.run_params(params)
 
         log("Pipeline completed successfully!")
-        return {'status': 'success', 'message': 'Pipeline executed successfully'}, 200
+        return {
+            'status': 'success',
+            'message': 'Pipeline executed successfully',
+            'summary': summary,
+        }, 200
 
+    except run_lock.AlreadyRunning as e:
+        return _already_running(e.holder)
     except Exception as e:
         error_msg = f"Pipeline failed: {str(e)}"
         error(error_msg)
@@ -49,6 +160,147 @@ def run_pipeline(request):
         return {'status': 'error', 'message': error_msg}, 500
 
 
+@functions_framework.http
+def pipeline_status(request):
+    """
+    HTTP entry point returning the status of an asynchronous pipeline job.
+
+    Args:
+        request (flask.Request): The request object, with ?job_id=<id>.
+
+    Returns:
+        Response tuple with the job record (status, stage, progress counts
+        and the final performance summary) and status code
+    """
+    job_id = request.args.get('job_id') if request.args else None
+    if not job_id:
+        return {'status': 'error', 'message': 'Missing job_id parameter'}, 400
+
+    job = jobs.get_job(job_id)
+    if not job:
+        return {'status': 'error', 'message': f'Unknown job: {job_id}'}, 404
+    return job, 200
+
+
+@functions_framework.http
+def metrics_endpoint(request):
+    """
+    HTTP entry point exposing the pipeline metrics for Prometheus.
+
+    Args:
+        request (flask.Request): The request object.
+
+    Returns:
+        Response tuple with the metrics in the OpenMetrics text format
+    """
+    return metrics.REGISTRY.expose(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+
+@functions_framework.http
+def run_tenants(request):
+    """
+    HTTP entry point running the pipelines of all due clubs concurrently.
+
+    Target of a frequent Cloud Scheduler job; every club only runs once its
+    schedule_minutes have passed (see src/tenant_runs.py). ?tenant=a,b
+    restricts the run to some clubs and ?force=1 ignores the schedules.
+
+    Args:
+        request (flask.Request): The request object.
+
+    Returns:
+        Response tuple with the result per club and status code (500 only if
+        every club that ran failed)
+    """
+    names = request.args.get('tenant') if request.args else None
+    force = request.args.get('force', '').lower() in ('1', 'true', 'yes') if request.args else False
+    traceparent = request.headers.get('traceparent') if request.headers else None
+    try:
+        with tracing.span("run_tenants", traceparent=traceparent):
+            outcome = tenant_runs.run_tenants(
+                names=[name.strip() for name in names.split(',') if name.strip()] if names else None,
+                force=force,
+            )
+    except Exception as e:
+        error_msg = f"Tenant runs failed: {str(e)}"
+        error(error_msg)
+        return {'status': 'error', 'message': error_msg}, 500
+
+    statuses = [result['status'] for result in outcome['tenants'].values()]
+    if statuses and all(status == 'failed' for status in statuses):
+        return dict(outcome, status='error'), 500
+    status = 'partial_failure' if 'failed' in statuses else 'success'
+    return dict(outcome, status=status), 200
+
+
+@functions_framework.http
+def run_pipeline_worker(request):
+    """
+    HTTP entry point executing a previously submitted pipeline job.
+
+    Target of the http job dispatcher (JOB_DISPATCHER=http); expects a JSON
+    body {"job_id": "<id>"}.
+
+    Args:
+        request (flask.Request): The request object.
+
+    Returns:
+        Response tuple with the final job record and status code
+    """
+    payload = request.get_json(silent=True) or {}
+    job_id = payload.get('job_id')
+    if not job_id:
+        return {'status': 'error', 'message': 'Missing job_id'}, 400
+
+    try:
+        job = jobs.execute(job_id)
+    except ValueError as e:
+        return {'status': 'error', 'message': str(e)}, 404
+
+    # A job refused by the run lock is final too; don't have it retried
+    status_code = 200 if job.get('status') in ('succeeded', 'already_running') else 500
+    return job, status_code
+
+
+@functions_framework.http
+def run_extract_worker(request):
+    """
+    HTTP entry point extracting one fan-out shard.
+
+    Target of the http fan-out dispatcher (FANOUT_DISPATCHER=http); expects a
+    JSON body {"group_ids": [...], "start": "YYYY-MM-DD", "end": "YYYY-MM-DD",
+    "output": "gs://bucket/prefix"} (plus "tenant" when extracting for a
+    configured club). The extracted rows are staged as NDJSON objects under
+    the output prefix (see src/fanout.py) and only their paths are returned,
+    so large shards don't hit the response size limit.
+
+    Args:
+        request (flask.Request): The request object.
+
+    Returns:
+        Response tuple with the staged paths per table and status code
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+        group_ids = initialise.parse_id_list(payload.get('group_ids'))
+        start = initialise.parse_date(payload.get('start'))
+        end = initialise.parse_date(payload.get('end'))
+        output = payload.get('output')
+        if not group_ids or not start or not end or not output:
+            return {'status': 'error', 'message': 'group_ids, start, end and output are required'}, 400
+
+        traceparent = request.headers.get('traceparent') if request.headers else None
+        with tenants.activate(payload.get('tenant') or tenants.DEFAULT_TENANT), \
+                tracing.span("extract_worker", traceparent=traceparent, groups=len(group_ids)):
+            tables = fanout.extract_shard(group_ids, start, end)
+            paths = fanout.upload_shard(tables, output)
+        return {'status': 'success', 'paths': paths}, 200
+    except Exception as e:
+        error_msg = f"Extract worker failed: {str(e)}"
+        error(error_msg)
+        return {'status': 'error', 'message': error_msg}, 500
+
+
 @functions_framework.cloud_event
 def run_pipeline_cloud_event(cloud_event):
     """
@@ -62,8 +314,15 @@ def run_pipeline_cloud_event(cloud_event):
     """
     try:
         log("Starting EHMS MyClub API pipeline (CloudEvent trigger)...")
-        initialise.run(interval=60)
+        with run_lock.hold() as lease:
+            stats = run_stats.RunStats()
+            if lease is not None:
+                stats.add_listener(lease)
+            initialise.run(interval=60, stats=stats)
         log("Pipeline completed successfully!")
+    except run_lock.AlreadyRunning as e:
+        # Not retried: the running pipeline covers this trigger
+        log(f"Skipping CloudEvent trigger: {e}")
     except Exception as e:
         error_msg = f"Pipeline failed: {str(e)}"
         error(error_msg)
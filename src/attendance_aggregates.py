@@ -0,0 +1,308 @@
+"""
+Incrementally maintained attendance aggregates.
+
+The `attendance_monthly` table (ATTENDANCE_AGGREGATE_TABLE) holds one row per
+(member, group, month) with presence counts and the member's status, so
+dashboards read the small aggregate instead of joining presences, events,
+members and memberships over the full history.
+
+After every successful upload only the keys touched by that run are
+recomputed:
+- keys of the presences of every uploaded event, both under the event's new
+  and its previous group/month (so events moved to another group or date
+  leave no stale counts behind)
+- all keys of the members whose member or membership rows were uploaded
+
+Keys that no longer have any presences are deleted. `python
+src/attendance_aggregates.py rebuild` recreates the table from scratch.
+Months are computed in AGGREGATE_TIMEZONE.
+"""
+import argparse
+import datetime
+import os
+from zoneinfo import ZoneInfo
+
+from dotenv import load_dotenv
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+import bigquery_upload
+import cost_guard
+import tracing
+from logger import log, error
+
+load_dotenv()
+
+ATTENDANCE_AGGREGATES = os.getenv("ATTENDANCE_AGGREGATES", "true").lower() in ("true", "1", "yes")
+ATTENDANCE_AGGREGATE_TABLE = os.getenv("ATTENDANCE_AGGREGATE_TABLE", "attendance_monthly")
+AGGREGATE_TIMEZONE = os.getenv("AGGREGATE_TIMEZONE", "UTC")
+
+SCHEMA = [
+    bigquery.SchemaField("member_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("group_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("month", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("presences", "INTEGER"),
+    bigquery.SchemaField("confirmed_presences", "INTEGER"),
+    bigquery.SchemaField("first_event_at", "TIMESTAMP"),
+    bigquery.SchemaField("last_event_at", "TIMESTAMP"),
+    bigquery.SchemaField("is_group_member", "BOOLEAN"),
+    bigquery.SchemaField("member_active", "BOOLEAN"),
+    bigquery.SchemaField("updated_at", "TIMESTAMP"),
+]
+
+EVENT_KEY_TYPE = bigquery.StructQueryParameterType(
+    bigquery.ScalarQueryParameterType("STRING", name="event_id"),
+    bigquery.ScalarQueryParameterType("STRING", name="group_id"),
+    bigquery.ScalarQueryParameterType("DATE", name="month"),
+)
+
+VALUE_FIELDS = [field.name for field in SCHEMA if field.name not in ("member_id", "group_id", "month")]
+
+
+def _table(name):
+    return f"`{bigquery_upload.GCP_PROJECT_ID}.{bigquery_upload.dataset_id()}.{name}`"
+
+
+def _month(column):
+    return f"DATE_TRUNC(DATE({column}, '{AGGREGATE_TIMEZONE}'), MONTH)"
+
+
+def _month_of(starts_at):
+    """Month (first day) of an ISO timestamp string, in AGGREGATE_TIMEZONE."""
+    if not starts_at:
+        return None
+    value = starts_at if isinstance(starts_at, datetime.datetime) else datetime.datetime.fromisoformat(str(starts_at))
+    if value.tzinfo is not None:
+        value = value.astimezone(ZoneInfo(AGGREGATE_TIMEZONE))
+    return value.date().replace(day=1)
+
+
+def event_key(event_id, group_id, starts_at):
+    """Return the (event_id, group_id, month) key of an event, or None if incomplete."""
+    if not group_id or not starts_at:
+        return None
+    return (event_id, group_id, _month_of(starts_at))
+
+
+def _aggregate_select(touched=None):
+    """
+    SELECT computing aggregate rows, restricted to a `touched` key relation.
+    """
+    join_touched = (
+        f"JOIN {touched} t ON t.member_id = p.member_id AND t.group_id = e.group_id "
+        f"AND t.month = {_month('e.starts_at')}"
+        if touched else ""
+    )
+    return f"""
+        SELECT
+            p.member_id,
+            e.group_id,
+            {_month('e.starts_at')} AS month,
+            COUNT(*) AS presences,
+            COUNTIF(p.confirmed) AS confirmed_presences,
+            MIN(e.starts_at) AS first_event_at,
+            MAX(e.starts_at) AS last_event_at,
+            LOGICAL_OR(ms.member_id IS NOT NULL) AS is_group_member,
+            ANY_VALUE(m.active) AS member_active,
+            CURRENT_TIMESTAMP() AS updated_at
+        FROM {_table('presences')} p
+        JOIN {_table('events')} e ON e.event_id = p.event_id
+        {join_touched}
+        LEFT JOIN {_table('members')} m ON m.member_id = p.member_id
+        LEFT JOIN {_table('memberships')} ms ON ms.member_id = p.member_id AND ms.group_id = e.group_id
+        WHERE e.group_id IS NOT NULL AND e.starts_at IS NOT NULL
+        GROUP BY p.member_id, e.group_id, month
+    """
+
+
+def create_table_if_not_exists(client):
+    """Create the aggregate table, partitioned by month and clustered by group and member."""
+    table_ref = client.dataset(bigquery_upload.dataset_id()).table(ATTENDANCE_AGGREGATE_TABLE)
+    try:
+        client.get_table(table_ref)
+    except NotFound:
+        table = bigquery.Table(table_ref, schema=SCHEMA)
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.MONTH, field="month"
+        )
+        table.clustering_fields = ["group_id", "member_id"]
+        client.create_table(table)
+        log(f"Created table {ATTENDANCE_AGGREGATE_TABLE}")
+
+
+def previous_event_keys(client, event_ids):
+    """
+    Return the stored group and month of events before they are merged.
+
+    Args:
+        client: BigQuery client instance
+        event_ids (list): IDs of the events about to be merged
+
+    Returns:
+        list: (event_id, group_id, month) tuples of events already in BigQuery
+    """
+    if not event_ids:
+        return []
+    query = f"""
+        SELECT event_id, group_id, {_month('starts_at')} AS month
+        FROM {_table('events')}
+        WHERE event_id IN UNNEST(@event_ids) AND group_id IS NOT NULL AND starts_at IS NOT NULL
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("event_ids", "STRING", list(event_ids))]
+    )
+    try:
+        _, rows = cost_guard.run_query(client, "query", query, label="previous_event_keys", job_config=job_config)
+    except NotFound:
+        return []
+    return [(row.event_id, row.group_id, row.month) for row in rows]
+
+
+def prepare(client, data_dict):
+    """
+    Collect what an upload will touch, before its MERGE runs.
+
+    Args:
+        client: BigQuery client instance
+        data_dict: Tables about to be uploaded (see upload_all_tables)
+
+    Returns:
+        dict: Touched event keys and member IDs for refresh(), or None when
+              aggregates are disabled or nothing relevant is uploaded
+    """
+    if not ATTENDANCE_AGGREGATES:
+        return None
+
+    event_keys = set()
+    for row in data_dict.get("events") or []:
+        key = event_key(row["event_id"], row.get("group_id"), row.get("starts_at"))
+        if key:
+            event_keys.add(key)
+    member_ids = {row["member_id"] for row in data_dict.get("members") or []}
+    member_ids.update(row["member_id"] for row in data_dict.get("memberships") or [])
+    if not event_keys and not member_ids:
+        return None
+
+    event_keys.update(previous_event_keys(client, sorted({key[0] for key in event_keys})))
+    return {"event_keys": sorted(event_keys), "member_ids": sorted(member_ids)}
+
+
+def refresh(client, touched):
+    """
+    Recompute the aggregate rows of the touched (member, group, month) keys.
+
+    Args:
+        client: BigQuery client instance
+        touched (dict): As returned by prepare()
+
+    Returns:
+        int: Number of aggregate rows inserted, updated or deleted
+    """
+    if not touched:
+        return 0
+    create_table_if_not_exists(client)
+
+    value_fields = ", ".join(VALUE_FIELDS)
+    update_set = ", ".join(f"target.{field} = source.{field}" for field in VALUE_FIELDS)
+    query = f"""
+        MERGE {_table(ATTENDANCE_AGGREGATE_TABLE)} AS target
+        USING (
+            WITH touched AS (
+                SELECT DISTINCT p.member_id, k.group_id, k.month
+                FROM {_table('presences')} p
+                JOIN UNNEST(@event_keys) k ON k.event_id = p.event_id
+                UNION DISTINCT
+                SELECT DISTINCT p.member_id, e.group_id, {_month('e.starts_at')} AS month
+                FROM {_table('presences')} p
+                JOIN {_table('events')} e ON e.event_id = p.event_id
+                WHERE p.member_id IN UNNEST(@member_ids)
+                  AND e.group_id IS NOT NULL AND e.starts_at IS NOT NULL
+            ),
+            fresh AS ({_aggregate_select('touched')})
+            SELECT t.member_id, t.group_id, t.month, fresh.* EXCEPT (member_id, group_id, month)
+            FROM touched t
+            LEFT JOIN fresh USING (member_id, group_id, month)
+        ) AS source
+        ON target.member_id = source.member_id
+           AND target.group_id = source.group_id
+           AND target.month = source.month
+        WHEN MATCHED AND source.presences IS NULL THEN
+            DELETE
+        WHEN MATCHED THEN
+            UPDATE SET {update_set}
+        WHEN NOT MATCHED AND source.presences IS NOT NULL THEN
+            INSERT (member_id, group_id, month, {value_fields})
+            VALUES (source.member_id, source.group_id, source.month,
+                    {', '.join(f'source.{field}' for field in VALUE_FIELDS)})
+    """
+    event_keys = [
+        bigquery.StructQueryParameter(
+            None,
+            bigquery.ScalarQueryParameter("event_id", "STRING", event_id),
+            bigquery.ScalarQueryParameter("group_id", "STRING", group_id),
+            bigquery.ScalarQueryParameter("month", "DATE", month),
+        )
+        for event_id, group_id, month in touched["event_keys"]
+    ]
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("event_keys", EVENT_KEY_TYPE, event_keys),
+        bigquery.ArrayQueryParameter("member_ids", "STRING", touched["member_ids"]),
+    ])
+
+    with tracing.span("bigquery.attendance_aggregates", events=len(event_keys),
+                      members=len(touched["member_ids"])) as span:
+        query_job, _ = cost_guard.run_query(
+            client, "aggregate", query, label=ATTENDANCE_AGGREGATE_TABLE, job_config=job_config
+        )
+        affected = getattr(query_job, "num_dml_affected_rows", None) or 0
+        span.set_attribute("affected_rows", affected)
+    return affected
+
+
+def refresh_after_upload(client, touched):
+    """
+    Refresh the aggregates after a successful upload without failing it.
+
+    The uploaded data is already committed at this point, so a failed
+    refresh is only reported; run `rebuild` to repair the aggregates.
+    """
+    if not touched:
+        return
+    log(f"Refreshing attendance aggregates...", end='', flush=True)
+    try:
+        affected = refresh(client, touched)
+        log(f" ✓ {affected} aggregate rows updated")
+    except Exception as e:
+        log(f" ✗ FAILED")
+        error(f"Could not refresh {ATTENDANCE_AGGREGATE_TABLE}: {e}. "
+              f"Run `python src/attendance_aggregates.py rebuild` to repair it.")
+
+
+def rebuild(client=None):
+    """
+    Recreate the aggregate table from the full history.
+
+    Args:
+        client: BigQuery client instance (default: a new client)
+    """
+    client = client or bigquery_upload.initialize_bigquery_client()
+    log(f"Rebuilding {ATTENDANCE_AGGREGATE_TABLE} from the full history...")
+    query = f"""
+        CREATE OR REPLACE TABLE {_table(ATTENDANCE_AGGREGATE_TABLE)}
+        PARTITION BY DATE_TRUNC(month, MONTH)
+        CLUSTER BY group_id, member_id
+        AS {_aggregate_select()}
+    """
+    cost_guard.run_query(client, "aggregate", query, label=ATTENDANCE_AGGREGATE_TABLE)
+    table = client.get_table(client.dataset(bigquery_upload.dataset_id()).table(ATTENDANCE_AGGREGATE_TABLE))
+    log(f"  Rebuild completed ({table.num_rows} rows)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the attendance aggregate table")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild", help="Recreate the aggregate table from the full history")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        rebuild()
@@ -0,0 +1,116 @@
+"""
+Microbenchmarks for listing_decoder on synthetic multi-megabyte listings.
+
+Compares the previous approach (json.loads of the whole payload, then picking
+the IDs) with every available listing_decoder backend, reporting time and
+peak Python memory per decode.
+
+Usage:
+    python src/bench_listing_decoder.py [--events 20000 50000] [--repeat 5]
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+import listing_decoder
+from logger import log
+
+
+def synthetic_listing(event_count, seed=0):
+    """
+    Build a listing payload shaped like the MyClub events/ endpoint.
+
+    Args:
+        event_count (int): Number of events in the listing
+        seed (int): Random seed for reproducible payloads
+
+    Returns:
+        bytes: JSON-encoded listing
+    """
+    rng = random.Random(seed)
+    items = []
+    for idx in range(event_count):
+        event_id = 8000000 + idx
+        items.append({
+            "event": {
+                "id": event_id,
+                "name": f"Training session {event_id} ({rng.choice(['Longsword', 'Sabre', 'Rapier'])})",
+                "starts_at": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T18:00:00.000+02:00",
+                "ends_at": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T20:00:00.000+02:00",
+                "event_category_id": rng.randint(1, 20),
+                "group_id": rng.randint(28000, 28200),
+                "venue_id": rng.randint(126000, 126300),
+                "course_id": rng.choice([None, rng.randint(7000000, 7100000)]),
+                "description": "Lorem ipsum dolor sit amet, " * rng.randint(1, 8),
+                "visibility": "members",
+                "registration_starts_at": None,
+                "registration_ends_at": None,
+                "created_at": "2023-12-01T10:00:00.000+02:00",
+                "updated_at": "2024-01-01T10:00:00.000+02:00",
+            }
+        })
+    return json.dumps(items).encode("utf-8")
+
+
+def _chunks(payload, chunk_size=listing_decoder.CHUNK_SIZE):
+    for start in range(0, len(payload), chunk_size):
+        yield payload[start:start + chunk_size]
+
+
+def decode_full_json(payload):
+    """Baseline: parse the whole payload with json.loads and pick the IDs."""
+    return [str(c["event"]["id"]) for c in json.loads(payload) if c.get("event")]
+
+
+def decode_backend(payload, backend):
+    """Decode the IDs with a listing_decoder backend from a chunk stream."""
+    return [str(item["id"]) for item in listing_decoder.iter_listing(_chunks(payload), "event", ("id",), backend)]
+
+
+def measure(fn, repeat):
+    """Return (best seconds, peak traced bytes, result) over `repeat` runs."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, result
+
+
+def run_benchmarks(event_counts, repeat):
+    """Run the benchmark matrix and log a result table."""
+    for event_count in event_counts:
+        payload = synthetic_listing(event_count)
+        log(f"\nListing with {event_count} events ({len(payload) / 1024 / 1024:.1f} MB)")
+        log(f"  {'decoder':<12} {'best time':>12} {'MB/s':>10} {'peak memory':>14}")
+
+        candidates = [("json.loads", lambda: decode_full_json(payload))]
+        for backend in listing_decoder.available_backends():
+            candidates.append((backend, lambda backend=backend: decode_backend(payload, backend)))
+
+        expected = None
+        for name, fn in candidates:
+            seconds, peak, result = measure(fn, repeat)
+            if expected is None:
+                expected = result
+            elif result != expected:
+                raise RuntimeError(f"Decoder {name} returned different IDs")
+            throughput = len(payload) / 1024 / 1024 / seconds
+            log(f"  {name:<12} {seconds * 1000:>10.1f}ms {throughput:>10.1f} {peak / 1024 / 1024:>12.1f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark listing response decoding")
+    parser.add_argument("--events", type=int, nargs="+", default=[5000, 20000, 50000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    run_benchmarks(args.events, args.repeat)
@@ -0,0 +1,134 @@
+"""
+Microbenchmarks for the BigQuery upload path against fake_bigquery.FakeClient.
+
+Runs validate_rows, merge_rows, upload_all_tables and
+merge_all_tables_in_transaction on synthetic rows and
+reports per scenario:
+- total wall time
+- time spent inside the fake client (payload serialisation and simulated
+  latency), i.e. what the real API would cost
+- the Python-side remainder (row handling, chunking, query building)
+- API call counts
+- the extra cost of formatting insert errors (validate_rows with an
+  error rate, compared to the clean run)
+
+Usage:
+    python src/bench_upload.py [--rows 1000 10000 100000] [--latency 0.0]
+                               [--error-rate 0.01] [--scenario merge]
+
+1M-row runs are opt-in via --rows 1000000.
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import bigquery_upload
+import fake_bigquery
+import synthetic_rows
+from logger import log
+
+
+SCENARIOS = ("validate", "merge", "upload_all", "transaction")
+
+
+def _quiet():
+    """Swallow the upload path's progress output while measuring."""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def _new_client(latency, error_rate=0.0):
+    client = fake_bigquery.FakeClient(call_latency=latency, job_latency=latency, error_rate=error_rate)
+    with _quiet():
+        bigquery_upload.create_dataset_if_not_exists(client)
+        for table_name in bigquery_upload.ALLOWED_TABLES:
+            bigquery_upload.create_table_if_not_exists(client, table_name)
+    client.reset()
+    return client
+
+
+def measure(fn, client):
+    """
+    Time a call against the fake client.
+
+    Returns:
+        dict: total, fake and python seconds plus API call counts
+    """
+    client.reset()
+    start = time.perf_counter()
+    with _quiet():
+        fn()
+    total = time.perf_counter() - start
+    fake = client.serialization_seconds + client.latency_seconds
+    return {
+        "total": total,
+        "fake": fake,
+        "python": max(total - fake, 0.0),
+        "calls": client.call_counts(),
+    }
+
+
+def error_formatting_seconds(rows, latency, error_rate):
+    """
+    Return the extra time validate_rows spends when inserts report errors.
+
+    Both runs go through the same fake inserts; the difference is the cost of
+    turning the error list into the RuntimeError message.
+    """
+    clean = _new_client(latency)
+    failing = _new_client(latency, error_rate=error_rate)
+    baseline = measure(lambda: bigquery_upload.validate_rows(clean, "presences", rows), clean)
+
+    def validate_failing():
+        try:
+            bigquery_upload.validate_rows(failing, "presences", rows)
+        except RuntimeError:
+            pass
+
+    with_errors = measure(validate_failing, failing)
+    return max(with_errors["python"] - baseline["python"], 0.0)
+
+
+def run_benchmarks(row_counts, scenarios, latency, error_rate):
+    """Run the benchmark matrix and log a result table."""
+    log(f"  {'scenario':<12} {'rows':>9} {'total':>10} {'in fake':>10} {'python':>10} {'rows/s':>10}  calls")
+    for count in row_counts:
+        rows = list(synthetic_rows.synthetic_rows("presences", count))
+        for scenario in scenarios:
+            client = _new_client(latency)
+            if scenario == "validate":
+                fn = lambda: bigquery_upload.validate_rows(client, "presences", rows)
+                total_rows = count
+            elif scenario == "merge":
+                fn = lambda: bigquery_upload.merge_rows(client, "presences", rows)
+                total_rows = count
+            else:
+                data = synthetic_rows.synthetic_tables(count)
+                if scenario == "transaction":
+                    fn = lambda: bigquery_upload.merge_all_tables_in_transaction(data, client=client)
+                else:
+                    fn = lambda: bigquery_upload.upload_all_tables(data, client=client)
+                total_rows = sum(len(table_rows) for table_rows in data.values())
+
+            result = measure(fn, client)
+            calls = ", ".join(f"{method}={n}" for method, n in sorted(result["calls"].items()))
+            log(f"  {scenario:<12} {total_rows:>9} {result['total']:>9.3f}s {result['fake']:>9.3f}s "
+                f"{result['python']:>9.3f}s {total_rows / result['total']:>10.0f}  {calls}")
+
+        if error_rate:
+            seconds = error_formatting_seconds(rows, latency, error_rate)
+            log(f"  {'error format':<12} {count:>9} {seconds:>9.3f}s "
+                f"({int(count * error_rate)} failing rows at error rate {error_rate})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the BigQuery upload path against a fake client")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--scenario", choices=SCENARIOS, nargs="+", default=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Simulated seconds per API call and per job wait")
+    parser.add_argument("--error-rate", type=float, default=0.01,
+                        help="Fraction of rows reported invalid in the error formatting run (0 disables it)")
+    args = parser.parse_args()
+
+    run_benchmarks(args.rows, args.scenario, args.latency, args.error_rate)
@@ -8,6 +8,13 @@ from dotenv import load_dotenv
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
 from google.oauth2 import service_account
+import cost_guard
+import metrics
+import resources
+import row_buffer
+import run_stats
+import tenants
+import tracing
 from logger import log, error
 
 load_dotenv()
@@ -25,34 +32,83 @@ GCP_PROJECT_ID = os.getenv("GCP_PROJECT_ID", "ehms-424721")
 BIGQUERY_DATASET_ID = os.getenv("BIGQUERY_DATASET_ID", "ehms_myclub")
 GOOGLE_CREDENTIALS_PATH = os.getenv("GOOGLE_CREDENTIALS_PATH")
 
+
+def dataset_id():
+    """Return the BigQuery dataset of the active tenant (default: BIGQUERY_DATASET_ID)."""
+    return tenants.dataset(BIGQUERY_DATASET_ID)
+
+
 # Allowed table names for security
 ALLOWED_TABLES = {"categories", "courses", "events", "groups", "members", "memberships", "presences"}
 
+# Rows per streaming insert request (the API limits request size to 10 MB)
+INSERT_CHUNK_SIZE = int(os.getenv("BIGQUERY_INSERT_CHUNK_SIZE", "5000"))
 
-def initialize_bigquery_client():
+# How upload_all_tables writes: 'merge' (validate and MERGE table by table) or
+# 'transaction' (stage all tables, then MERGE them in one atomic script)
+UPLOAD_MODE = os.getenv("BIGQUERY_UPLOAD_MODE", "merge").lower()
+UPLOAD_MODES = ("merge", "transaction")
+
+
+def load_credentials():
     """
-    Initialize and return a BigQuery client.
+    Load the service account credentials of GOOGLE_CREDENTIALS_PATH.
 
-    Uses service account credentials if GOOGLE_CREDENTIALS_PATH is set,
-    otherwise falls back to default application credentials.
+    Returns:
+        Credentials, or None to use default application credentials
     """
     if GOOGLE_CREDENTIALS_PATH:
         # Load credentials from service account JSON file
-        credentials = service_account.Credentials.from_service_account_file(
+        return service_account.Credentials.from_service_account_file(
             GOOGLE_CREDENTIALS_PATH
         )
-        client = bigquery.Client(project=GCP_PROJECT_ID, credentials=credentials)
-    else:
-        # Use default application credentials
-        client = bigquery.Client(project=GCP_PROJECT_ID)
+    return None
+
+
+def create_bigquery_client():
+    """
+    Create a new BigQuery client.
+
+    Uses service account credentials if GOOGLE_CREDENTIALS_PATH is set,
+    otherwise falls back to default application credentials.
+    """
+    credentials = resources.get("bigquery_credentials")
+    if credentials is not None:
+        return bigquery.Client(project=GCP_PROJECT_ID, credentials=credentials)
+    # Use default application credentials
+    return bigquery.Client(project=GCP_PROJECT_ID)
+
+
+def _client_healthy(client):
+    """Health check of a reused client: one metadata request must succeed."""
+    try:
+        client.get_dataset(client.dataset(dataset_id()))
+    except NotFound:
+        pass
+    return True
+
+
+def initialize_bigquery_client():
+    """
+    Return the BigQuery client shared by this instance.
 
-    return client
+    The client (and its credentials and connection pool) is created once and
+    reused by later runs and warm invocations (see resources).
+    """
+    return resources.get("bigquery_client")
+
+
+resources.register("bigquery_credentials", load_credentials)
+resources.register(
+    "bigquery_client", create_bigquery_client,
+    health_check=_client_healthy, close=lambda client: client.close(),
+)
 
 
 def create_dataset_if_not_exists(client):
     """Create the BigQuery dataset if it doesn't already exist."""
-    dataset_id = BIGQUERY_DATASET_ID
-    dataset_ref = client.dataset(dataset_id)
+    dataset_name = dataset_id()
+    dataset_ref = client.dataset(dataset_name)
 
     try:
         client.get_dataset(dataset_ref)
@@ -60,7 +116,7 @@ def create_dataset_if_not_exists(client):
         dataset = bigquery.Dataset(dataset_ref)
         dataset.location = "US"
         dataset = client.create_dataset(dataset, timeout=30)
-        log(f"Created dataset {dataset_id}")
+        log(f"Created dataset {dataset_name}")
 
 
 def get_table_schema(table_name):
@@ -115,7 +171,7 @@ def get_table_schema(table_name):
 
 def create_table_if_not_exists(client, table_name):
     """Create a BigQuery table if it doesn't already exist."""
-    dataset_ref = client.dataset(BIGQUERY_DATASET_ID)
+    dataset_ref = client.dataset(dataset_id())
     table_ref = dataset_ref.table(table_name)
     new_schema = get_table_schema(table_name)
 
@@ -142,6 +198,37 @@ def get_primary_keys(table_name):
     return primary_keys.get(table_name, [])
 
 
+def stream_rows(client, table_ref, rows):
+    """
+    Stream rows into a table in chunks of INSERT_CHUNK_SIZE rows.
+
+    Rows may be a list or a row_buffer.RowBuffer, which is read segment by
+    segment so that spilled rows never need to be in memory at once.
+
+    Args:
+        client: BigQuery client instance
+        table_ref: Destination table reference
+        rows: List of row dictionaries or a RowBuffer
+
+    Returns:
+        list: Insert errors as returned by insert_rows_json, with row indexes
+              relative to the whole row sequence
+    """
+    errors = []
+    offset = 0
+    for chunk in row_buffer.iter_chunks(rows, INSERT_CHUNK_SIZE):
+        with tracing.span("bigquery.insert_rows_json", table=table_ref.table_id,
+                          offset=offset, rows=len(chunk)) as span:
+            chunk_errors = client.insert_rows_json(table_ref, chunk, skip_invalid_rows=False)
+            span.set_attribute("errors", len(chunk_errors))
+        for err in chunk_errors:
+            if isinstance(err.get('index'), int):
+                err['index'] += offset
+            errors.append(err)
+        offset += len(chunk)
+    return errors
+
+
 def validate_rows(client, table_name, rows):
     """
     Validate that rows can be inserted into a BigQuery table without actually inserting them.
@@ -166,41 +253,100 @@ def validate_rows(client, table_name, rows):
     # Create a temporary validation table
     import uuid
     validation_table_name = f"{table_name}_validation_{uuid.uuid4().hex[:8]}"
-    dataset_ref = client.dataset(BIGQUERY_DATASET_ID)
+    dataset_ref = client.dataset(dataset_id())
     validation_table_ref = dataset_ref.table(validation_table_name)
 
     # Get schema for the table
     schema = get_table_schema(table_name)
 
-    validation_table_created = False
-    try:
-        # Create temporary validation table
-        validation_table = bigquery.Table(validation_table_ref, schema=schema)
-        validation_table = client.create_table(validation_table)
-        validation_table_created = True
-
-        # Attempt to insert data
-        errors = client.insert_rows_json(validation_table_ref, rows, skip_invalid_rows=False)
-        if errors:
-            error_msg = f"Validation failed for {table_name}:\n"
-            for error in errors:
-                error_msg += f"  Row index: {error.get('index', 'unknown')}\n"
-                for err in error.get('errors', []):
-                    error_msg += f"    - {err.get('reason', 'unknown')}: {err.get('message', 'no message')}\n"
-                    error_msg += f"      Location: {err.get('location', 'unknown')}\n"
-            raise RuntimeError(error_msg)
+    with tracing.span("bigquery.validate_rows", table=table_name, rows=len(rows)):
+        validation_table_created = False
+        try:
+            # Create temporary validation table
+            validation_table = bigquery.Table(validation_table_ref, schema=schema)
+            with tracing.span("bigquery.create_table", table=validation_table_name):
+                validation_table = client.create_table(validation_table)
+            validation_table_created = True
+
+            # Attempt to insert data
+            errors = stream_rows(client, validation_table_ref, rows)
+            if errors:
+                error_msg = f"Validation failed for {table_name}:\n"
+                for error in errors:
+                    error_msg += f"  Row index: {error.get('index', 'unknown')}\n"
+                    for err in error.get('errors', []):
+                        error_msg += f"    - {err.get('reason', 'unknown')}: {err.get('message', 'no message')}\n"
+                        error_msg += f"      Location: {err.get('location', 'unknown')}\n"
+                raise RuntimeError(error_msg)
+
+            return True
+
+        finally:
+            # Clean up validation table
+            if validation_table_created:
+                try:
+                    with tracing.span("bigquery.delete_table", table=validation_table_name):
+                        client.delete_table(validation_table_ref)
+                except NotFound:
+                    pass
+                except Exception as e:
+                    log(f"Warning: Could not delete validation table {validation_table_name}: {e}")
+
+
+def build_merge_query(table_name, source_table_name, insert_only=False):
+    """
+    Build the MERGE statement upserting a source table into a target table.
 
-        return True
+    Args:
+        table_name: Name of the target table
+        source_table_name: Name of the table holding the new rows (same schema)
+        insert_only: Only insert new rows; existing rows are left unchanged,
+                     so only the key columns of the target are read (the
+                     cost guard's downgrade)
 
-    finally:
-        # Clean up validation table
-        if validation_table_created:
-            try:
-                client.delete_table(validation_table_ref)
-            except NotFound:
-                pass
-            except Exception as e:
-                log(f"Warning: Could not delete validation table {validation_table_name}: {e}")
+    Returns:
+        str: MERGE statement matching rows on the table's primary keys
+    """
+    primary_keys = get_primary_keys(table_name)
+    schema = get_table_schema(table_name)
+
+    # Build MERGE statement
+    match_condition = " AND ".join([f"target.{key} = source.{key}" for key in primary_keys])
+
+    # Get all field names from schema
+    all_fields = [field.name for field in schema]
+
+    # Build UPDATE SET clause (update all fields except primary keys)
+    update_fields = [f for f in all_fields if f not in primary_keys]
+
+    # Build INSERT clause
+    insert_fields = ", ".join(all_fields)
+    insert_values = ", ".join([f"source.{field}" for field in all_fields])
+
+    # Build MERGE query - handle edge case where there are no non-PK fields to update
+    if not update_fields or insert_only:
+        # If all fields are primary keys, only INSERT (no UPDATE needed)
+        return f"""
+            MERGE `{GCP_PROJECT_ID}.{dataset_id()}.{table_name}` AS target
+            USING `{GCP_PROJECT_ID}.{dataset_id()}.{source_table_name}` AS source
+            ON {match_condition}
+            WHEN NOT MATCHED THEN
+                INSERT ({insert_fields})
+                VALUES ({insert_values})
+        """
+
+    # Normal case: both UPDATE and INSERT
+    update_set = ", ".join([f"target.{field} = source.{field}" for field in update_fields])
+    return f"""
+            MERGE `{GCP_PROJECT_ID}.{dataset_id()}.{table_name}` AS target
+            USING `{GCP_PROJECT_ID}.{dataset_id()}.{source_table_name}` AS source
+            ON {match_condition}
+            WHEN MATCHED THEN
+                UPDATE SET {update_set}
+            WHEN NOT MATCHED THEN
+                INSERT ({insert_fields})
+                VALUES ({insert_values})
+        """
 
 
 def merge_rows(client, table_name, rows):
@@ -214,6 +360,10 @@ def merge_rows(client, table_name, rows):
         client: BigQuery client instance
         table_name: Name of the table
         rows: List of row dictionaries
+
+    Returns:
+        bool: True if the cost guard downgraded the MERGE to insert-only, so
+              existing rows were not updated
     """
     # Validate table name for security
     if table_name not in ALLOWED_TABLES:
@@ -221,97 +371,72 @@ def merge_rows(client, table_name, rows):
 
     if not rows:
         log(f"No entries for {table_name}")
-        return
+        return False
 
     primary_keys = get_primary_keys(table_name)
     if not primary_keys:
         log(f"Warning: No primary keys defined for {table_name}, using insert_rows instead")
         insert_rows(client, table_name, rows)
-        return
+        return False
 
     # Create a temporary table name with unique suffix to avoid collisions
     import uuid
     temp_table_name = f"{table_name}_temp_{uuid.uuid4().hex[:8]}"
-    dataset_ref = client.dataset(BIGQUERY_DATASET_ID)
+    dataset_ref = client.dataset(dataset_id())
     temp_table_ref = dataset_ref.table(temp_table_name)
 
     # Get schema for the table
     schema = get_table_schema(table_name)
 
-    temp_table_created = False
-    try:
-        # Create temporary table
-        temp_table = bigquery.Table(temp_table_ref, schema=schema)
-        temp_table = client.create_table(temp_table)
-        temp_table_created = True
-
-        # Insert data into temporary table
-        errors = client.insert_rows_json(temp_table_ref, rows, skip_invalid_rows=False)
-        if errors:
-            error(f"\nErrors inserting rows into temp table {temp_table_name}:")
-            for err_item in errors:
-                error(f"  Row index: {err_item.get('index', 'unknown')}")
-                for err in err_item.get('errors', []):
-                    error(f"    - {err.get('reason', 'unknown')}: {err.get('message', 'no message')}")
-                    error(f"      Location: {err.get('location', 'unknown')}")
-            raise RuntimeError(f"Failed to insert rows into {temp_table_name}")
-
-        # Build MERGE statement
-        match_condition = " AND ".join([f"target.{key} = source.{key}" for key in primary_keys])
-
-        # Get all field names from schema
-        all_fields = [field.name for field in schema]
-
-        # Build UPDATE SET clause (update all fields except primary keys)
-        update_fields = [f for f in all_fields if f not in primary_keys]
-
-        # Build INSERT clause
-        insert_fields = ", ".join(all_fields)
-        insert_values = ", ".join([f"source.{field}" for field in all_fields])
-
-        # Build MERGE query - handle edge case where there are no non-PK fields to update
-        if not update_fields:
-            # If all fields are primary keys, only INSERT (no UPDATE needed)
-            merge_query = f"""
-                MERGE `{GCP_PROJECT_ID}.{BIGQUERY_DATASET_ID}.{table_name}` AS target
-                USING `{GCP_PROJECT_ID}.{BIGQUERY_DATASET_ID}.{temp_table_name}` AS source
-                ON {match_condition}
-                WHEN NOT MATCHED THEN
-                    INSERT ({insert_fields})
-                    VALUES ({insert_values})
-            """
-        else:
-            # Normal case: both UPDATE and INSERT
-            update_set = ", ".join([f"target.{field} = source.{field}" for field in update_fields])
-            merge_query = f"""
-                MERGE `{GCP_PROJECT_ID}.{BIGQUERY_DATASET_ID}.{table_name}` AS target
-                USING `{GCP_PROJECT_ID}.{BIGQUERY_DATASET_ID}.{temp_table_name}` AS source
-                ON {match_condition}
-                WHEN MATCHED THEN
-                    UPDATE SET {update_set}
-                WHEN NOT MATCHED THEN
-                    INSERT ({insert_fields})
-                    VALUES ({insert_values})
-            """
-
-        # Execute MERGE
-        query_job = client.query(merge_query)
-        result = query_job.result()
-
-        log(f" ✓ successfully merged {len(rows)} rows")
+    with tracing.span("bigquery.merge_rows", table=table_name, rows=len(rows)):
+        temp_table_created = False
+        try:
+            # Create temporary table
+            temp_table = bigquery.Table(temp_table_ref, schema=schema)
+            with tracing.span("bigquery.create_table", table=temp_table_name):
+                temp_table = client.create_table(temp_table)
+            temp_table_created = True
+
+            # Insert data into temporary table
+            errors = stream_rows(client, temp_table_ref, rows)
+            if errors:
+                error(f"\nErrors inserting rows into temp table {temp_table_name}:")
+                for err_item in errors:
+                    error(f"  Row index: {err_item.get('index', 'unknown')}")
+                    for err in err_item.get('errors', []):
+                        error(f"    - {err.get('reason', 'unknown')}: {err.get('message', 'no message')}")
+                        error(f"      Location: {err.get('location', 'unknown')}")
+                raise RuntimeError(f"Failed to insert rows into {temp_table_name}")
+
+            merge_query = build_merge_query(table_name, temp_table_name)
+
+            # Execute MERGE (dry-run first, see cost_guard)
+            with tracing.span("bigquery.merge_query", table=table_name) as span:
+                query_job, _ = cost_guard.run_query(
+                    client, "merge", merge_query, label=table_name,
+                    downgrade=lambda: build_merge_query(table_name, temp_table_name, insert_only=True),
+                )
+                span.set_attribute("job_id", getattr(query_job, "job_id", None))
+                span.set_attribute("bytes_processed", getattr(query_job, "total_bytes_processed", None))
+            metrics.observe_rows_merged(table_name, len(rows))
+
+            downgraded = table_name in cost_guard.downgraded()
+            log(f" ✓ successfully merged {len(rows)} rows{' (insert-only)' if downgraded else ''}")
+            return downgraded
 
-    except Exception as e:
-        error(f"Error during merge operation for {table_name}: {e}")
-        raise
-    finally:
-        # Clean up temporary table only if it was created
-        if temp_table_created:
-            try:
-                client.delete_table(temp_table_ref)
-            except NotFound:
-                pass  # Already deleted, that's fine
-            except Exception as e:
-                log(f"Warning: Could not delete temp table {temp_table_name}: {e}")
+        except Exception as e:
+            error(f"Error during merge operation for {table_name}: {e}")
+            raise
+        finally:
+            # Clean up temporary table only if it was created
+            if temp_table_created:
+                try:
+                    with tracing.span("bigquery.delete_table", table=temp_table_name):
+                        client.delete_table(temp_table_ref)
+                except NotFound:
+                    pass  # Already deleted, that's fine
+                except Exception as e:
+                    log(f"Warning: Could not delete temp table {temp_table_name}: {e}")
 
 
 def insert_rows(client, table_name, rows, replace=False):
@@ -328,18 +453,19 @@ def insert_rows(client, table_name, rows, replace=False):
         log(f"No entries for {table_name}")
         return
 
-    dataset_ref = client.dataset(BIGQUERY_DATASET_ID)
+    dataset_ref = client.dataset(dataset_id())
     table_ref = dataset_ref.table(table_name)
     table = client.get_table(table_ref)
 
     # Insert rows
-    errors = client.insert_rows_json(table_ref, rows, skip_invalid_rows=False)
+    errors = stream_rows(client, table_ref, rows)
 
     if errors:
         error(f"Errors inserting rows into {table_name}:")
         for err in errors:
             error(err)
     else:
+        metrics.observe_rows_merged(table_name, len(rows))
         log(f"Successfully inserted {len(rows)} rows into {table_name}")
 
 
@@ -357,10 +483,9 @@ def get_most_recent_date(client):
     try:
         query = f"""
             SELECT MAX(starts_at) as max_date
-            FROM `{GCP_PROJECT_ID}.{BIGQUERY_DATASET_ID}.events`
+            FROM `{GCP_PROJECT_ID}.{dataset_id()}.events`
         """
-        query_job = client.query(query)
-        results = query_job.result()
+        _, results = cost_guard.run_query(client, "query", query, label="most_recent_date")
 
         for row in results:
             max_date = row.max_date
@@ -373,14 +498,17 @@ def get_most_recent_date(client):
                 return None
 
     except NotFound:
-        log(f"Dataset {BIGQUERY_DATASET_ID} or table 'events' not found in BigQuery")
+        log(f"Dataset {dataset_id()} or table 'events' not found in BigQuery")
         return None
+    except cost_guard.BudgetExceeded:
+        # Falling back to the full history would cost even more
+        raise
     except Exception as e:
         error(f"Error retrieving most recent date from BigQuery: {e}")
         return None
 
 
-def upload_all_tables(data_dict):
+def upload_all_tables(data_dict, client=None):
     """
     Upload all tables to BigQuery.
 
@@ -404,8 +532,22 @@ def upload_all_tables(data_dict):
                        'memberships': [...],
                        'presences': [...]
                    }
+        client: BigQuery client instance (default: a new client)
+
+    With BIGQUERY_UPLOAD_MODE=transaction the upload is delegated to
+    merge_all_tables_in_transaction instead.
+
+    Returns:
+        list: Tables whose MERGE the cost guard downgraded to insert-only;
+              their existing rows were not updated, so callers must not
+              record them as fetched (see cost_guard)
     """
-    client = initialize_bigquery_client()
+    client = client or initialize_bigquery_client()
+
+    if UPLOAD_MODE not in UPLOAD_MODES:
+        raise ValueError(f"Invalid BIGQUERY_UPLOAD_MODE: {UPLOAD_MODE}. Allowed modes: {UPLOAD_MODES}")
+    if UPLOAD_MODE == "transaction":
+        return merge_all_tables_in_transaction(data_dict, client=client)
 
     # Create dataset and tables
     create_dataset_if_not_exists(client)
@@ -416,19 +558,20 @@ def upload_all_tables(data_dict):
 
     # VALIDATION PHASE: Validate ALL tables before inserting ANY data
     log(f"Validating data for all tables...")
-    validation_errors = []
-    for idx, (table_name, rows) in enumerate(data_dict.items(), 1):
-        if not rows:
-            log(f"  [{idx}/{len(data_dict)}] Skipping validation for {table_name} (no data)")
-            continue
-
-        log(f"  [{idx}/{len(data_dict)}] Validating {table_name} ({len(rows)} rows)...", end='')
-        try:
-            validate_rows(client, table_name, rows)
-            log(f" ✓ passed")
-        except Exception as e:
-            validation_errors.append((table_name, str(e)))
-            log(f" ✗ FAILED")
+    with run_stats.stage("validation"):
+        validation_errors = []
+        for idx, (table_name, rows) in enumerate(data_dict.items(), 1):
+            if not rows:
+                log(f"  [{idx}/{len(data_dict)}] Skipping validation for {table_name} (no data)")
+                continue
+
+            log(f"  [{idx}/{len(data_dict)}] Validating {table_name} ({len(rows)} rows)...", end='')
+            try:
+                validate_rows(client, table_name, rows)
+                log(f" ✓ passed")
+            except Exception as e:
+                validation_errors.append((table_name, str(e)))
+                log(f" ✗ FAILED")
 
     # If any validation failed, abort before inserting anything
     if validation_errors:
@@ -442,16 +585,369 @@ def upload_all_tables(data_dict):
 
     log(f"✓ All validations passed!\n")
 
+    # Keys of the attendance aggregates touched by this upload (before the
+    # MERGE overwrites the previous group/date of the events)
+    import attendance_aggregates
+    touched = attendance_aggregates.prepare(client, data_dict)
+
     # INSERTION PHASE: Now that all validations passed, perform the actual merges
     log(f"Uploading data to BigQuery...")
-    for idx, (table_name, rows) in enumerate(data_dict.items(), 1):
-        log(f"  [{idx}/{len(data_dict)}] Uploading {table_name}...", end='', flush=True)
-        merge_rows(client, table_name, rows)
+    downgraded = []
+    with run_stats.stage("merge"):
+        for idx, (table_name, rows) in enumerate(data_dict.items(), 1):
+            log(f"  [{idx}/{len(data_dict)}] Uploading {table_name}...", end='', flush=True)
+            if merge_rows(client, table_name, rows):
+                downgraded.append(table_name)
     log(f"  Upload completed!")
+    if downgraded:
+        error(f"Existing rows of {', '.join(downgraded)} were not updated (insert-only MERGE)")
+
+    with run_stats.stage("aggregates"):
+        attendance_aggregates.refresh_after_upload(client, touched)
+    return downgraded
+
+
+def delete_events(event_ids, client=None, event_keys=()):
+    """
+    Delete events and their presences, e.g. events cancelled in MyClub.
+
+    The event rows are deleted first and the attendance aggregates of their
+    (member, group, month) keys refreshed, which drops the keys that only had
+    presences of these events; their presences are deleted last, only once
+    the refresh has succeeded. A failed call can be retried: the aggregate
+    keys are found through the remaining presences.
+
+    Args:
+        event_ids (list): IDs of the events to delete
+        client: BigQuery client instance (default: a new client)
+        event_keys: Known (event_id, group_id, month) keys of the events
+                    (see attendance_aggregates.event_key), refreshed in
+                    addition to those still in BigQuery, so a retry after
+                    the event rows are gone still refreshes them
+
+    Returns:
+        int: Number of deleted event rows
+
+    Raises:
+        Exception: If a DELETE or the aggregate refresh fails
+    """
+    if not event_ids:
+        return 0
+    client = client or initialize_bigquery_client()
+
+    import attendance_aggregates
+    touched = None
+    if attendance_aggregates.ATTENDANCE_AGGREGATES:
+        keys = set(event_keys)
+        keys.update(attendance_aggregates.previous_event_keys(client, event_ids))
+        if keys:
+            touched = {"event_keys": sorted(keys), "member_ids": []}
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("event_ids", "STRING", list(event_ids))]
+    )
+    deleted = 0
+    for table_name in ("events", "presences"):
+        query = f"""
+            DELETE FROM `{GCP_PROJECT_ID}.{dataset_id()}.{table_name}`
+            WHERE event_id IN UNNEST(@event_ids)
+        """
+        try:
+            query_job, _ = cost_guard.run_query(
+                client, "delete", query, label=table_name, job_config=job_config
+            )
+        except NotFound:
+            continue
+        if table_name == "events":
+            deleted = getattr(query_job, "num_dml_affected_rows", None) or 0
+            attendance_aggregates.refresh(client, touched)
+    log(f"Deleted {deleted} cancelled events and their presences")
+    return deleted
+
+
+def load_rows_into_table(client, table_ref, table_name, rows,
+                         write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE):
+    """
+    Load rows into a table with a single BigQuery load job.
+
+    Unlike streaming inserts, load jobs are free, apply to the table
+    atomically and either load every row or none. A RowBuffer is loaded
+    directly from its NDJSON segments, one load job per segment.
+
+    Args:
+        client: BigQuery client instance
+        table_ref: Destination table reference
+        table_name: Name of the logical table (used for the schema)
+        rows: List of row dictionaries or a RowBuffer
+        write_disposition: BigQuery write disposition (default: WRITE_TRUNCATE)
+    """
+    def job_config(disposition):
+        return bigquery.LoadJobConfig(
+            schema=get_table_schema(table_name),
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=disposition,
+        )
+
+    def wait(load_job):
+        try:
+            metrics.run_bigquery_job("load", load_job)
+        except Exception:
+            for err in load_job.errors or []:
+                error(f"    - {err.get('reason', 'unknown')}: {err.get('message', 'no message')}")
+            raise
+
+    if not isinstance(rows, row_buffer.RowBuffer):
+        wait(client.load_table_from_json(rows, table_ref, job_config=job_config(write_disposition)))
+        return
+
+    disposition = write_disposition
+    for path in rows.segment_paths():
+        with open(path, "rb") as f:
+            wait(client.load_table_from_file(f, table_ref, job_config=job_config(disposition)))
+        disposition = bigquery.WriteDisposition.WRITE_APPEND
+
+
+def replace_all_tables(data_dict, client=None):
+    """
+    Atomically replace the full contents of all tables (rebuild mode).
+
+    Intended for full historical rebuilds, where there is nothing in the target
+    to MERGE against. Every table is first loaded into a staging table with a
+    load job; only when ALL tables were staged successfully is each production
+    table replaced by a WRITE_TRUNCATE copy of its staging table. The copy
+    replaces the table contents atomically, so production tables are never
+    visible empty or half-filled. Tables without rows are left untouched.
+
+    Args:
+        data_dict: Dictionary with table names as keys and row lists as values
+        client: BigQuery client instance (default: a new client)
+
+    Raises:
+        RuntimeError: If staging fails for any table (no table is replaced)
+    """
+    import datetime
+    import uuid
+
+    client = client or initialize_bigquery_client()
+    create_dataset_if_not_exists(client)
+    dataset_ref = client.dataset(dataset_id())
+    suffix = uuid.uuid4().hex[:8]
+
+    staged = {}
+    try:
+        # STAGING PHASE: load every table before replacing any of them
+        log(f"Staging data for all tables...")
+        staging_errors = []
+        for idx, (table_name, rows) in enumerate(data_dict.items(), 1):
+            if table_name not in ALLOWED_TABLES:
+                raise ValueError(f"Invalid table name: {table_name}. Allowed tables: {ALLOWED_TABLES}")
+            create_table_if_not_exists(client, table_name)
+            if not rows:
+                log(f"  [{idx}/{len(data_dict)}] Skipping {table_name} (no data, table left untouched)")
+                continue
+
+            staging_ref = dataset_ref.table(f"{table_name}_rebuild_{suffix}")
+            staging_table = bigquery.Table(staging_ref, schema=get_table_schema(table_name))
+            # Staging tables expire on their own if the cleanup below never runs
+            staging_table.expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+            client.create_table(staging_table)
+            staged[table_name] = staging_ref
+
+            log(f"  [{idx}/{len(data_dict)}] Staging {table_name} ({len(rows)} rows)...", end='')
+            try:
+                with run_stats.stage("staging"):
+                    load_rows_into_table(client, staging_ref, table_name, rows)
+                log(f" ✓ staged")
+            except Exception as e:
+                staging_errors.append((table_name, str(e)))
+                log(f" ✗ FAILED")
+
+        if staging_errors:
+            error("\n" + "="*80)
+            error("STAGING FAILED - No table was replaced")
+            error("="*80)
+            for table_name, err_msg in staging_errors:
+                error(f"\n{table_name}:")
+                error(err_msg)
+            raise RuntimeError(f"Staging failed for {len(staging_errors)} table(s). No table was replaced.")
+
+        # SWAP PHASE: atomically replace each production table
+        log(f"Replacing tables...")
+        copy_config = bigquery.CopyJobConfig(
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE
+        )
+        for idx, (table_name, staging_ref) in enumerate(staged.items(), 1):
+            log(f"  [{idx}/{len(staged)}] Replacing {table_name}...", end='', flush=True)
+            with run_stats.stage("swap"):
+                metrics.run_bigquery_job(
+                    "copy", client.copy_table(staging_ref, dataset_ref.table(table_name), job_config=copy_config)
+                )
+            metrics.observe_rows_merged(table_name, len(data_dict[table_name]))
+            log(f" ✓ replaced with {len(data_dict[table_name])} rows")
+        log(f"  Rebuild completed!")
+
+        import attendance_aggregates
+        if attendance_aggregates.ATTENDANCE_AGGREGATES:
+            with run_stats.stage("aggregates"):
+                attendance_aggregates.rebuild(client)
+
+    finally:
+        for staging_ref in staged.values():
+            try:
+                client.delete_table(staging_ref, not_found_ok=True)
+            except Exception as e:
+                log(f"Warning: Could not delete staging table {staging_ref.table_id}: {e}")
+
+
+def build_transaction_script(sources, insert_only=False):
+    """
+    Build a BigQuery script merging several tables in one transaction.
+
+    The MERGEs run inside BEGIN TRANSACTION ... COMMIT TRANSACTION, so either
+    every table is updated or none is; on error the transaction is rolled back
+    and the error re-raised. The source tables are dropped once the
+    transaction has committed.
+
+    Args:
+        sources (dict): target table name -> source table name
+        insert_only: Use insert-only MERGEs (see build_merge_query)
+
+    Returns:
+        str: The script
+    """
+    merges = ";\n".join(
+        build_merge_query(table_name, source, insert_only).strip() for table_name, source in sources.items()
+    )
+    drops = "\n".join(
+        f"DROP TABLE IF EXISTS `{GCP_PROJECT_ID}.{dataset_id()}.{source}`;"
+        for source in sources.values()
+    )
+    return f"""
+BEGIN
+  BEGIN TRANSACTION;
+{merges};
+  COMMIT TRANSACTION;
+EXCEPTION WHEN ERROR THEN
+  ROLLBACK TRANSACTION;
+  RAISE USING MESSAGE = @@error.message;
+END;
+{drops}
+"""
+
+
+def merge_all_tables_in_transaction(data_dict, client=None):
+    """
+    Upsert all tables atomically with a single multi-statement transaction.
+
+    Every table is first loaded into a staging table with a load job (which
+    also validates the rows against the schema, so no separate validation
+    phase is needed). Only when ALL tables were staged successfully is one
+    script run that MERGEs every table inside a transaction and then drops
+    the staging tables. Compared to the table-by-table merge this needs one
+    query job instead of seven and a failure can no longer leave some tables
+    updated while others are not.
+
+    Staging tables cannot be script temp tables (load jobs cannot write to
+    them), so they expire on their own after a day in case the cleanup never
+    runs.
+
+    Args:
+        data_dict: Dictionary with table names as keys and row lists as values
+        client: BigQuery client instance (default: a new client)
+
+    Returns:
+        list: Tables merged insert-only because the cost guard downgraded
+              the script (see upload_all_tables)
+
+    Raises:
+        RuntimeError: If staging fails for any table (no data is merged)
+    """
+    import datetime
+    import uuid
+
+    client = client or initialize_bigquery_client()
+    create_dataset_if_not_exists(client)
+    dataset_ref = client.dataset(dataset_id())
+    suffix = uuid.uuid4().hex[:8]
+
+    staged = {}
+    merged = False
+    try:
+        # STAGING PHASE: load every table before merging any of them
+        log(f"Staging data for all tables...")
+        staging_errors = []
+        with run_stats.stage("validation"):
+            for idx, (table_name, rows) in enumerate(data_dict.items(), 1):
+                if table_name not in ALLOWED_TABLES:
+                    raise ValueError(f"Invalid table name: {table_name}. Allowed tables: {ALLOWED_TABLES}")
+                create_table_if_not_exists(client, table_name)
+                if not rows:
+                    log(f"  [{idx}/{len(data_dict)}] Skipping {table_name} (no data)")
+                    continue
+
+                staging_ref = dataset_ref.table(f"{table_name}_txn_{suffix}")
+                staging_table = bigquery.Table(staging_ref, schema=get_table_schema(table_name))
+                staging_table.expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+                client.create_table(staging_table)
+                staged[table_name] = staging_ref
+
+                log(f"  [{idx}/{len(data_dict)}] Staging {table_name} ({len(rows)} rows)...", end='')
+                try:
+                    load_rows_into_table(client, staging_ref, table_name, rows)
+                    log(f" ✓ staged")
+                except Exception as e:
+                    staging_errors.append((table_name, str(e)))
+                    log(f" ✗ FAILED")
+
+        if staging_errors:
+            error("\n" + "="*80)
+            error("STAGING FAILED - No data was inserted")
+            error("="*80)
+            for table_name, err_msg in staging_errors:
+                error(f"\n{table_name}:")
+                error(err_msg)
+            raise RuntimeError(f"Staging failed for {len(staging_errors)} table(s). No data was inserted to maintain consistency.")
+
+        if not staged:
+            log(f"  No data to upload")
+            return []
+
+        import attendance_aggregates
+        touched = attendance_aggregates.prepare(client, data_dict)
+
+        # MERGE PHASE: one script, one transaction
+        log(f"Merging {len(staged)} tables in one transaction...", end='', flush=True)
+        sources = {table_name: ref.table_id for table_name, ref in staged.items()}
+        script = build_transaction_script(sources)
+        with run_stats.stage("merge"):
+            cost_guard.run_query(
+                client, "transaction", script,
+                downgrade=lambda: build_transaction_script(sources, insert_only=True),
+            )
+        merged = True
+        for table_name in staged:
+            metrics.observe_rows_merged(table_name, len(data_dict[table_name]))
+        log(f" ✓ committed {sum(len(data_dict[table_name]) for table_name in staged)} rows")
+        downgraded = list(staged) if "transaction" in cost_guard.downgraded() else []
+        if downgraded:
+            error(f"Existing rows of {', '.join(downgraded)} were not updated (insert-only MERGE)")
+
+        with run_stats.stage("aggregates"):
+            attendance_aggregates.refresh_after_upload(client, touched)
+        return downgraded
+
+    finally:
+        # The script drops the staging tables itself once committed
+        if not merged:
+            for staging_ref in staged.values():
+                try:
+                    client.delete_table(staging_ref, not_found_ok=True)
+                except Exception as e:
+                    log(f"Warning: Could not delete staging table {staging_ref.table_id}: {e}")
 
 
 if __name__ == "__main__":
     # Test the BigQuery connection
     client = initialize_bigquery_client()
     log(f"Connected to GCP project: {GCP_PROJECT_ID}")
-    log(f"Using dataset: {BIGQUERY_DATASET_ID}")
+    log(f"Using dataset: {dataset_id()}")
@@ -1,12 +1,23 @@
 import requests
+import http_client
+import resources
+import tenants
 import json
-import os
 from dotenv import load_dotenv
 from logger import error
 
 load_dotenv()
 
 def categories():
+    """
+    Return all event categories, cached per instance for METADATA_CACHE_SECONDS.
+
+    See fetch_categories and resources.cached.
+    """
+    return resources.cached("categories", fetch_categories)
+
+
+def fetch_categories():
     """
     Fetch all event categories from MyClub API.
 
@@ -17,16 +28,16 @@ def categories():
         ValueError: If MC_TOKEN is not set
         requests.exceptions.RequestException: If API request fails
     """
-    myclub_token = os.getenv("MC_TOKEN")
+    myclub_token = tenants.token()
     if not myclub_token:
         raise ValueError("MC_TOKEN environment variable is required but not set")
 
     headers = {"X-myClub-token": myclub_token}
-    base_url = "https://ehms.myclub.fi/api/"
+    base_url = tenants.base_url()
     full_url = f"{base_url}event_categories"
 
     try:
-        response = requests.get(full_url, headers=headers, timeout=30)
+        response = http_client.get(full_url, headers=headers, timeout=30)
         response.raise_for_status()
         content = response.json()
 
@@ -0,0 +1,218 @@
+"""
+Dry-run cost guard for the generated BigQuery queries.
+
+Every query the pipeline generates (the MERGEs of the upload, the
+transaction script, the start-date lookup, the aggregate refreshes and the
+fan-out weights) is dry-run first, which is free and reports the bytes the
+query would process. The estimate is checked against two budgets:
+
+- QUERY_BUDGET_GB: bytes a single query may process
+- RUN_BUDGET_GB: bytes all queries of a run may process together
+
+(0, the default, disables a budget.) A query over budget raises
+BudgetExceeded, unless COST_GUARD_ACTION=downgrade and the caller offers a
+cheaper variant within budget: the upload MERGEs then fall back to
+insert-only MERGEs, which only read the key columns of the target table but
+no longer update rows that already exist. upload_all_tables returns the
+downgraded tables, so the runs don't record their members as fresh or their
+events as closed and the dropped updates are fetched and merged again.
+
+Each query's estimate, estimated cost (COST_PER_TB, on-demand USD per TiB)
+and actual bytes billed are recorded in the run summary's 'cost_guard'
+entry and the bigquery_bytes_estimated/bigquery_bytes_billed metrics, and
+logged per table when the run finishes. Disabled with COST_GUARD=false.
+"""
+import os
+
+from dotenv import load_dotenv
+from google.cloud import bigquery
+
+import metrics
+import run_stats
+from logger import log, error
+
+load_dotenv()
+
+COST_GUARD = os.getenv("COST_GUARD", "true").lower() in ("true", "1", "yes")
+QUERY_BUDGET_GB = float(os.getenv("QUERY_BUDGET_GB", "0"))
+RUN_BUDGET_GB = float(os.getenv("RUN_BUDGET_GB", "0"))
+COST_GUARD_ACTION = os.getenv("COST_GUARD_ACTION", "abort").lower()
+COST_PER_TB = float(os.getenv("COST_PER_TB", "6.25"))
+
+ACTIONS = ("abort", "downgrade")
+
+GB = 1024 ** 3
+TB = 1024 ** 4
+
+
+class BudgetExceeded(RuntimeError):
+    """Raised when a query's estimate exceeds a budget."""
+
+
+def estimated_cost(num_bytes):
+    """Return the on-demand cost in USD of processing `num_bytes`."""
+    return num_bytes / TB * COST_PER_TB
+
+
+def format_bytes(num_bytes):
+    """Return a byte count in human-readable units."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.2f} TiB"
+
+
+def dry_run(client, query, job_config=None):
+    """
+    Return the bytes a query would process, without running it.
+
+    Args:
+        client: BigQuery client instance
+        query: The query
+        job_config: The query's job config (its parameters are reused)
+    """
+    config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    if job_config is not None and job_config.query_parameters:
+        config.query_parameters = job_config.query_parameters
+    job = client.query(query, job_config=config)
+    return job.total_bytes_processed or 0
+
+
+def _summary():
+    return run_stats.current().extra.setdefault("cost_guard", {
+        "estimated_bytes": 0,
+        "billed_bytes": 0,
+        "estimated_cost": 0.0,
+        "downgraded": [],
+        "queries": [],
+    })
+
+
+def over_budget(estimated, run_estimated):
+    """
+    Return why a query's estimate exceeds a budget, or None.
+
+    Args:
+        estimated: Estimated bytes of the query
+        run_estimated: Estimated bytes of the run's earlier queries
+    """
+    if QUERY_BUDGET_GB and estimated > QUERY_BUDGET_GB * GB:
+        return f"estimate {format_bytes(estimated)} exceeds QUERY_BUDGET_GB={QUERY_BUDGET_GB:g}"
+    if RUN_BUDGET_GB and run_estimated + estimated > RUN_BUDGET_GB * GB:
+        return (f"run total {format_bytes(run_estimated + estimated)} would exceed "
+                f"RUN_BUDGET_GB={RUN_BUDGET_GB:g}")
+    return None
+
+
+def check(client, label, query, job_config=None, downgrade=None):
+    """
+    Dry-run a query and enforce the budgets.
+
+    Args:
+        client: BigQuery client instance
+        label: What the query is for (table name, 'most_recent_date', ...)
+        query: The query
+        job_config: The query's job config
+        downgrade: Callable returning a cheaper variant of the query, used
+                   instead with COST_GUARD_ACTION=downgrade
+
+    Returns:
+        tuple: (query to run, its estimated bytes, whether it was downgraded)
+
+    Raises:
+        BudgetExceeded: If the query (and its downgrade) exceed a budget
+    """
+    if COST_GUARD_ACTION not in ACTIONS:
+        raise ValueError(f"Invalid COST_GUARD_ACTION: {COST_GUARD_ACTION}. Allowed actions: {ACTIONS}")
+    run_estimated = _summary()["estimated_bytes"]
+    estimated = dry_run(client, query, job_config)
+    reason = over_budget(estimated, run_estimated)
+    if reason is None:
+        return query, estimated, False
+
+    if downgrade is None or COST_GUARD_ACTION != "downgrade":
+        raise BudgetExceeded(f"{label}: {reason}")
+    fallback = downgrade()
+    fallback_estimated = dry_run(client, fallback, job_config)
+    fallback_reason = over_budget(fallback_estimated, run_estimated)
+    if fallback_reason is not None:
+        raise BudgetExceeded(f"{label}: {reason}; downgraded query: {fallback_reason}")
+    error(f"{label}: {reason}, downgraded to {format_bytes(fallback_estimated)}")
+    return fallback, fallback_estimated, True
+
+
+def downgraded():
+    """Return the labels of the current run's queries that were downgraded."""
+    return list(run_stats.current().extra.get("cost_guard", {}).get("downgraded", []))
+
+
+def record(label, job_type, estimated, job, downgraded=False):
+    """Record a query's estimate against the bytes it was billed for."""
+    billed = getattr(job, "total_bytes_billed", None) or 0
+    summary = _summary()
+    summary["estimated_bytes"] += estimated
+    summary["billed_bytes"] += billed
+    summary["estimated_cost"] = round(estimated_cost(summary["estimated_bytes"]), 6)
+    if downgraded:
+        summary["downgraded"].append(label)
+    summary["queries"].append({
+        "label": label,
+        "job_type": job_type,
+        "estimated_bytes": estimated,
+        "billed_bytes": billed,
+        "estimated_cost": round(estimated_cost(estimated), 6),
+        "downgraded": downgraded,
+    })
+    metrics.BIGQUERY_BYTES_ESTIMATED.inc(estimated, job_type=job_type)
+    metrics.BIGQUERY_BYTES_BILLED.inc(billed, job_type=job_type)
+
+
+def run_query(client, job_type, query, label=None, job_config=None, downgrade=None):
+    """
+    Run a generated query under the cost guard.
+
+    Drop-in for metrics.run_bigquery_job(job_type, client.query(query, job_config=job_config)).
+
+    Args:
+        client: BigQuery client instance
+        job_type: Job type recorded in the metrics
+        query: The query
+        label: What the query is for (default: job_type)
+        job_config: The query's job config
+        downgrade: Callable returning a cheaper variant (see check)
+
+    Returns:
+        tuple: (finished query job, its result)
+
+    Raises:
+        BudgetExceeded: If the query exceeds a budget (nothing is run)
+    """
+    if not COST_GUARD:
+        job = client.query(query, job_config=job_config)
+        return job, metrics.run_bigquery_job(job_type, job)
+
+    label = label or job_type
+    query, estimated, downgraded = check(client, label, query, job_config, downgrade)
+    job = client.query(query, job_config=job_config)
+    try:
+        return job, metrics.run_bigquery_job(job_type, job)
+    finally:
+        record(label, job_type, estimated, job, downgraded)
+
+
+def _run_listener(event, stats, **details):
+    """Log the estimated and billed bytes per query when a run finishes."""
+    summary = stats.extra.get("cost_guard")
+    if event != "finish" or not summary or not summary["queries"]:
+        return
+    log("BigQuery cost guard:")
+    for entry in summary["queries"]:
+        log(f"  {entry['label']}: estimated {format_bytes(entry['estimated_bytes'])} "
+            f"(${entry['estimated_cost']:.4f}), billed {format_bytes(entry['billed_bytes'])}"
+            f"{' (downgraded)' if entry['downgraded'] else ''}")
+    log(f"  Total: estimated {format_bytes(summary['estimated_bytes'])} "
+        f"(${summary['estimated_cost']:.4f}), billed {format_bytes(summary['billed_bytes'])}")
+
+
+run_stats.add_default_listener(_run_listener)
@@ -1,10 +1,35 @@
 import requests
+import http_client
+import tenants
 import json
-import os
 from dotenv import load_dotenv
 from logger import error, log
 load_dotenv()
 
+# Fields of a course object that make up its courses row
+COURSE_FIELDS = ("id", "name", "starts_at", "ends_at", "group_id")
+
+
+def course_row(course_id, course_data):
+    """
+    Build a courses row from a course object.
+
+    Args:
+        course_id: The course ID
+        course_data (dict): 'course' object of the detail or listing response
+
+    Returns:
+        dict: Course row
+    """
+    return {
+        "course_id": str(course_id),
+        "course_name": course_data.get("name"),
+        "starts_at": course_data.get("starts_at"),
+        "ends_at": course_data.get("ends_at"),
+        "group_id": str(course_data.get("group_id")) if course_data.get("group_id") is not None else None,
+    }
+
+
 def course(course_id):
     """
     Fetch course details from MyClub API.
@@ -16,35 +41,28 @@ def course(course_id):
         dict: Course details
 
     Raises:
-        ValueError: If MC_TOKEN is not set or API returns invalid data
+        ValueError: If MC_TOKEN is not set
+        http_client.NoDataReturned: If the API returns no course data
         requests.exceptions.RequestException: If API request fails
     """
-    myclub_token = os.getenv("MC_TOKEN")
+    myclub_token = tenants.token()
     if not myclub_token:
         raise ValueError("MC_TOKEN environment variable is required but not set")
 
     headers = {"X-myClub-token": myclub_token}
-    base_url = "https://ehms.myclub.fi/api/"
+    base_url = tenants.base_url()
     full_url = f"{base_url}courses/{course_id}"
 
     try:
-        response = requests.get(full_url, headers=headers, timeout=30)
+        response = http_client.get(full_url, headers=headers, timeout=30)
         response.raise_for_status()
         content = response.json()
 
         course_data = content.get("course")
         if not course_data:
-            raise ValueError(f"No course data returned for course_id {course_id}")
-
-        course_dict = {
-            "course_id": str(course_id),
-            "course_name": course_data.get("name"),
-            "starts_at": course_data.get("starts_at"),
-            "ends_at": course_data.get("ends_at"),
-            "group_id": str(course_data.get("group_id")) if course_data.get("group_id") is not None else None,
-        }
+            raise http_client.NoDataReturned(f"No course data returned for course_id {course_id}")
 
-        return course_dict
+        return course_row(course_id, course_data)
 
     except requests.exceptions.HTTPError as e:
         error(f"HTTP error fetching course {course_id}: {e}")
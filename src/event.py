@@ -1,12 +1,44 @@
 import requests
+import http_client
+import tenants
 import json
-import os
 
 from dotenv import load_dotenv
 from logger import error, log
 
 load_dotenv()
 
+# Fields of an event object that make up its events row
+EVENT_FIELDS = ("id", "name", "starts_at", "ends_at", "event_category_id", "group_id", "venue_id", "course_id")
+
+
+def _str_or_none(value):
+    return str(value) if value is not None else None
+
+
+def event_row(event_id, event_data):
+    """
+    Build an events row from an event object.
+
+    Args:
+        event_id: The event ID
+        event_data (dict): 'event' object of the detail or listing response
+
+    Returns:
+        dict: Event row
+    """
+    return {
+        "event_id": str(event_id),
+        "event_name": event_data.get("name"),
+        "starts_at": event_data.get("starts_at"),
+        "ends_at": event_data.get("ends_at"),
+        "event_category_id": _str_or_none(event_data.get("event_category_id")),
+        "group_id": _str_or_none(event_data.get("group_id")),
+        "venue_id": _str_or_none(event_data.get("venue_id")),
+        "course_id": _str_or_none(event_data.get("course_id")),
+    }
+
+
 def event(event_id):
     """
     Fetch event details and participations from MyClub API.
@@ -18,36 +50,28 @@ def event(event_id):
         tuple: (event_dict, participants_list)
 
     Raises:
-        ValueError: If MC_TOKEN is not set or API returns invalid data
+        ValueError: If MC_TOKEN is not set
+        http_client.NoDataReturned: If the API returns no event data
         requests.exceptions.RequestException: If API request fails
     """
-    myclub_token = os.getenv("MC_TOKEN")
+    myclub_token = tenants.token()
     if not myclub_token:
         raise ValueError("MC_TOKEN environment variable is required but not set")
 
     headers = {"X-myClub-token": myclub_token}
-    base_url = "https://ehms.myclub.fi/api/"
+    base_url = tenants.base_url()
     full_url = f"{base_url}events/{event_id}"
 
     try:
-        response = requests.get(full_url, headers=headers, timeout=30)
+        response = http_client.get(full_url, headers=headers, timeout=30)
         response.raise_for_status()
         content = response.json()
 
         event_data = content.get("event")
         if not event_data:
-            raise ValueError(f"No event data returned for event_id {event_id}")
-
-        event_dict = {
-            "event_id": str(event_id),
-            "event_name": event_data.get("name"),
-            "starts_at": event_data.get("starts_at"),
-            "ends_at": event_data.get("ends_at"),
-            "event_category_id": str(event_data.get("event_category_id")) if event_data.get("event_category_id") is not None else None,
-            "group_id": str(event_data.get("group_id")) if event_data.get("group_id") is not None else None,
-            "venue_id": str(event_data.get("venue_id")) if event_data.get("venue_id") is not None else None,
-            "course_id": str(event_data.get("course_id")) if event_data.get("course_id") is not None else None,
-        }
+            raise http_client.NoDataReturned(f"No event data returned for event_id {event_id}")
+
+        event_dict = event_row(event_id, event_data)
 
         participants_list = []
         participations = content.get("participations", [])
@@ -1,8 +1,10 @@
 import requests
+import http_client
+import tenants
+import listing_decoder
 import json
 import datetime
 import event
-import os
 
 from dotenv import load_dotenv
 from logger import error, log
@@ -28,28 +30,55 @@ def events_in_group(
         ValueError: If MC_TOKEN is not set
         requests.exceptions.RequestException: If API request fails
     """
-    myclub_token = os.getenv("MC_TOKEN")
+    # Decode the listing incrementally, keeping only the event IDs
+    return _list_events(group_id, start, end, lambda response: listing_decoder.listing_ids(response, "event"))
+
+
+def event_listing(
+    group_id,
+    start=datetime.datetime.now() - datetime.timedelta(days=7),
+    end=datetime.datetime.now(),
+):
+    """
+    Fetch the event objects of a specific group within a date range.
+
+    Only the fields of event.EVENT_FIELDS are kept; fields missing from the
+    listing are left out of the objects (see event.event_row).
+
+    Args:
+        group_id: The group ID to fetch events for
+        start: Start date (default: 7 days ago)
+        end: End date (default: now)
+
+    Returns:
+        list: Event dicts with the listed fields
+
+    Raises:
+        ValueError: If MC_TOKEN is not set
+        requests.exceptions.RequestException: If API request fails
+    """
+    return _list_events(
+        group_id, start, end,
+        lambda response: listing_decoder.listing_objects(response, "event", event.EVENT_FIELDS),
+    )
+
+
+def _list_events(group_id, start, end, decode):
+    myclub_token = tenants.token()
     if not myclub_token:
         raise ValueError("MC_TOKEN environment variable is required but not set")
 
     headers = {"X-myClub-token": myclub_token}
-    base_url = "https://ehms.myclub.fi/api/"
+    base_url = tenants.base_url()
     full_url = f"{base_url}events/"
 
     params = {"group_id": group_id, "start_date": start, "end_date": end}
 
+    response = None
     try:
-        response = requests.get(full_url, headers=headers, params=params, timeout=30)
+        response = http_client.get(full_url, headers=headers, params=params, timeout=30, stream=True)
         response.raise_for_status()
-        content = response.json()
-
-        events_list = []
-        for c in content:
-            event_data = c.get("event")
-            if event_data:
-                events_list.append(str(event_data.get("id")))
-
-        return events_list
+        return decode(response)
 
     except requests.exceptions.HTTPError as e:
         error(f"HTTP error fetching events for group {group_id}: {e}")
@@ -63,6 +92,10 @@ def events_in_group(
     except json.JSONDecodeError as e:
         error(f"Invalid JSON response for events in group {group_id}: {e}")
         raise
+    finally:
+        # Release the streamed connection even if decoding stopped early
+        if response is not None:
+            response.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,181 @@
+"""
+In-memory stand-in for google.cloud.bigquery.Client.
+
+Implements the subset of the client API used by bigquery_upload, records
+every call with its duration and simulates configurable API latency, so the
+upload path can be exercised and benchmarked offline. Streaming inserts
+serialise their payload like the real client does, which keeps the
+Python-side serialisation cost in the measurements.
+"""
+import json
+import time
+
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+
+class FakeRow:
+    """Query result row with attribute access."""
+
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+class FakeJob:
+    """Completed job returned by query, load and copy calls."""
+
+    def __init__(self, client, job_type, rows=None, total_bytes_processed=0):
+        self.client = client
+        self.job_type = job_type
+        self.rows = rows or []
+        self.errors = None
+        self.total_bytes_processed = total_bytes_processed
+        self.total_bytes_billed = total_bytes_processed
+        self.job_id = f"fake_{job_type}_{len(client.calls)}"
+
+    def result(self, *args, **kwargs):
+        self.client._sleep(self.client.job_latency)
+        return iter(self.rows)
+
+
+class FakeClient:
+    """
+    Fake BigQuery client.
+
+    Args:
+        project: Project ID reported by the client
+        call_latency: Seconds slept per API round trip (table/dataset calls,
+                      streaming inserts)
+        job_latency: Additional seconds slept when waiting for a job result
+        error_rate: Fraction of streamed rows reported as invalid
+    """
+
+    def __init__(self, project="fake-project", call_latency=0.0, job_latency=0.0, error_rate=0.0):
+        self.project = project
+        self.call_latency = call_latency
+        self.job_latency = job_latency
+        self.error_rate = error_rate
+        self.datasets = set()
+        self.tables = {}
+        self.calls = []
+        self.queries = []
+        self.serialization_seconds = 0.0
+        self.latency_seconds = 0.0
+
+    def _sleep(self, seconds):
+        if seconds:
+            time.sleep(seconds)
+            self.latency_seconds += seconds
+
+    def _record(self, method, **details):
+        self.calls.append((method, details))
+        self._sleep(self.call_latency)
+
+    @staticmethod
+    def _table_id(table):
+        if isinstance(table, str):
+            return table
+        if isinstance(table, bigquery.Table):
+            table = table.reference
+        return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+    def call_counts(self):
+        """Return the number of calls per method."""
+        counts = {}
+        for method, _ in self.calls:
+            counts[method] = counts.get(method, 0) + 1
+        return counts
+
+    def reset(self):
+        """Forget recorded calls and timings (tables are kept)."""
+        self.calls = []
+        self.queries = []
+        self.serialization_seconds = 0.0
+        self.latency_seconds = 0.0
+
+    # Dataset and table management
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def get_dataset(self, dataset_ref):
+        self._record("get_dataset")
+        if dataset_ref.dataset_id not in self.datasets:
+            raise NotFound(f"Dataset {dataset_ref.dataset_id} not found")
+        return bigquery.Dataset(dataset_ref)
+
+    def create_dataset(self, dataset, timeout=None, exists_ok=False):
+        self._record("create_dataset")
+        self.datasets.add(dataset.dataset_id)
+        return dataset
+
+    def get_table(self, table):
+        self._record("get_table")
+        table_id = self._table_id(table)
+        if table_id not in self.tables:
+            raise NotFound(f"Table {table_id} not found")
+        return self.tables[table_id]["table"]
+
+    def create_table(self, table, exists_ok=False):
+        self._record("create_table")
+        table_id = self._table_id(table)
+        self.tables[table_id] = {"table": table, "rows": 0}
+        return table
+
+    def delete_table(self, table, not_found_ok=False):
+        self._record("delete_table")
+        table_id = self._table_id(table)
+        if table_id not in self.tables and not not_found_ok:
+            raise NotFound(f"Table {table_id} not found")
+        self.tables.pop(table_id, None)
+
+    # Data
+
+    def insert_rows_json(self, table, json_rows, skip_invalid_rows=False, **kwargs):
+        start = time.perf_counter()
+        payload = json.dumps({"rows": [{"json": row} for row in json_rows]})
+        self.serialization_seconds += time.perf_counter() - start
+        self._record("insert_rows_json", rows=len(json_rows), bytes=len(payload))
+
+        table_id = self._table_id(table)
+        if table_id in self.tables:
+            self.tables[table_id]["rows"] += len(json_rows)
+
+        errors = []
+        if self.error_rate:
+            step = max(int(1 / self.error_rate), 1)
+            for index in range(0, len(json_rows), step):
+                errors.append({
+                    "index": index,
+                    "errors": [{"reason": "invalid", "location": "confirmed",
+                                "message": "Cannot convert value to boolean."}],
+                })
+        return errors
+
+    def query(self, query, job_config=None, **kwargs):
+        dry_run = bool(job_config and getattr(job_config, "dry_run", False))
+        if dry_run:
+            # Dry runs estimate what the query itself reports
+            self._record("dry_run")
+            job = FakeJob(self, "query", total_bytes_processed=len(query))
+            job.total_bytes_billed = 0
+            return job
+        self._record("query")
+        self.queries.append(query)
+        return FakeJob(self, "query", total_bytes_processed=len(query))
+
+    def load_table_from_json(self, json_rows, destination, job_config=None, **kwargs):
+        start = time.perf_counter()
+        payload = "\n".join(json.dumps(row) for row in json_rows)
+        self.serialization_seconds += time.perf_counter() - start
+        self._record("load_table_from_json", bytes=len(payload))
+        return FakeJob(self, "load")
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, **kwargs):
+        size = len(file_obj.read())
+        self._record("load_table_from_file", bytes=size)
+        return FakeJob(self, "load")
+
+    def copy_table(self, sources, destination, job_config=None, **kwargs):
+        self._record("copy_table")
+        return FakeJob(self, "copy")
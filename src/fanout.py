@@ -0,0 +1,443 @@
+"""
+Coordinator/worker fan-out of the extraction across several processes or
+function instances.
+
+The coordinator lists all groups, partitions them into shards balanced by
+their historical event counts in BigQuery and dispatches every shard to a
+worker. Workers extract the rows for their groups and stage them as one
+NDJSON file per table: in a local directory (subprocess dispatcher) or in
+the FANOUT_STAGING_BUCKET Cloud Storage bucket (http dispatcher,
+FANOUT_WORKER_URL pointing at the `run_extract_worker` entry point, which
+only returns the staged paths). Once all shards have finished, the
+coordinator combines the staged rows, uploads them in one pass and deletes
+the staged files. The staged files are read as file-backed RowBuffers and
+combined by key position (see initialise.combine_rows), so the coordinator
+never holds the shards' rows in memory.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import uuid
+
+import requests
+from dotenv import load_dotenv
+from google.cloud.exceptions import NotFound
+
+import bigquery_upload
+import categories
+import cost_guard
+import get_all_presences
+import groups
+import initialise
+import member_freshness
+import resources
+import row_buffer
+import run_stats
+import tenants
+import tracing
+from logger import log, error
+
+load_dotenv()
+
+FANOUT_SHARDS = int(os.getenv("FANOUT_SHARDS", "4"))
+FANOUT_DISPATCHER = os.getenv("FANOUT_DISPATCHER", "subprocess")
+FANOUT_WORKER_URL = os.getenv("FANOUT_WORKER_URL")
+# Bucket (and prefix) the http workers stage their rows in
+FANOUT_STAGING_BUCKET = os.getenv("FANOUT_STAGING_BUCKET")
+FANOUT_STAGING_PREFIX = os.getenv("FANOUT_STAGING_PREFIX", "fanout")
+
+# Seconds a single shard may take before the coordinator gives up on it
+FANOUT_WORKER_TIMEOUT = int(os.getenv("FANOUT_WORKER_TIMEOUT", "3600"))
+
+
+def get_group_event_counts(client):
+    """
+    Get the historical number of events per group from BigQuery.
+
+    Args:
+        client: BigQuery client instance
+
+    Returns:
+        dict: group_id -> event count (empty if the events table does not exist)
+    """
+    query = f"""
+        SELECT group_id, COUNT(*) AS event_count
+        FROM `{bigquery_upload.GCP_PROJECT_ID}.{bigquery_upload.dataset_id()}.events`
+        GROUP BY group_id
+    """
+    try:
+        _, rows = cost_guard.run_query(client, "query", query, label="group_weights")
+        return {row.group_id: row.event_count for row in rows}
+    except NotFound:
+        log("No events table yet, shards will be balanced by group count")
+        return {}
+
+
+def partition_groups(group_ids, weights, shard_count):
+    """
+    Partition groups into shards with roughly equal total weight.
+
+    Uses the longest-processing-time heuristic: groups are assigned heaviest
+    first to the currently lightest shard. Groups without history get the
+    average weight of the known groups.
+
+    Args:
+        group_ids (list): Group IDs to partition
+        weights (dict): group_id -> historical event count
+        shard_count (int): Maximum number of shards
+
+    Returns:
+        list: Non-empty lists of group IDs
+    """
+    known = [weights[g] for g in group_ids if weights.get(g)]
+    default_weight = sum(known) / len(known) if known else 1
+
+    shard_count = max(1, min(shard_count, len(group_ids)))
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+
+    ordered = sorted(group_ids, key=lambda g: weights.get(g) or default_weight, reverse=True)
+    for group_id in ordered:
+        lightest = loads.index(min(loads))
+        shards[lightest].append(group_id)
+        loads[lightest] += weights.get(group_id) or default_weight
+
+    return [shard for shard in shards if shard]
+
+
+def extract_shard(group_ids, start, end):
+    """
+    Worker: extract all rows for a shard of groups.
+
+    Args:
+        group_ids (list): Group IDs of the shard
+        start (datetime.date): Window start
+        end (datetime.date): Window end
+
+    Returns:
+        dict: table name -> list of rows
+    """
+    results = get_all_presences.get_all_presences_in_date_range(start, end, group_ids=group_ids)
+    return dict(zip(get_all_presences.RESULT_TABLES, results))
+
+
+def write_shard(data, output_dir):
+    """Stage a shard's rows as one NDJSON file per table in output_dir."""
+    os.makedirs(output_dir, exist_ok=True)
+    for table_name, rows in data.items():
+        with open(os.path.join(output_dir, f"{table_name}.ndjson"), "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+
+def read_shard(output_dir):
+    """
+    Open the rows staged by write_shard without loading them.
+
+    Returns:
+        dict: table name -> row_buffer.RowBuffer backed by the staged file,
+              which close() deletes
+    """
+    data = {}
+    for table_name in get_all_presences.RESULT_TABLES:
+        path = os.path.join(output_dir, f"{table_name}.ndjson")
+        if os.path.exists(path):
+            data[table_name] = row_buffer.RowBuffer.from_segments(table_name, [path])
+    return data
+
+
+def _storage_client():
+    from google.cloud import storage
+    return storage.Client(
+        project=bigquery_upload.GCP_PROJECT_ID, credentials=resources.get("bigquery_credentials")
+    )
+
+
+resources.register("storage_client", _storage_client)
+
+
+def _split_gcs_uri(uri):
+    """Split gs://bucket/path into (bucket, path)."""
+    if not uri.startswith("gs://"):
+        raise ValueError(f"Not a Cloud Storage URI: {uri}")
+    bucket, _, path = uri[len("gs://"):].partition("/")
+    return bucket, path.rstrip("/")
+
+
+def upload_shard(data, output_uri):
+    """
+    Stage a shard's rows in Cloud Storage, one NDJSON object per table.
+
+    The files are written locally with write_shard first, so the rows are
+    never held in memory as a whole.
+
+    Args:
+        data (dict): table name -> rows
+        output_uri: gs://bucket/prefix the objects are written under
+
+    Returns:
+        dict: table name -> gs:// URI of its object
+    """
+    bucket_name, prefix = _split_gcs_uri(output_uri)
+    bucket = resources.get("storage_client").bucket(bucket_name)
+    local_dir = tempfile.mkdtemp(prefix="ehms_shard_")
+    try:
+        write_shard(data, local_dir)
+        paths = {}
+        for table_name in data:
+            blob_name = f"{prefix}/{table_name}.ndjson"
+            bucket.blob(blob_name).upload_from_filename(
+                os.path.join(local_dir, f"{table_name}.ndjson"), content_type="application/x-ndjson"
+            )
+            paths[table_name] = f"gs://{bucket_name}/{blob_name}"
+        return paths
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+
+def download_shard(paths, output_dir):
+    """Download the objects staged by upload_shard into output_dir (see read_shard)."""
+    os.makedirs(output_dir, exist_ok=True)
+    client = resources.get("storage_client")
+    for table_name, uri in paths.items():
+        bucket_name, blob_name = _split_gcs_uri(uri)
+        client.bucket(bucket_name).blob(blob_name).download_to_filename(
+            os.path.join(output_dir, f"{table_name}.ndjson")
+        )
+
+
+def delete_staged(paths):
+    """Delete objects staged by upload_shard, ignoring missing ones."""
+    client = resources.get("storage_client")
+    for uri in paths:
+        bucket_name, blob_name = _split_gcs_uri(uri)
+        try:
+            client.bucket(bucket_name).blob(blob_name).delete()
+        except NotFound:
+            pass
+        except Exception as e:
+            log(f"Warning: Could not delete staged object {uri}: {e}")
+
+
+def dispatch_subprocess(shards, start, end, staging_dir):
+    """
+    Run every shard in a separate local worker process.
+
+    Stands in for separate function instances when testing locally.
+
+    Args:
+        shards (list): Group ID lists
+        start (datetime.date): Window start
+        end (datetime.date): Window end
+        staging_dir: Local directory the shards are staged in; the returned
+                     buffers read from it, so the caller removes it
+
+    Returns:
+        list: One table dict per shard (see read_shard)
+
+    Raises:
+        RuntimeError: If any worker process fails
+    """
+    processes = []
+    for idx, shard in enumerate(shards):
+        output_dir = os.path.join(staging_dir, f"shard_{idx}")
+        cmd = [
+            sys.executable, os.path.abspath(__file__), "worker",
+            "--group-ids", ",".join(shard),
+            "--start", start.isoformat(),
+            "--end", end.isoformat(),
+            "--output", output_dir,
+        ]
+        env = dict(os.environ)
+        if not tenants.current().is_default:
+            env["TENANT"] = tenants.name()
+        if tracing.current_traceparent():
+            env["TRACEPARENT"] = tracing.current_traceparent()
+        processes.append((idx, output_dir, subprocess.Popen(cmd, env=env)))
+
+    results = []
+    failed = []
+    for idx, output_dir, process in processes:
+        try:
+            returncode = process.wait(timeout=FANOUT_WORKER_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            returncode = None
+        if returncode != 0:
+            failed.append(idx)
+            continue
+        results.append(read_shard(output_dir))
+
+    if failed:
+        raise RuntimeError(f"Fan-out workers failed for shard(s) {failed}")
+    return results
+
+
+def _post_shard(shard, start, end, output_uri, traceparent=None, tenant=None):
+    payload = {
+        "group_ids": shard,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "output": output_uri,
+    }
+    if tenant:
+        payload["tenant"] = tenant
+    response = requests.post(
+        FANOUT_WORKER_URL,
+        json=payload,
+        headers={"traceparent": traceparent} if traceparent else None,
+        timeout=FANOUT_WORKER_TIMEOUT,
+    )
+    response.raise_for_status()
+    return response.json().get("paths", {})
+
+
+def dispatch_http(shards, start, end, staging_dir):
+    """
+    Run every shard on a separate function instance via the worker entry point.
+
+    Workers stage their rows under gs://FANOUT_STAGING_BUCKET/<prefix>/<run>/
+    shard_<n>/ and return the paths; the objects are downloaded into
+    staging_dir and deleted from the bucket.
+
+    Args:
+        shards (list): Group ID lists
+        start (datetime.date): Window start
+        end (datetime.date): Window end
+        staging_dir: Local directory the shards are downloaded to; the
+                     returned buffers read from it, so the caller removes it
+
+    Returns:
+        list: One table dict per shard (see read_shard)
+    """
+    if not FANOUT_WORKER_URL:
+        raise ValueError("FANOUT_WORKER_URL environment variable is required for the http dispatcher")
+    if not FANOUT_STAGING_BUCKET:
+        raise ValueError("FANOUT_STAGING_BUCKET environment variable is required for the http dispatcher")
+
+    run_uri = f"gs://{FANOUT_STAGING_BUCKET}/{FANOUT_STAGING_PREFIX.strip('/')}/{uuid.uuid4().hex}"
+    # Worker threads don't inherit the context, so pass the trace context explicitly
+    traceparent = tracing.current_traceparent()
+    tenant = None if tenants.current().is_default else tenants.name()
+    staged = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            futures = [
+                executor.submit(_post_shard, shard, start, end, f"{run_uri}/shard_{idx}", traceparent, tenant)
+                for idx, shard in enumerate(shards)
+            ]
+            shard_paths = [future.result() for future in futures]
+        results = []
+        for idx, paths in enumerate(shard_paths):
+            staged.extend(paths.values())
+            output_dir = os.path.join(staging_dir, f"shard_{idx}")
+            download_shard(paths, output_dir)
+            results.append(read_shard(output_dir))
+        return results
+    finally:
+        if staged:
+            delete_staged(staged)
+
+
+def run_coordinator(interval=60, shard_count=None, stats=None):
+    """
+    Run the pipeline with extraction fanned out across workers.
+
+    Args:
+        interval (int): Number of days to fetch from the start date (default: 60)
+        shard_count (int): Number of shards (default: FANOUT_SHARDS)
+        stats (run_stats.RunStats): Stats collector for this run (default: new one)
+
+    Returns:
+        dict: Performance summary of the run
+    """
+    stats = run_stats.activate(stats)
+    shard_count = shard_count or FANOUT_SHARDS
+
+    client = bigquery_upload.initialize_bigquery_client()
+    start, end = initialise.compute_window(interval, client=client)
+    stats.extra["window"] = {"start": start.isoformat(), "end": end.isoformat()}
+
+    with stats.stage("metadata"):
+        _categories = categories.categories()
+        _groups = groups.get_group_ids()
+
+    with stats.stage("partition"):
+        weights = get_group_event_counts(client)
+        shards = partition_groups([g.get("group_id") for g in _groups], weights, shard_count)
+    log(f"Dispatching {len(shards)} shards ({FANOUT_DISPATCHER} dispatcher)")
+    stats.extra["shards"] = [len(shard) for shard in shards]
+
+    if FANOUT_DISPATCHER not in ("http", "subprocess"):
+        raise ValueError(f"Unknown FANOUT_DISPATCHER: {FANOUT_DISPATCHER}")
+
+    data_to_upload = {"categories": _categories, "groups": _groups}
+    staging_dir = tempfile.mkdtemp(prefix="ehms_fanout_")
+    try:
+        with stats.stage("extract"):
+            if FANOUT_DISPATCHER == "http":
+                shard_results = dispatch_http(shards, start, end, staging_dir)
+            else:
+                shard_results = dispatch_subprocess(shards, start, end, staging_dir)
+
+        # Members attending events in several shards are fetched more than once
+        for table_name in get_all_presences.RESULT_TABLES:
+            data_to_upload[table_name] = initialise.combine_rows(
+                table_name, *[result.get(table_name, []) for result in shard_results]
+            )
+        for result in shard_results:
+            row_buffer.close_all(result)
+
+        stats.set_rows(data_to_upload)
+        log("Uploading to BigQuery")
+        with stats.stage("upload"):
+            downgraded = bigquery_upload.upload_all_tables(data_to_upload)
+            member_freshness.mark_fetched(data_to_upload["members"], downgraded=downgraded)
+    finally:
+        row_buffer.close_all(data_to_upload)
+        # The staged rows include member details; don't leave them in /tmp
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    stats.finish()
+    return stats.summary()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Fan the MyClub extraction out across worker processes"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    coordinator_parser = subparsers.add_parser("coordinator", help="Partition, dispatch and upload")
+    coordinator_parser.add_argument("interval", type=int, nargs="?", default=60)
+    coordinator_parser.add_argument("--shards", type=int, default=FANOUT_SHARDS)
+
+    worker_parser = subparsers.add_parser("worker", help="Extract and stage one shard")
+    worker_parser.add_argument("--group-ids", required=True)
+    worker_parser.add_argument("--start", required=True)
+    worker_parser.add_argument("--end", required=True)
+    worker_parser.add_argument("--output", required=True)
+
+    args = parser.parse_args()
+
+    if args.command == "coordinator":
+        run_coordinator(interval=args.interval, shard_count=args.shards)
+    else:
+        try:
+            with tenants.activate(os.getenv("TENANT") or tenants.DEFAULT_TENANT), \
+                    tracing.span("extract_worker", traceparent=os.getenv("TRACEPARENT")):
+                shard_data = extract_shard(
+                    initialise.parse_id_list(args.group_ids),
+                    datetime.date.fromisoformat(args.start),
+                    datetime.date.fromisoformat(args.end),
+                )
+            write_shard(shard_data, args.output)
+        except Exception as e:
+            error(f"Fan-out worker failed: {e}")
+            sys.exit(1)
@@ -6,8 +6,24 @@ import course
 import member
 import venues
 import datetime
+import os
+import member_freshness
+import quarantine
+import row_buffer
+import run_stats
+import tracing
+from dotenv import load_dotenv
 from logger import log
 
+load_dotenv()
+
+# Build events and courses rows from the group listings instead of fetching
+# details (see hydrate_rows)
+LISTING_HYDRATION = os.getenv("LISTING_HYDRATION", "false").lower() in ("true", "1", "yes")
+
+# Table names in the order of the tuples returned by the fetch functions below
+RESULT_TABLES = ("presences", "events", "courses", "members", "memberships")
+
 
 def progress_bar(current, total, width=30):
     """Generate a progress bar string."""
@@ -17,7 +33,171 @@ def progress_bar(current, total, width=30):
     return f"[{bar}] {current}/{total}"
 
 
-def get_all_presences_in_date_range(start, end):
+def fetch_events(event_ids):
+    """
+    Fetch event details and presences for a list of event IDs.
+
+    Events that fail to fetch are quarantined and skipped (see quarantine).
+
+    Args:
+        event_ids (list): Event ID strings to fetch
+
+    Returns:
+        tuple: (event_dict_list, presences_list) as row_buffer.RowBuffer
+
+    Raises:
+        quarantine.FailureRateExceeded: If too many events fail
+    """
+    event_dict_list = row_buffer.RowBuffer("events")
+    presences_list = row_buffer.RowBuffer("presences")
+    fetched = []
+    failed = 0
+
+    for idx, ev in enumerate(event_ids, 1):
+        bar = progress_bar(idx, len(event_ids))
+        log(f"Processing {len(event_ids)} events... {bar}", end='\r')
+        with tracing.span("myclub.event", event_id=ev) as span:
+            try:
+                event_dict, presences = event.event(ev)
+            except quarantine.QUARANTINABLE_ERRORS as e:
+                span.set_attribute("error", str(e))
+                failed += 1
+                quarantine.record_failure("event", ev, e)
+                quarantine.check_failure_rate("event", failed, len(event_ids))
+                continue
+            span.set_attribute("presences", len(presences))
+        event_dict_list.append(event_dict)
+        presences_list.extend(presences)
+        fetched.append(ev)
+        run_stats.progress("events", idx, len(event_ids))
+    bar = progress_bar(len(event_ids), len(event_ids))
+    log(f"Processing {len(event_ids)} events... {bar} completed" + " " * 10)
+    quarantine.release("event", fetched)
+
+    return event_dict_list, presences_list
+
+
+def fetch_courses(course_ids):
+    """
+    Fetch course details for a list of course IDs.
+
+    Courses that fail to fetch are quarantined and skipped (see quarantine).
+
+    Args:
+        course_ids (list): Course ID strings to fetch
+
+    Returns:
+        row_buffer.RowBuffer: Course dictionaries
+
+    Raises:
+        quarantine.FailureRateExceeded: If too many courses fail
+    """
+    course_dict_list = row_buffer.RowBuffer("courses")
+    fetched = []
+    failed = 0
+
+    for idx, cs in enumerate(course_ids, 1):
+        bar = progress_bar(idx, len(course_ids))
+        log(f"Processing {len(course_ids)} courses... {bar}", end='\r')
+        with tracing.span("myclub.course", course_id=cs) as span:
+            try:
+                course_dict = course.course(cs)
+            except quarantine.QUARANTINABLE_ERRORS as e:
+                span.set_attribute("error", str(e))
+                failed += 1
+                quarantine.record_failure("course", cs, e)
+                quarantine.check_failure_rate("course", failed, len(course_ids))
+                continue
+        course_dict_list.append(course_dict)
+        fetched.append(cs)
+        run_stats.progress("courses", idx, len(course_ids))
+    if course_ids:
+        bar = progress_bar(len(course_ids), len(course_ids))
+        log(f"Processing {len(course_ids)} courses... {bar} completed" + " " * 10)
+    quarantine.release("course", fetched)
+
+    return course_dict_list
+
+
+def fetch_members(member_ids):
+    """
+    Fetch member details and memberships for a list of member IDs.
+
+    Members that no longer exist in MyClub (404) are skipped. Members that
+    fail to fetch are quarantined and skipped (see quarantine).
+
+    Args:
+        member_ids (list): Member ID strings to fetch
+
+    Returns:
+        tuple: (members_dict_list, membership_dict_list) as row_buffer.RowBuffer
+
+    Raises:
+        quarantine.FailureRateExceeded: If too many members fail
+    """
+    members_dict_list = row_buffer.RowBuffer("members")
+    membership_dict_list = row_buffer.RowBuffer("memberships")
+    fetched = []
+    failed = 0
+
+    for idx, m in enumerate(member_ids, 1):
+        bar = progress_bar(idx, len(member_ids))
+        log(f"Processing {len(member_ids)} members... {bar}", end='\r')
+        with tracing.span("myclub.member", member_id=m) as span:
+            try:
+                member_dict, membership_dict = member.member(m)
+            except quarantine.QUARANTINABLE_ERRORS as e:
+                span.set_attribute("error", str(e))
+                failed += 1
+                quarantine.record_failure("member", m, e)
+                quarantine.check_failure_rate("member", failed, len(member_ids))
+                continue
+            span.set_attribute("memberships", len(membership_dict or []))
+        if member_dict and membership_dict:
+            members_dict_list.append(member_dict)
+            membership_dict_list.extend(membership_dict)
+        fetched.append(m)
+        run_stats.progress("members", idx, len(member_ids))
+    bar = progress_bar(len(member_ids), len(member_ids))
+    log(f"Processing {len(member_ids)} members... {bar} completed" + " " * 10)
+    quarantine.release("member", fetched)
+
+    return members_dict_list, membership_dict_list
+
+
+def hydrate_rows(listed, fields, build_row):
+    """
+    Build rows from listed objects that carry every field of a row.
+
+    Args:
+        listed (list): Objects of a listing (see events_in_group.event_listing)
+        fields (tuple): Fields a complete object has (e.g. event.EVENT_FIELDS)
+        build_row: Row builder (e.g. event.event_row)
+
+    Returns:
+        tuple: (IDs of all listed objects, {ID: row} of the complete ones)
+    """
+    ids = []
+    rows = {}
+    for obj in listed:
+        obj_id = str(obj["id"])
+        ids.append(obj_id)
+        if all(field in obj for field in fields):
+            rows[obj_id] = build_row(obj_id, obj)
+    return ids, rows
+
+
+def unique_member_ids(presences_list):
+    """Return the unique member IDs referenced by a list of presences."""
+    members_set = set()
+    for p in presences_list:
+        members_set.add(p.get("member_id"))
+    return list(members_set)
+
+
+def get_all_presences_in_date_range(start, end, group_ids=None, all_members=False,
+                                    exclude_member_ids=None, event_tracker=None,
+                                    group_scheduler=None):
     """
     Fetch all presences, events, courses, members, and memberships for a date range.
 
@@ -25,74 +205,136 @@ def get_all_presences_in_date_range(start, end):
     1. Fetches all groups and venues
     2. Gets events and courses for each group in the date range
     3. Collects event details and participant presences
-    4. Fetches unique member details and their memberships
+    4. Fetches details and memberships of the unique members that are new or
+       due for a refresh (see member_freshness)
+
+    With LISTING_HYDRATION, courses rows are built from the course listings
+    and only courses missing fields in the listing are fetched in detail.
+    Events are still fetched in detail for their participations, but listed
+    events that are not fetched (closed events skipped by the event_tracker)
+    get their rows from the listing.
 
     Args:
         start (datetime.date): Start date for event range
         end (datetime.date): End date for event range
+        group_ids (list): Optional group IDs to restrict the listing to
+                          (default: all groups)
+        all_members (bool): Fetch every member seen in the presences,
+                            bypassing the freshness check (default: False)
+        exclude_member_ids (set): Member IDs already fetched earlier in the
+                                  same run, which are not fetched again
+        event_tracker (open_events.OpenEventsTracker): Chooses which of the
+                                  listed events to fetch (ignored when
+                                  group_ids restricts the listing)
+        group_scheduler (group_activity.GroupScheduler): Chooses which groups
+                                  to list and from which date (ignored when
+                                  group_ids is given)
 
     Returns:
         tuple: (presences_list, event_dict_list, course_dict_list,
-                members_dict_list, membership_dict_list)
+                members_dict_list, membership_dict_list), each a
+                row_buffer.RowBuffer that spills to disk past its memory budget
     """
-    log(f"From: {start} to {end}")
-    groups_list = groups.get_group_ids()
-    venues.venues()
-    group_ids_list = [g.get("group_id") for g in groups_list]
-
-    events_list = []
-    courses_list = []
-    members_list = []
-    presences_list = []
-    event_dict_list = []
-    course_dict_list = []
-    members_dict_list = []
-    membership_dict_list = []
-
-    for idx, group in enumerate(group_ids_list, 1):
-        bar = progress_bar(idx, len(group_ids_list))
-        log(f"Fetching events and courses for {len(group_ids_list)} groups... {bar}", end='\r')
-        events = events_in_group.events_in_group(group, start=start, end=end)
-        events_list.extend(events)
-
-        courses = courses_in_group.courses_in_group(group, start=start, end=end)
-        courses_list.extend(courses)
-    bar = progress_bar(len(group_ids_list), len(group_ids_list))
-    log(f"Fetching events and courses for {len(group_ids_list)} groups... {bar} completed" + " " * 10)
-
-    for idx, ev in enumerate(events_list, 1):
-        bar = progress_bar(idx, len(events_list))
-        log(f"Processing {len(events_list)} events... {bar}", end='\r')
-        event_dict, presences = event.event(ev)
-        event_dict_list.append(event_dict)
-        presences_list.extend(presences)
-    bar = progress_bar(len(events_list), len(events_list))
-    log(f"Processing {len(events_list)} events... {bar} completed" + " " * 10)
+    with tracing.span("extract", start=str(start), end=str(end)) as extract_span:
+        log(f"From: {start} to {end}")
+        if group_ids:
+            group_ids_list = [str(g) for g in group_ids]
+        else:
+            groups_list = groups.get_group_ids()
+            venues.venues()
+            group_ids_list = [g.get("group_id") for g in groups_list]
+        group_starts = {}
+        if group_scheduler is not None and not group_ids:
+            group_starts = group_scheduler.plan(group_ids_list, start)
+            group_ids_list = list(group_starts)
+        extract_span.set_attribute("groups", len(group_ids_list))
 
-    for idx, cs in enumerate(courses_list, 1):
-        bar = progress_bar(idx, len(courses_list))
-        log(f"Processing {len(courses_list)} courses... {bar}", end='\r')
-        course_dict = course.course(cs)
-        course_dict_list.append(course_dict)
-    if courses_list:
-        bar = progress_bar(len(courses_list), len(courses_list))
-        log(f"Processing {len(courses_list)} courses... {bar} completed" + " " * 10)
+        events_list = []
+        courses_list = []
+        listed_event_rows = {}
+        listed_course_rows = {}
 
-    members_set = set()
-    for p in presences_list:
-        members_set.add(p.get("member_id"))
+        with run_stats.stage("listing"):
+            for idx, group in enumerate(group_ids_list, 1):
+                bar = progress_bar(idx, len(group_ids_list))
+                log(f"Fetching events and courses for {len(group_ids_list)} groups... {bar}", end='\r')
+                group_start = group_starts.get(group, start)
+                with tracing.span("myclub.group_listing", group_id=group) as span:
+                    if LISTING_HYDRATION:
+                        events, rows = hydrate_rows(
+                            events_in_group.event_listing(group, start=group_start, end=end),
+                            event.EVENT_FIELDS, event.event_row,
+                        )
+                        listed_event_rows.update(rows)
+                    else:
+                        events = events_in_group.events_in_group(group, start=group_start, end=end)
+                    events_list.extend(events)
 
-    members_list = list(members_set)
+                    if LISTING_HYDRATION:
+                        courses, rows = hydrate_rows(
+                            courses_in_group.course_listing(group, start=group_start, end=end),
+                            course.COURSE_FIELDS, course.course_row,
+                        )
+                        listed_course_rows.update(rows)
+                    else:
+                        courses = courses_in_group.courses_in_group(group, start=group_start, end=end)
+                    courses_list.extend(courses)
+                    span.set_attribute("events", len(events))
+                    span.set_attribute("courses", len(courses))
+                if group_scheduler is not None:
+                    group_scheduler.observe(group, len(events) + len(courses))
+                run_stats.progress("groups", idx, len(group_ids_list))
+            bar = progress_bar(len(group_ids_list), len(group_ids_list))
+            log(f"Fetching events and courses for {len(group_ids_list)} groups... {bar} completed" + " " * 10)
 
-    for idx, m in enumerate(members_list, 1):
-        bar = progress_bar(idx, len(members_list))
-        log(f"Processing {len(members_list)} members... {bar}", end='\r')
-        member_dict, membership_dict = member.member(m)
-        if member_dict and membership_dict:
-            members_dict_list.append(member_dict)
-            membership_dict_list.extend(membership_dict)
-    bar = progress_bar(len(members_list), len(members_list))
-    log(f"Processing {len(members_list)} members... {bar} completed" + " " * 10)
+        if event_tracker is not None and not group_ids:
+            events_list = event_tracker.select(events_list, listed_groups=set(group_ids_list))
+
+        # Retry quarantined entities whose backoff has elapsed (full runs only, so
+        # that group-restricted runs such as fan-out shards don't all retry them)
+        retry = not group_ids
+        if retry:
+            listed_events = set(events_list)
+            events_list.extend(e for e in quarantine.due_for_retry("event") if e not in listed_events)
+            listed_courses = set(courses_list)
+            courses_list.extend(c for c in quarantine.due_for_retry("course") if c not in listed_courses)
+
+        with run_stats.stage("events"):
+            event_dict_list, presences_list = fetch_events(events_list)
+        # Courses with complete listing rows need no detail calls
+        course_ids = [c for c in courses_list if c not in listed_course_rows]
+        with run_stats.stage("courses"):
+            course_dict_list = fetch_courses(course_ids)
+        if LISTING_HYDRATION:
+            fetched_events = {row["event_id"] for row in event_dict_list}
+            hydrated_events = [row for event_id, row in listed_event_rows.items() if event_id not in fetched_events]
+            event_dict_list.extend(hydrated_events)
+            course_dict_list.extend(listed_course_rows.values())
+            # Quarantined courses that the listing now covers are released
+            quarantine.release("course", list(listed_course_rows))
+            run_stats.current().extra["listing_hydration"] = {
+                "events_from_listing": len(hydrated_events),
+                "courses_from_listing": len(listed_course_rows),
+                "course_details_fetched": len(course_ids),
+            }
+        if all_members:
+            member_ids_list = unique_member_ids(presences_list)
+        else:
+            member_ids_list, freshness = member_freshness.select_members(
+                unique_member_ids(presences_list)
+            )
+            run_stats.current().extra["member_freshness"] = freshness
+        if exclude_member_ids:
+            member_ids_list = [m for m in member_ids_list if m not in exclude_member_ids]
+        if retry:
+            selected_members = set(member_ids_list)
+            member_ids_list.extend(m for m in quarantine.due_for_retry("member") if m not in selected_members)
+        with run_stats.stage("members"):
+            members_dict_list, membership_dict_list = fetch_members(member_ids_list)
+        extract_span.set_attribute("events", len(event_dict_list))
+        extract_span.set_attribute("presences", len(presences_list))
+        extract_span.set_attribute("members", len(members_dict_list))
+    quarantine.report()
 
     return (
         presences_list,
@@ -103,6 +345,42 @@ def get_all_presences_in_date_range(start, end):
     )
 
 
+def get_entities(event_ids=None, member_ids=None):
+    """
+    Fetch specific events and members together with their dependents.
+
+    Used for targeted refreshes: the listed events are re-fetched along with
+    their presences, and every member appearing in those presences is
+    re-fetched together with the explicitly requested members.
+
+    Args:
+        event_ids (list): Event IDs to refresh
+        member_ids (list): Member IDs to refresh
+
+    Returns:
+        tuple: (presences_list, event_dict_list, course_dict_list,
+                members_dict_list, membership_dict_list)
+    """
+    event_ids_list = [str(e) for e in (event_ids or [])]
+    with run_stats.stage("events"):
+        event_dict_list, presences_list = fetch_events(event_ids_list)
+
+    member_ids_list = unique_member_ids(presences_list)
+    for m in member_ids or []:
+        if str(m) not in member_ids_list:
+            member_ids_list.append(str(m))
+    with run_stats.stage("members"):
+        members_dict_list, membership_dict_list = fetch_members(member_ids_list)
+
+    return (
+        presences_list,
+        event_dict_list,
+        [],
+        members_dict_list,
+        membership_dict_list,
+    )
+
+
 if __name__ == "__main__":
     end = datetime.datetime.now().date()
     start = end - datetime.timedelta(days=1)
@@ -0,0 +1,136 @@
+"""
+Activity-aware scheduling of the group listings.
+
+Every incremental run lists the events and courses of every group, although
+many groups are archived or seasonal and never return anything. Per group,
+the state store keeps when its listings last returned events or courses
+(last_active), when it was last listed (last_polled) and up to which date
+its listings are complete (covered_until). A run then lists:
+
+- active groups (anything listed within GROUP_DORMANT_DAYS)
+- dormant groups only every GROUP_DORMANT_POLL_DAYS
+- every group during a full sweep, every GROUP_FULL_SWEEP_DAYS
+- groups in FORCE_GROUP_IDS (comma-separated) always
+
+A group that was skipped is listed from its covered_until date on its next
+poll, so skipping it delays but never loses its events. Disabled with
+GROUP_ACTIVITY=false.
+"""
+import datetime
+import os
+
+from dotenv import load_dotenv
+
+import run_stats
+import state_store
+import tenants
+from logger import log
+
+load_dotenv()
+
+GROUP_ACTIVITY = os.getenv("GROUP_ACTIVITY", "true").lower() in ("true", "1", "yes")
+GROUP_DORMANT_DAYS = int(os.getenv("GROUP_DORMANT_DAYS", "60"))
+GROUP_DORMANT_POLL_DAYS = int(os.getenv("GROUP_DORMANT_POLL_DAYS", "7"))
+GROUP_FULL_SWEEP_DAYS = int(os.getenv("GROUP_FULL_SWEEP_DAYS", "30"))
+FORCE_GROUP_IDS = {g.strip() for g in os.getenv("FORCE_GROUP_IDS", "").split(",") if g.strip()}
+
+STATE_NAMESPACE = "group_activity"
+
+
+def _date(value):
+    return datetime.date.fromisoformat(value) if value else None
+
+
+class GroupScheduler:
+    """
+    Chooses the groups to list and records their activity.
+
+    Passed to get_all_presences.get_all_presences_in_date_range as its
+    group_scheduler; record() must only be called once the run's rows have
+    been uploaded.
+    """
+
+    def __init__(self, end, state=None, today=None):
+        state = state or {}
+        self.end = end
+        self.today = today or datetime.date.today()
+        self.groups = dict(state.get("groups") or {})
+        self.last_full_sweep = _date(state.get("last_full_sweep"))
+        self.full_sweep = (
+            self.last_full_sweep is None
+            or (self.today - self.last_full_sweep).days >= GROUP_FULL_SWEEP_DAYS
+        )
+        self.observed = {}
+        self.summary = {"groups": 0, "listed": 0, "skipped_dormant": 0, "forced": 0,
+                        "full_sweep": self.full_sweep}
+
+    @classmethod
+    def load(cls, end):
+        """Create a scheduler from the active tenant's state."""
+        return cls(end, state_store.load(tenants.scoped(STATE_NAMESPACE)))
+
+    def is_dormant(self, entry):
+        """Return True if a group's listings have been empty for GROUP_DORMANT_DAYS."""
+        last_active = _date(entry.get("last_active") or entry.get("first_seen"))
+        return last_active is not None and (self.today - last_active).days >= GROUP_DORMANT_DAYS
+
+    def plan(self, group_ids, start):
+        """
+        Choose the groups to list and the start date of each listing.
+
+        Args:
+            group_ids (list): All group IDs
+            start (datetime.date): Window start
+
+        Returns:
+            dict: group_id -> listing start, in the order of group_ids
+        """
+        planned = {}
+        for group_id in group_ids:
+            entry = self.groups.get(group_id)
+            forced = group_id in FORCE_GROUP_IDS
+            if entry is not None and not (self.full_sweep or forced) and self.is_dormant(entry):
+                last_polled = _date(entry.get("last_polled"))
+                if last_polled and (self.today - last_polled).days < GROUP_DORMANT_POLL_DAYS:
+                    self.summary["skipped_dormant"] += 1
+                    continue
+            covered_until = _date(entry.get("covered_until")) if entry else None
+            planned[group_id] = min(start, covered_until) if covered_until else start
+            self.summary["forced"] += forced
+
+        # Groups that no longer exist are forgotten
+        existing = set(group_ids)
+        self.groups = {g: entry for g, entry in self.groups.items() if g in existing}
+        self.summary["groups"] = len(group_ids)
+        self.summary["listed"] = len(planned)
+        log(
+            f"Listing {len(planned)} of {len(group_ids)} groups "
+            f"({self.summary['skipped_dormant']} dormant skipped"
+            f"{', full sweep' if self.full_sweep else ''})"
+        )
+        run_stats.current().extra["group_activity"] = self.summary
+        return planned
+
+    def observe(self, group_id, listed):
+        """Note the number of events and courses a group's listing returned."""
+        self.observed[group_id] = listed
+
+    def record(self):
+        """Save the activity of the listed groups."""
+        today = self.today.isoformat()
+        for group_id, listed in self.observed.items():
+            entry = self.groups.setdefault(group_id, {"first_seen": today})
+            entry["last_polled"] = today
+            entry["covered_until"] = self.end.isoformat()
+            if listed:
+                entry["last_active"] = today
+        last_full_sweep = today if self.full_sweep else self.last_full_sweep.isoformat()
+        state = {"groups": self.groups, "last_full_sweep": last_full_sweep}
+        state_store.save(tenants.scoped(STATE_NAMESPACE), state)
+
+
+def scheduler(end):
+    """Return a GroupScheduler for a window ending at `end`, or None if disabled."""
+    if not GROUP_ACTIVITY:
+        return None
+    return GroupScheduler.load(end)
@@ -1,6 +1,8 @@
 import requests
+import http_client
+import resources
+import tenants
 import json
-import os
 
 from dotenv import load_dotenv
 from logger import error
@@ -8,6 +10,15 @@ from logger import error
 load_dotenv()
 
 def get_group_ids():
+    """
+    Return all groups, cached per instance for METADATA_CACHE_SECONDS.
+
+    See fetch_groups and resources.cached.
+    """
+    return resources.cached("groups", fetch_groups)
+
+
+def fetch_groups():
     """
     Fetch all groups from MyClub API.
 
@@ -18,16 +29,16 @@ def get_group_ids():
         ValueError: If MC_TOKEN is not set
         requests.exceptions.RequestException: If API request fails
     """
-    myclub_token = os.getenv("MC_TOKEN")
+    myclub_token = tenants.token()
     if not myclub_token:
         raise ValueError("MC_TOKEN environment variable is required but not set")
 
-    base_url = "https://ehms.myclub.fi/api/"
+    base_url = tenants.base_url()
     headers = {"X-myClub-token": myclub_token}
     full_url = f"{base_url}groups"
 
     try:
-        response = requests.get(full_url, headers=headers, timeout=30)
+        response = http_client.get(full_url, headers=headers, timeout=30)
         response.raise_for_status()
         content = response.json()
 
@@ -0,0 +1,344 @@
+"""
+Record/replay of MyClub API traffic.
+
+In record mode every request sent through http_client.get is captured with
+its response (status, headers, body, latency) or its exception into a
+compressed zip archive. In replay mode the requests are answered from the
+archive without network access, optionally sleeping for the recorded
+latency, so extraction runs and performance changes can be reproduced and
+benchmarked deterministically against the shapes of real data.
+
+Enable it for any run with HTTP_ARCHIVE_MODE=record|replay and
+HTTP_ARCHIVE_PATH, or use the CLI, which records or replays
+get_all_presences_in_date_range with an isolated state store:
+
+    python src/http_archive.py record run.zip --start 2024-01-01 --end 2024-03-01
+    python src/http_archive.py replay run.zip --timing 1.0
+
+Archive layout:
+- bodies/<session>-<seq>: response bodies (deflated)
+- index/<session>.json: the session's exchanges in request order, each with
+  the request key (method, URL and query parameters; headers such as the API
+  token are never stored), status, headers, latency and body member, plus
+  the run parameters of CLI recordings
+
+Recording again into an existing archive appends a new session. Identical
+requests are replayed in recorded order, the last response repeating once
+they are exhausted. Requests missing from the archive fail with
+ArchiveMiss, a requests exception, so they are quarantined like network
+errors. Recording reads streamed bodies completely before handing them on.
+An environment-enabled recording is shared by concurrent runs (e.g. club
+runs) and finalised when the last run that used it finishes.
+"""
+import argparse
+import atexit
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+import zipfile
+from urllib.parse import urlencode
+
+import requests
+from dotenv import load_dotenv
+from requests.structures import CaseInsensitiveDict
+
+import run_stats
+from logger import log, error
+
+load_dotenv()
+
+HTTP_ARCHIVE_MODE = os.getenv("HTTP_ARCHIVE_MODE", "off").lower()
+HTTP_ARCHIVE_PATH = os.getenv(
+    "HTTP_ARCHIVE_PATH", os.path.join(tempfile.gettempdir(), "ehms_http_archive.zip")
+)
+# Share of the recorded latency slept on replay (0 = answer immediately)
+HTTP_REPLAY_TIMING = float(os.getenv("HTTP_REPLAY_TIMING", "0"))
+
+ARCHIVE_MODES = ("record", "replay")
+
+# Response headers that are not worth keeping
+_SKIPPED_HEADERS = {"set-cookie", "content-encoding", "transfer-encoding", "connection"}
+
+
+class ArchiveMiss(requests.exceptions.RequestException):
+    """Raised on replay for a request that is not in the archive."""
+
+
+def request_key(url, params=None):
+    """Return the key identifying a GET request in the archive."""
+    query = urlencode(sorted((str(k), str(v)) for k, v in (params or {}).items() if v is not None))
+    return f"GET {url}?{query}" if query else f"GET {url}"
+
+
+class Recorder:
+    """Appends the exchanges of one session to an archive."""
+
+    def __init__(self, path, run=None):
+        self.path = path
+        self.session = uuid.uuid4().hex[:12]
+        self.exchanges = []
+        self.run = run
+        # Runs (RunStats) that sent requests through the recording
+        self.runs = weakref.WeakSet()
+        self.lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.zip = zipfile.ZipFile(path, "a", compression=zipfile.ZIP_DEFLATED)
+
+    def attach(self, stats):
+        """Register a run using the recording; False if it is already closed."""
+        with self.lock:
+            if self.zip is None:
+                return False
+            self.runs.add(stats)
+            return True
+
+    def detach(self, stats):
+        """Unregister a finished run; True if no other run uses the recording."""
+        with self.lock:
+            self.runs.discard(stats)
+            return not self.runs
+
+    def _add(self, key, entry, body=None):
+        with self.lock:
+            if self.zip is None:
+                raise RuntimeError(f"Archive {self.path} is closed")
+            entry = dict(entry, key=key, seq=len(self.exchanges))
+            if body is not None:
+                entry["body"] = f"bodies/{self.session}-{entry['seq']:06d}"
+                self.zip.writestr(entry["body"], body)
+            self.exchanges.append(entry)
+
+    def record(self, url, params, response, elapsed):
+        """Record a response (its body is read completely)."""
+        headers = {
+            name: value for name, value in response.headers.items()
+            if name.lower() not in _SKIPPED_HEADERS
+        }
+        self._add(request_key(url, params), {
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": headers,
+            "encoding": response.encoding,
+            "elapsed": round(elapsed, 6),
+        }, body=response.content)
+
+    def record_error(self, url, params, exc, elapsed):
+        """Record a request that raised instead of returning a response."""
+        self._add(request_key(url, params), {
+            "error": type(exc).__name__,
+            "message": str(exc),
+            "elapsed": round(elapsed, 6),
+        })
+
+    def close(self):
+        """Write the session index and close the archive."""
+        with self.lock:
+            if self.zip is None:
+                return
+            index = {
+                "session": self.session,
+                "recorded_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "run": self.run,
+                "exchanges": self.exchanges,
+            }
+            self.zip.writestr(f"index/{self.session}.json", json.dumps(index))
+            self.zip.close()
+            self.zip = None
+        log(f"Recorded {len(self.exchanges)} API exchanges to {self.path}")
+
+
+class Replayer:
+    """Answers requests from the exchanges of an archive."""
+
+    def __init__(self, path, timing=None):
+        self.path = path
+        self.timing = HTTP_REPLAY_TIMING if timing is None else timing
+        self.zip = zipfile.ZipFile(path, "r")
+        self.entries = {}
+        self.runs = []
+        for name in sorted(n for n in self.zip.namelist() if n.startswith("index/")):
+            index = json.loads(self.zip.read(name))
+            if index.get("run"):
+                self.runs.append(index["run"])
+            for entry in index["exchanges"]:
+                self.entries.setdefault(entry["key"], []).append(entry)
+        self.cursors = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _next(self, key):
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                self.misses += 1
+                return None
+            position = self.cursors.get(key, 0)
+            self.cursors[key] = position + 1
+            self.hits += 1
+            return entries[min(position, len(entries) - 1)]
+
+    def get(self, url, params=None):
+        """
+        Return the recorded response of a request.
+
+        Raises:
+            ArchiveMiss: If the request is not in the archive
+            requests.exceptions.RequestException: The recorded exception
+        """
+        key = request_key(url, params)
+        entry = self._next(key)
+        if entry is None:
+            raise ArchiveMiss(f"No recorded response for {key}")
+        if self.timing:
+            time.sleep(entry.get("elapsed", 0.0) * self.timing)
+
+        if "error" in entry:
+            exc_type = getattr(requests.exceptions, entry["error"], requests.exceptions.RequestException)
+            raise exc_type(entry["message"])
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason = entry.get("reason")
+        response.headers = CaseInsensitiveDict(entry.get("headers") or {})
+        response.encoding = entry.get("encoding")
+        response.url = url
+        with self.lock:
+            response._content = self.zip.read(entry["body"]) if entry.get("body") else b""
+        response._content_consumed = True
+        return response
+
+    def close(self):
+        self.zip.close()
+
+
+_active = None
+_active_lock = threading.Lock()
+
+
+def active():
+    """
+    Return the active Recorder or Replayer, opening HTTP_ARCHIVE_MODE's on first use.
+
+    A Recorder is kept open until the current run has finished as well.
+    """
+    global _active
+    while True:
+        archive = _active
+        if archive is None and HTTP_ARCHIVE_MODE in ARCHIVE_MODES:
+            with _active_lock:
+                if _active is None:
+                    if HTTP_ARCHIVE_MODE == "record":
+                        _active = Recorder(HTTP_ARCHIVE_PATH)
+                        log(f"Recording MyClub API traffic to {HTTP_ARCHIVE_PATH}")
+                    else:
+                        _active = Replayer(HTTP_ARCHIVE_PATH)
+                        log(f"Replaying MyClub API traffic from {HTTP_ARCHIVE_PATH}")
+                archive = _active
+        # A recording finalised in the meantime is replaced by a new session
+        if not isinstance(archive, Recorder) or archive.attach(run_stats.current()):
+            return archive
+
+
+def start(archive):
+    """Make a Recorder or Replayer the active archive (closing the previous one)."""
+    global _active
+    with _active_lock:
+        previous, _active = _active, archive
+    if previous is not None:
+        previous.close()
+    return archive
+
+
+def close():
+    """Close the active archive; a recording is finalised with its index."""
+    global _active
+    with _active_lock:
+        archive, _active = _active, None
+    if archive is not None:
+        archive.close()
+    return archive
+
+
+def _run_listener(event, stats, **details):
+    """Finalise an environment-enabled recording when the last run using it finishes."""
+    global _active
+    if event != "finish" or not isinstance(_active, Recorder):
+        return
+    # Closed under the lock, so that active() can't open the next session on
+    # the same file before this one is written
+    with _active_lock:
+        archive = _active
+        if not isinstance(archive, Recorder) or not archive.detach(stats):
+            return
+        _active = None
+        try:
+            archive.close()
+        except Exception as e:
+            error(f"Could not finalise the HTTP archive: {e}")
+
+
+run_stats.add_default_listener(_run_listener)
+atexit.register(close)
+
+
+def _isolate_state():
+    """Keep CLI runs from reading or changing the pipeline's state."""
+    import state_store
+    state_store.STATE_DIR = tempfile.mkdtemp(prefix="ehms_archive_state_")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record or replay the MyClub extraction")
+    parser.add_argument("command", choices=ARCHIVE_MODES)
+    parser.add_argument("archive", help="Path of the zip archive")
+    parser.add_argument("--start", help="Window start (YYYY-MM-DD), default: as recorded")
+    parser.add_argument("--end", help="Window end (YYYY-MM-DD), default: as recorded")
+    parser.add_argument("--group-ids", help="Comma-separated group IDs, default: as recorded")
+    parser.add_argument("--timing", type=float, default=None,
+                        help="Replay: share of the recorded latency to sleep (default: HTTP_REPLAY_TIMING)")
+    args = parser.parse_args()
+
+    # Run through the imported module: http_client checks its active archive
+    import get_all_presences
+    import http_archive
+    import initialise
+
+    if args.command == "record":
+        if not args.start or not args.end:
+            parser.error("record needs --start and --end")
+        run = {"start": args.start, "end": args.end, "group_ids": initialise.parse_id_list(args.group_ids)}
+        archive = http_archive.start(http_archive.Recorder(args.archive, run=run))
+    else:
+        archive = http_archive.start(http_archive.Replayer(args.archive, timing=args.timing))
+        run = dict(archive.runs[-1]) if archive.runs else {}
+        run.update({key: value for key, value in (("start", args.start), ("end", args.end)) if value})
+        if args.group_ids:
+            run["group_ids"] = initialise.parse_id_list(args.group_ids)
+        if not run.get("start") or not run.get("end"):
+            parser.error("the archive has no recorded run, pass --start and --end")
+        # The fetchers insist on a token, which the archive doesn't need
+        os.environ.setdefault("MC_TOKEN", "replay")
+    _isolate_state()
+
+    # Every member is fetched so that recordings are complete for replays
+    # started from an empty state store
+    stats = run_stats.activate()
+    results = get_all_presences.get_all_presences_in_date_range(
+        initialise.parse_date(run["start"]),
+        initialise.parse_date(run["end"]),
+        group_ids=run.get("group_ids") or None,
+        all_members=True,
+    )
+    stats.set_rows(dict(zip(get_all_presences.RESULT_TABLES, results)))
+    if isinstance(archive, http_archive.Replayer):
+        stats.extra["replay"] = {"hits": archive.hits, "misses": archive.misses, "timing": archive.timing}
+    stats.finish()
+    http_archive.close()
+    log(json.dumps(stats.summary(), indent=2))
@@ -0,0 +1,84 @@
+"""
+Shared HTTP access to the MyClub API.
+
+All fetchers send their requests through `get()` so that cross-cutting
+behaviour (streaming, instrumentation, ...) lives in one place. Exceptions
+are the usual requests exceptions, so callers keep their error handling;
+fetchers raise NoDataReturned when a response lacks the requested object.
+Every request is recorded in the metrics registry and as an 'http.get'
+tracing span, and waits for the rate limit of the active tenant (see
+tenants). Requests are recorded to or replayed from an archive when
+http_archive is active. Connections are kept alive in one pooled session per
+instance (see resources), so warm invocations skip the TLS handshakes.
+"""
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import http_archive
+import metrics
+import resources
+import tenants
+import tracing
+
+# Connections kept alive per host (concurrent tenants share the pool)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+
+
+class NoDataReturned(ValueError):
+    """Raised when a MyClub response doesn't contain the requested object."""
+
+
+def create_session():
+    """Create a requests session with a connection pool of HTTP_POOL_SIZE."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+resources.register("http_session", create_session, close=lambda session: session.close())
+
+
+def get(url, headers=None, params=None, timeout=30, stream=False):
+    """
+    Send a GET request.
+
+    Args:
+        url: Full request URL
+        headers: Request headers
+        params: Query parameters
+        timeout: Request timeout in seconds (default: 30)
+        stream: Don't download the body until it is read (default: False)
+
+    Returns:
+        requests.Response
+    """
+    archive = http_archive.active()
+    if not isinstance(archive, http_archive.Replayer):
+        tenants.wait_for_request()
+    with tracing.span("http.get", endpoint=metrics.endpoint_label(url)) as span:
+        started = time.perf_counter()
+        try:
+            if isinstance(archive, http_archive.Replayer):
+                response = archive.get(url, params=params)
+            else:
+                response = resources.get("http_session").get(
+                    url, headers=headers, params=params, timeout=timeout, stream=stream
+                )
+        except requests.RequestException as e:
+            elapsed = time.perf_counter() - started
+            if isinstance(archive, http_archive.Recorder):
+                archive.record_error(url, params, e, elapsed)
+            metrics.observe_request(url, "error", elapsed)
+            raise
+        elapsed = time.perf_counter() - started
+        if isinstance(archive, http_archive.Recorder):
+            archive.record(url, params, response, elapsed)
+        metrics.observe_request(url, response.status_code, elapsed)
+        span.set_attribute("status", response.status_code)
+        span.set_attribute("content_length", response.headers.get("Content-Length"))
+    return response
@@ -4,37 +4,172 @@ import argparse
 import get_all_presences
 import categories
 import groups
+import group_activity
 import bigquery_upload
+import member_freshness
+import memory_tracking
+import open_events
+import profiling
+import row_buffer
+import run_stats
 from logger import log
 
 import os
 
+# Parameters that turn a run into a targeted refresh (see run_targeted)
+TARGETED_PARAMS = ("group_ids", "event_ids", "member_ids", "start", "end")
 
-def run(interval=60):
+# Start of the tracked history
+HISTORY_START = datetime.date(2021, 1, 1)
+
+
+def parse_date(value):
+    """Parse a date given as datetime.date or an ISO string (YYYY-MM-DD)."""
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.fromisoformat(str(value)).date()
+
+
+def parse_id_list(value):
+    """Parse a comma-separated string (or iterable) of IDs into a list of strings."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def combine_rows(table_name, *row_lists):
     """
-    Main pipeline function to fetch data from MyClub API and upload to BigQuery.
+    Concatenate row lists for a table, keeping the last row per primary key.
 
-    This function:
-    1. Determines the date range (from most recent BigQuery data - 7 days buffer)
-    2. Fetches all data (presences, events, courses, members, etc.) from MyClub API
-    3. Uploads data directly to BigQuery using MERGE (upsert) strategy
+    MERGE rejects source tables where several rows match the same target row,
+    so overlapping fetches (e.g. a targeted event that is also inside the
+    refreshed window) must be deduplicated before upload.
 
-    The 7-day buffer ensures that any modifications to recent events are captured.
+    The inputs are read twice: once to find the position of the last row per
+    key, then to copy those rows into a RowBuffer, so only the keys are held
+    in memory. The caller closes the returned buffer after the upload.
 
     Args:
-        interval (int): Number of days to fetch from the start date (default: 60)
+        table_name: Table the rows belong to
+        *row_lists: Lists of row dictionaries or RowBuffers
 
-    Raises:
-        Exception: If BigQuery upload fails or API calls fail
+    Returns:
+        row_buffer.RowBuffer: The deduplicated rows
+    """
+    primary_keys = bigquery_upload.get_primary_keys(table_name)
+    last_position = {}
+    position = 0
+    for rows in row_lists:
+        for row in rows:
+            last_position[tuple(row.get(k) for k in primary_keys)] = position
+            position += 1
+
+    combined = row_buffer.RowBuffer(table_name)
+    position = 0
+    for rows in row_lists:
+        for row in rows:
+            if last_position[tuple(row.get(k) for k in primary_keys)] == position:
+                combined.append(row)
+            position += 1
+    return combined
+
+
+def run_targeted(interval=60, group_ids=None, event_ids=None, member_ids=None,
+                 start=None, end=None, stats=None):
+    """
+    Refresh only specific groups, events or members.
+
+    Unlike the full pipeline, only the affected entities and their dependents
+    are fetched and merged:
+    - group_ids (optionally with start/end): events and courses of those groups
+      in the window, their presences and the members of those presences
+    - event_ids: the events, their presences and the members of those presences
+    - member_ids: the members and their memberships
+
+    Categories and groups are not refreshed.
+
+    Args:
+        interval (int): Window length in days when only one of start/end is given
+        group_ids (list): Group IDs to refresh
+        event_ids (list): Event IDs to refresh
+        member_ids (list): Member IDs to refresh
+        start (datetime.date | str): Window start (default: end - interval)
+        end (datetime.date | str): Window end (default: start + interval, capped at 8 days ago)
+        stats (run_stats.RunStats): Stats collector for this run (default: new one)
+
+    Returns:
+        dict: Performance summary of the run (see run_stats.RunStats.summary)
     """
+    stats = run_stats.activate(stats)
+    group_ids = parse_id_list(group_ids)
+    event_ids = parse_id_list(event_ids)
+    member_ids = parse_id_list(member_ids)
+    start = parse_date(start)
+    end = parse_date(end)
 
-    date = "2021-01-01T00:00:00.000"
-    start = datetime.datetime.strptime(
-        date, "%Y-%m-%dT%H:%M:%S.%f"
-    ).date()  # convert it to date
+    results = []
+    if group_ids or start or end:
+        if start is None and end is None:
+            end = (datetime.datetime.now() - datetime.timedelta(days=8)).date()
+        if start is None:
+            start = end - datetime.timedelta(days=interval)
+        if end is None:
+            end = min(
+                start + datetime.timedelta(days=interval),
+                (datetime.datetime.now() - datetime.timedelta(days=8)).date(),
+            )
+        log(f"Targeted refresh of groups {group_ids or 'all'}")
+        results.append(
+            get_all_presences.get_all_presences_in_date_range(
+                start, end, group_ids=group_ids or None
+            )
+        )
+    if event_ids or member_ids:
+        log(f"Targeted refresh of {len(event_ids)} events and {len(member_ids)} members")
+        results.append(get_all_presences.get_entities(event_ids, member_ids))
+
+    data_to_upload = {
+        table_name: combine_rows(table_name, *[r[idx] for r in results])
+        for idx, table_name in enumerate(get_all_presences.RESULT_TABLES)
+    }
+    for result in results:
+        row_buffer.close_all(dict(zip(get_all_presences.RESULT_TABLES, result)))
+
+    stats.set_rows(data_to_upload)
+    log("Uploading to BigQuery")
+    with stats.stage("upload"):
+        try:
+            downgraded = bigquery_upload.upload_all_tables(data_to_upload)
+            member_freshness.mark_fetched(data_to_upload["members"], downgraded=downgraded)
+        finally:
+            row_buffer.close_all(data_to_upload)
+
+    stats.finish()
+    return stats.summary()
+
+
+def compute_window(interval=60, client=None):
+    """
+    Determine the date range of the next incremental run.
+
+    Starts from the most recent event in BigQuery minus a 7-day buffer (or
+    2021-01-01 on the first run) and ends <interval> days later, but never
+    later than 8 days ago.
+
+    Args:
+        interval (int): Number of days to fetch from the start date (default: 60)
+        client: BigQuery client instance (default: a new client)
+
+    Returns:
+        tuple: (start, end) as datetime.date
+    """
+    start = HISTORY_START
 
     # Get the most recent date from BigQuery
-    client = bigquery_upload.initialize_bigquery_client()
+    if client is None:
+        client = bigquery_upload.initialize_bigquery_client()
     most_recent = bigquery_upload.get_most_recent_date(client)
     if most_recent:
         # Parse the ISO format datetime string (handles timezone automatically)
@@ -49,12 +184,48 @@ def run(interval=60):
         (datetime.datetime.now() - datetime.timedelta(days=8)).date(),
     )
 
+    return start, end
+
+
+def run(interval=60, stats=None):
+    """
+    Main pipeline function to fetch data from MyClub API and upload to BigQuery.
+
+    This function:
+    1. Determines the date range (from most recent BigQuery data - 7 days buffer)
+    2. Fetches all data (presences, events, courses, members, etc.) from MyClub API
+    3. Uploads data directly to BigQuery using MERGE (upsert) strategy
+
+    The 7-day buffer ensures that any modifications to recent events are captured;
+    with open-events tracking only the buffer's new and still open events are
+    re-fetched (see open_events).
+
+    Args:
+        interval (int): Number of days to fetch from the start date (default: 60)
+        stats (run_stats.RunStats): Stats collector for this run (default: new one)
+
+    Returns:
+        dict: Performance summary of the run (see run_stats.RunStats.summary)
+
+    Raises:
+        Exception: If BigQuery upload fails or API calls fail
+    """
+    stats = run_stats.activate(stats)
+
+    start, end = compute_window(interval)
+    stats.extra["window"] = {"start": start.isoformat(), "end": end.isoformat()}
+
+    event_tracker = open_events.tracker(start, end)
+    group_scheduler = group_activity.scheduler(end)
     presences, events, courses, members, memberships = (
-        get_all_presences.get_all_presences_in_date_range(start, end)
+        get_all_presences.get_all_presences_in_date_range(
+            start, end, event_tracker=event_tracker, group_scheduler=group_scheduler
+        )
     )
 
-    _categories = categories.categories()
-    _groups = groups.get_group_ids()
+    with stats.stage("metadata"):
+        _categories = categories.categories()
+        _groups = groups.get_group_ids()
 
     # Note: No data cleaning needed - BigQuery handles all data types properly
     # and parameterized queries in MERGE statement prevent SQL injection
@@ -70,9 +241,79 @@ def run(interval=60):
         "presences": presences,
     }
 
+    stats.set_rows(data_to_upload)
+
     # Upload directly to BigQuery
     log("Uploading to BigQuery")
-    bigquery_upload.upload_all_tables(data_to_upload)
+    with stats.stage("upload"):
+        try:
+            downgraded = bigquery_upload.upload_all_tables(data_to_upload)
+            member_freshness.mark_fetched(data_to_upload["members"], downgraded=downgraded)
+            if event_tracker is not None:
+                event_tracker.cleanup()
+                event_tracker.record(
+                    events, presences, keep_open=bool({"events", "presences"} & set(downgraded))
+                )
+            if group_scheduler is not None:
+                group_scheduler.record()
+        finally:
+            row_buffer.close_all(data_to_upload)
+
+    stats.finish()
+    return stats.summary()
+
+
+def run_rebuild(stats=None):
+    """
+    Rebuild all tables from the full MyClub history.
+
+    Extracts everything from HISTORY_START up to 8 days ago (every member is
+    fetched, ignoring member freshness) and atomically replaces the contents
+    of each table through load jobs instead of MERGE. Use after
+    truncate_tables.truncate_all_tables or a schema change.
+
+    Args:
+        stats (run_stats.RunStats): Stats collector for this run (default: new one)
+
+    Returns:
+        dict: Performance summary of the run
+    """
+    stats = run_stats.activate(stats)
+
+    start = HISTORY_START
+    end = (datetime.datetime.now() - datetime.timedelta(days=8)).date()
+    stats.extra["window"] = {"start": start.isoformat(), "end": end.isoformat()}
+    log(f"Rebuilding all tables from {start} to {end}")
+
+    presences, events, courses, members, memberships = (
+        get_all_presences.get_all_presences_in_date_range(start, end, all_members=True)
+    )
+
+    with stats.stage("metadata"):
+        _categories = categories.categories()
+        _groups = groups.get_group_ids()
+
+    data_to_upload = {
+        "categories": _categories,
+        "courses": courses,
+        "events": events,
+        "groups": _groups,
+        "members": members,
+        "memberships": memberships,
+        "presences": presences,
+    }
+
+    stats.set_rows(data_to_upload)
+    log("Replacing BigQuery tables")
+    with stats.stage("upload"):
+        try:
+            bigquery_upload.replace_all_tables(data_to_upload)
+            member_freshness.mark_fetched(data_to_upload["members"])
+        finally:
+            row_buffer.close_all(data_to_upload)
+
+    stats.finish()
+    return stats.summary()
 
 
 if __name__ == "__main__":
@@ -86,7 +327,52 @@ if __name__ == "__main__":
         default=60,
         help="Number of days to fetch from the start date (default: 60)"
     )
+    parser.add_argument("--group-ids", help="Comma-separated group IDs to refresh")
+    parser.add_argument("--event-ids", help="Comma-separated event IDs to refresh")
+    parser.add_argument("--member-ids", help="Comma-separated member IDs to refresh")
+    parser.add_argument("--start", help="Window start date (YYYY-MM-DD) for a targeted refresh")
+    parser.add_argument("--end", help="Window end date (YYYY-MM-DD) for a targeted refresh")
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Rebuild all tables from the full history, replacing their contents atomically"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=None,
+        help="Profile the run and save the profile (also enabled by PROFILE=true)"
+    )
+    parser.add_argument(
+        "--memory",
+        nargs="?",
+        const="rss",
+        choices=memory_tracking.MEMORY_TRACKING_MODES,
+        help="Report memory per stage: rss (default) or tracemalloc (also MEMORY_TRACKING)"
+    )
     args = parser.parse_args()
 
-    log(f"Running with interval: {args.interval} days")
-    run(interval=args.interval)
+    if args.rebuild:
+        fn, kwargs = run_rebuild, {}
+    elif args.group_ids or args.event_ids or args.member_ids or args.start or args.end:
+        fn, kwargs = run_targeted, {
+            "interval": args.interval,
+            "group_ids": args.group_ids,
+            "event_ids": args.event_ids,
+            "member_ids": args.member_ids,
+            "start": args.start,
+            "end": args.end,
+        }
+    else:
+        log(f"Running with interval: {args.interval} days")
+        fn, kwargs = run, {"interval": args.interval}
+
+    stats = run_stats.RunStats()
+    tracking_mode = memory_tracking.mode(args.memory)
+    if tracking_mode:
+        memory_tracking.attach(stats, tracking_mode)
+
+    if profiling.enabled(args.profile):
+        profiling.profiled_call(fn, stats=stats, **kwargs)
+    else:
+        fn(stats=stats, **kwargs)
@@ -0,0 +1,314 @@
+"""
+Asynchronous pipeline jobs for the HTTP trigger.
+
+A job is accepted immediately and executed either in a background thread of
+the current instance (JOB_DISPATCHER=thread, the local stand-in and the
+default outside Cloud Functions) or by POSTing the job id to a worker entry
+point (JOB_DISPATCHER=http, JOB_WORKER_URL pointing at `run_pipeline_worker`,
+e.g. behind a Cloud Tasks queue; the default when deployed, because the
+instance's CPU is throttled once the 202 response has been sent, which
+would stall a background thread and its run lock heartbeat). Job status, the
+current stage, progress counts and the final performance summary are kept
+in the state store under 'jobs/<job_id>'; the http dispatcher therefore
+needs a STATE_DIR shared with the worker (see deploy.sh).
+"""
+import datetime
+import os
+import threading
+import time
+import traceback
+import uuid
+
+import requests
+from dotenv import load_dotenv
+
+import fanout
+import initialise
+import memory_tracking
+import profiling
+import run_lock
+import run_stats
+import state_store
+import tenants
+import time_budget
+import tracing
+from logger import log, error
+
+load_dotenv()
+
+# Set by the Cloud Functions (gen2) / Cloud Run runtime
+DEPLOYED = bool(os.getenv("K_SERVICE") or os.getenv("FUNCTION_TARGET"))
+
+JOB_DISPATCHER = os.getenv("JOB_DISPATCHER") or ("http" if DEPLOYED else "thread")
+JOB_WORKER_URL = os.getenv("JOB_WORKER_URL")
+
+# Minimum seconds between progress writes to the state store
+PROGRESS_SAVE_INTERVAL = 1.0
+
+# Pipeline modes besides the default incremental run
+PIPELINE_MODES = ("fanout", "rebuild", "budget")
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _namespace(job_id):
+    return f"jobs/{job_id}"
+
+
+def run_params(params, stats=None, job_id=None):
+    """
+    Run the pipeline variant selected by a parameter dict.
+
+    Args:
+        params (dict): 'interval', an optional 'mode' (see PIPELINE_MODES),
+                       'shards' for fanout mode, 'budget' (seconds) for
+                       budget mode, 'profile' to enable the
+                       profiler (see profiling), 'memory' to enable memory
+                       tracking (see memory_tracking), 'tenant' to run for
+                       a configured club (see tenants) and targeted refresh
+                       parameters
+        stats (run_stats.RunStats): Stats collector for this run (default: new one)
+        job_id: ID of the job running the pipeline, reported to runs that
+                find the run lock taken
+
+    Returns:
+        dict: Performance summary of the run
+
+    Raises:
+        run_lock.AlreadyRunning: If another run of the same club is in progress
+        run_lock.LeaseLost: If the run's lease was taken over by another run
+    """
+    params = dict(params)
+    tenant = params.pop("tenant", None)
+    if tenant:
+        with tenants.activate(tenant):
+            log(f"Running for tenant {tenant}")
+            return run_params(params, stats=stats, job_id=job_id)
+
+    mode = params.pop("mode", None)
+    interval = params.pop("interval", 60)
+    shards = params.pop("shards", None)
+    budget = params.pop("budget", None)
+    profile = params.pop("profile", None)
+    memory = params.pop("memory", None)
+
+    if mode == "rebuild":
+        fn, kwargs = initialise.run_rebuild, {}
+    elif mode == "fanout":
+        fn, kwargs = fanout.run_coordinator, {
+            "interval": interval, "shard_count": int(shards) if shards else None
+        }
+    elif mode == "budget":
+        fn, kwargs = time_budget.run_budgeted, {"budget_seconds": int(budget) if budget else None}
+    elif mode:
+        raise ValueError(f"Unknown pipeline mode: {mode}")
+    elif params:
+        log(f"Running targeted refresh: {params}")
+        fn, kwargs = initialise.run_targeted, dict(params, interval=interval)
+    else:
+        fn, kwargs = initialise.run, {"interval": interval}
+
+    tracking_mode = memory_tracking.mode(memory)
+
+    with run_lock.hold(job_id=job_id) as lease:
+        stats = stats or run_stats.RunStats()
+        if lease is not None:
+            # Stop at the next stage once another run has taken the lease over
+            stats.add_listener(lease)
+        tracker = None
+        if tracking_mode:
+            tracker = memory_tracking.attach(stats, tracking_mode)
+        try:
+            if profiling.enabled(profile):
+                return profiling.profiled_call(fn, stats=stats, **kwargs)
+            return fn(stats=stats, **kwargs)
+        finally:
+            # A failed run never reaches the "finish" event; stop tracemalloc
+            # anyway so later runs on this instance don't pay for it
+            if tracker is not None:
+                tracker.finish(stats)
+
+
+def get_job(job_id):
+    """
+    Return the stored record of a job.
+
+    Args:
+        job_id: The job ID returned by submit()
+
+    Returns:
+        dict: Job record, or None if the job does not exist
+    """
+    job = state_store.load(_namespace(job_id))
+    return job or None
+
+
+def _update_job(job_id, **fields):
+    def apply(job):
+        job.update(fields)
+        return job
+    return state_store.update(_namespace(job_id), apply)
+
+
+def create_job(params, traceparent=None):
+    """
+    Create a queued job record.
+
+    Args:
+        params (dict): Pipeline parameters (see run_params)
+        traceparent: Trace context the job's spans continue (W3C traceparent)
+
+    Returns:
+        dict: The new job record
+    """
+    job_id = uuid.uuid4().hex
+    job = {
+        "job_id": job_id,
+        "status": "queued",
+        "params": params,
+        "created_at": _now(),
+        "started_at": None,
+        "finished_at": None,
+        "stage": None,
+        "progress": {},
+        "summary": None,
+        "error": None,
+        "traceparent": traceparent,
+    }
+    state_store.save(_namespace(job_id), job)
+    return job
+
+
+def submit(params, traceparent=None):
+    """
+    Create a job and dispatch it for background execution.
+
+    Args:
+        params (dict): Pipeline parameters
+        traceparent: Trace context of the submitting request
+
+    Returns:
+        str: The job ID
+    """
+    job = create_job(params, traceparent)
+    job_id = job["job_id"]
+
+    if JOB_DISPATCHER == "http":
+        _dispatch_http(job_id)
+    elif JOB_DISPATCHER == "thread":
+        if DEPLOYED:
+            error("WARNING: JOB_DISPATCHER=thread on a deployed function; the job runs "
+                  "with a throttled CPU after the response is sent (use http)")
+        _dispatch_thread(job_id)
+    else:
+        raise ValueError(f"Unknown JOB_DISPATCHER: {JOB_DISPATCHER}")
+
+    log(f"Submitted pipeline job {job_id} ({JOB_DISPATCHER} dispatcher)")
+    return job_id
+
+
+def _dispatch_thread(job_id):
+    """Run the job in a background thread of this instance."""
+    thread = threading.Thread(target=execute, args=(job_id,), name=f"pipeline-job-{job_id}")
+    thread.start()
+
+
+def _worker_auth_headers():
+    """Return an ID token header for the worker function (deployed without unauthenticated access)."""
+    if not DEPLOYED:
+        return None
+    import google.auth.transport.requests
+    from google.oauth2 import id_token
+
+    token = id_token.fetch_id_token(google.auth.transport.requests.Request(), JOB_WORKER_URL)
+    return {"Authorization": f"Bearer {token}"}
+
+
+def _dispatch_http(job_id):
+    """Hand the job to the worker entry point without waiting for it to finish."""
+    if not JOB_WORKER_URL:
+        raise ValueError("JOB_WORKER_URL environment variable is required for the http dispatcher")
+    try:
+        response = requests.post(
+            JOB_WORKER_URL, json={"job_id": job_id}, headers=_worker_auth_headers(), timeout=(10, 2)
+        )
+        response.raise_for_status()
+    except requests.exceptions.ReadTimeout:
+        # The worker accepted the request and keeps running the pipeline
+        pass
+
+
+class _JobProgress:
+    """RunStats listener that mirrors stage and progress into the job record."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.last_save = 0.0
+
+    def __call__(self, event, stats, **details):
+        now = time.monotonic()
+        if event == "progress" and now - self.last_save < PROGRESS_SAVE_INTERVAL:
+            return
+        self.last_save = now
+        _update_job(
+            self.job_id,
+            stage=stats.current_stage,
+            progress=dict(stats.progress_counts),
+        )
+
+
+def execute(job_id):
+    """
+    Run a queued job to completion and record its outcome.
+
+    Args:
+        job_id: The job ID
+
+    Returns:
+        dict: The final job record
+
+    Raises:
+        ValueError: If the job does not exist
+    """
+    job = get_job(job_id)
+    if not job:
+        raise ValueError(f"Unknown job: {job_id}")
+
+    stats = run_stats.RunStats()
+    stats.add_listener(_JobProgress(job_id))
+    _update_job(job_id, status="running", started_at=_now())
+
+    try:
+        with tracing.span("pipeline_job", traceparent=job.get("traceparent"), job_id=job_id):
+            summary = run_params(job.get("params") or {}, stats=stats, job_id=job_id)
+        return _update_job(
+            job_id,
+            status="succeeded",
+            finished_at=_now(),
+            stage=None,
+            progress=dict(stats.progress_counts),
+            summary=summary,
+        )
+    except run_lock.AlreadyRunning as e:
+        log(f"Pipeline job {job_id} not started: {e}")
+        return _update_job(
+            job_id,
+            status="already_running",
+            finished_at=_now(),
+            attached_job_id=e.holder.get("job_id"),
+            error=str(e),
+        )
+    except Exception as e:
+        error(f"Pipeline job {job_id} failed: {e}")
+        traceback.print_exc()
+        stats.finish()
+        return _update_job(
+            job_id,
+            status="failed",
+            finished_at=_now(),
+            progress=dict(stats.progress_counts),
+            summary=stats.summary(),
+            error=str(e),
+        )
@@ -0,0 +1,234 @@
+"""
+Incremental decoding of MyClub listing responses.
+
+Listing endpoints (events/, courses/) return a JSON array of wrapped objects,
+e.g. [{"event": {"id": 1, ...}}, ...], of which only a few fields are used.
+Instead of building the whole object tree with response.json(), the listing
+is decoded element by element from the byte stream and only the requested
+fields of each element are kept.
+
+Backends, fastest available first:
+- ijson: true streaming parser (C backend when available), only the
+  requested fields are materialised
+- orjson: parses the whole payload, but much faster than the stdlib
+- stdlib: incremental element-by-element json.JSONDecoder.raw_decode over
+  the byte stream
+
+LISTING_DECODER forces a backend ('ijson', 'orjson' or 'stdlib').
+"""
+import json
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+try:
+    import ijson
+except ImportError:  # pragma: no cover - optional dependency
+    ijson = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+# Bytes read from the response per chunk
+CHUNK_SIZE = 64 * 1024
+
+
+def available_backends():
+    """Return the installed decoder backends, fastest first."""
+    backends = []
+    if ijson is not None:
+        backends.append("ijson")
+    if orjson is not None:
+        backends.append("orjson")
+    backends.append("stdlib")
+    return backends
+
+
+def default_backend():
+    """Return the backend used when none is requested explicitly."""
+    forced = os.getenv("LISTING_DECODER")
+    if forced:
+        if forced not in available_backends():
+            raise ValueError(f"Listing decoder backend not available: {forced}")
+        return forced
+    return available_backends()[0]
+
+
+def _pick(item, key, fields, present_only=False):
+    data = item.get(key) if isinstance(item, dict) else None
+    if not data:
+        return None
+    if present_only:
+        return {field: data[field] for field in fields if field in data}
+    return {field: data.get(field) for field in fields}
+
+
+def _iter_stdlib(chunks):
+    """Yield the elements of a top-level JSON array from an iterable of byte chunks."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    started = False
+    ended = False
+    pending = b""
+
+    for chunk in chunks:
+        if ended:
+            break
+        if not chunk:
+            continue
+        # Decode UTF-8 without splitting multi-byte characters across chunks
+        data = pending + chunk
+        try:
+            text = data.decode("utf-8")
+            pending = b""
+        except UnicodeDecodeError as e:
+            text = data[:e.start].decode("utf-8")
+            pending = data[e.start:]
+        buffer = buffer[pos:] + text
+        pos = 0
+
+        while True:
+            # Skip whitespace and separators
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not started:
+                if buffer[pos] != "[":
+                    raise json.JSONDecodeError("Expected a JSON array", buffer, pos)
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                ended = True
+                break
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Element continues in the next chunk
+                break
+            yield item
+            pos = end
+
+    # A listing cut off after a complete element must not pass as a
+    # shorter listing (open_events would treat the rest as cancelled)
+    if not ended:
+        raise json.JSONDecodeError("Unterminated JSON array", buffer, pos)
+
+
+def iter_listing(chunks, key, fields, backend=None, present_only=False):
+    """
+    Decode a listing incrementally and yield the requested fields per element.
+
+    Args:
+        chunks: Iterable of byte chunks (e.g. response.iter_content()) or a
+                bytes object
+        key: Wrapper key of each element ('event', 'course', ...)
+        fields: Field names to keep from each wrapped object
+        backend: Decoder backend (default: default_backend())
+        present_only: Leave out fields missing from an object instead of
+                      setting them to None
+
+    Yields:
+        dict: {field: value} for every element that has the wrapper key
+
+    Raises:
+        json.JSONDecodeError: If the payload is not a valid JSON array
+    """
+    backend = backend or default_backend()
+    if isinstance(chunks, (bytes, bytearray)):
+        chunks = [bytes(chunks)]
+
+    if backend == "ijson":
+        try:
+            for item in ijson.items(_ChunkReader(chunks), "item"):
+                picked = _pick(item, key, fields, present_only)
+                if picked:
+                    yield picked
+        except ijson.JSONError as e:
+            raise json.JSONDecodeError(str(e), "", 0) from e
+    elif backend == "orjson":
+        try:
+            content = orjson.loads(b"".join(chunks))
+        except orjson.JSONDecodeError as e:
+            raise json.JSONDecodeError(str(e), "", 0) from e
+        if not isinstance(content, list):
+            raise json.JSONDecodeError("Expected a JSON array", "", 0)
+        for item in content:
+            picked = _pick(item, key, fields, present_only)
+            if picked:
+                yield picked
+    else:
+        for item in _iter_stdlib(chunks):
+            picked = _pick(item, key, fields, present_only)
+            if picked:
+                yield picked
+
+
+def iter_response(response, key, fields, backend=None, present_only=False):
+    """
+    Decode a streamed requests.Response listing (see iter_listing).
+
+    The request should be sent with stream=True so that the body is read
+    chunk by chunk instead of being downloaded up front.
+    """
+    return iter_listing(response.iter_content(chunk_size=CHUNK_SIZE), key, fields, backend, present_only)
+
+
+def listing_ids(response, key, backend=None):
+    """
+    Return the IDs of all elements of a listing response as strings.
+
+    Args:
+        response: requests.Response of a listing endpoint
+        key: Wrapper key of each element ('event', 'course', ...)
+        backend: Decoder backend (default: default_backend())
+
+    Returns:
+        list: ID strings
+    """
+    return [str(item["id"]) for item in iter_response(response, key, ("id",), backend)]
+
+
+def listing_objects(response, key, fields, backend=None):
+    """
+    Return the requested fields of all elements of a listing response.
+
+    Fields missing from an element are left out, so callers can tell
+    incomplete objects from null values.
+
+    Args:
+        response: requests.Response of a listing endpoint
+        key: Wrapper key of each element ('event', 'course', ...)
+        fields: Field names to keep
+        backend: Decoder backend (default: default_backend())
+
+    Returns:
+        list: dicts of the present fields
+    """
+    return list(iter_response(response, key, fields, backend, present_only=True))
+
+
+class _ChunkReader:
+    """File-like adapter over an iterable of byte chunks (for ijson)."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
@@ -1,6 +1,7 @@
 import requests
+import http_client
+import tenants
 import json
-import os
 from datetime import datetime
 from dotenv import load_dotenv
 from logger import error, log
@@ -19,19 +20,20 @@ def member(member_id):
         tuple: (member_dict, memberships_list) or (None, None) if member not found
 
     Raises:
-        ValueError: If MC_TOKEN is not set or API returns invalid data
+        ValueError: If MC_TOKEN is not set
+        http_client.NoDataReturned: If the API returns no member data
         requests.exceptions.RequestException: If API request fails
     """
-    myclub_token = os.getenv("MC_TOKEN")
+    myclub_token = tenants.token()
     if not myclub_token:
         raise ValueError("MC_TOKEN environment variable is required but not set")
 
     headers = {"X-myClub-token": myclub_token}
-    base_url = "https://ehms.myclub.fi/api/"
+    base_url = tenants.base_url()
     full_url = f"{base_url}members/{member_id}"
 
     try:
-        response = requests.get(full_url, headers=headers, timeout=30)
+        response = http_client.get(full_url, headers=headers, timeout=30)
 
         if response.status_code == 404:
             return (None, None)
@@ -41,7 +43,7 @@ def member(member_id):
 
         member_data = content.get("member")
         if not member_data:
-            raise ValueError(f"No member data returned for member_id {member_id}")
+            raise http_client.NoDataReturned(f"No member data returned for member_id {member_id}")
 
         # Extract date only from member_since (BigQuery DATE type)
         member_since_raw = member_data.get("created_at")
@@ -0,0 +1,117 @@
+"""
+Member freshness scheduling.
+
+Member profiles and memberships rarely change, so instead of re-fetching
+every member seen in a window's presences on every run, the time each member
+was last fetched (and uploaded) is tracked in the state store. A run only
+fetches members that are new or older than MEMBER_STALENESS_DAYS, plus a
+rolling refresh of the MEMBER_REFRESH_FRACTION least recently fetched members
+of the whole known roster, which bounds the cost per run.
+"""
+import datetime
+import math
+import os
+
+from dotenv import load_dotenv
+
+import metrics
+import state_store
+import tenants
+from logger import log
+
+load_dotenv()
+
+MEMBER_FRESHNESS = os.getenv("MEMBER_FRESHNESS", "true").lower() in ("true", "1", "yes")
+MEMBER_STALENESS_DAYS = float(os.getenv("MEMBER_STALENESS_DAYS", "30"))
+MEMBER_REFRESH_FRACTION = float(os.getenv("MEMBER_REFRESH_FRACTION", "0.05"))
+
+STATE_NAMESPACE = "member_freshness"
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def select_members(member_ids, now=None):
+    """
+    Choose which members need to be fetched in this run.
+
+    Args:
+        member_ids (list): Member IDs referenced by the run's presences
+        now (datetime.datetime): Current time (default: now, UTC)
+
+    Returns:
+        tuple: (member IDs to fetch, stats dict with 'new', 'stale',
+                'rolling' and 'fresh' counts)
+    """
+    if not MEMBER_FRESHNESS:
+        return list(member_ids), {"new": len(member_ids), "stale": 0, "rolling": 0, "fresh": 0}
+
+    now = now or _now()
+    cutoff = now - datetime.timedelta(days=MEMBER_STALENESS_DAYS)
+    last_fetched = state_store.load(tenants.scoped(STATE_NAMESPACE))
+
+    to_fetch = []
+    counts = {"new": 0, "stale": 0, "rolling": 0, "fresh": 0}
+    for member_id in member_ids:
+        fetched_at = last_fetched.get(member_id)
+        if fetched_at is None:
+            counts["new"] += 1
+            to_fetch.append(member_id)
+        elif datetime.datetime.fromisoformat(fetched_at) < cutoff:
+            counts["stale"] += 1
+            to_fetch.append(member_id)
+        else:
+            counts["fresh"] += 1
+
+    # Rolling refresh: re-validate the least recently fetched part of the roster
+    rolling_count = math.ceil(len(last_fetched) * MEMBER_REFRESH_FRACTION)
+    in_window = set(member_ids)
+    selected = set(to_fetch)
+    for member_id, _ in sorted(last_fetched.items(), key=lambda item: item[1]):
+        if counts["rolling"] >= rolling_count:
+            break
+        if member_id in selected:
+            continue
+        if member_id in in_window:
+            counts["fresh"] -= 1
+        to_fetch.append(member_id)
+        selected.add(member_id)
+        counts["rolling"] += 1
+
+    log(
+        f"Members: {counts['new']} new, {counts['stale']} stale, "
+        f"{counts['rolling']} rolling refresh, {counts['fresh']} fresh (skipped)"
+    )
+    metrics.CACHE_HITS.inc(counts["fresh"], cache="member_freshness")
+    return to_fetch, counts
+
+
+def mark_fetched(member_rows, now=None, downgraded=()):
+    """
+    Record that members were fetched and successfully uploaded.
+
+    Call after the upload so that a failed run does not mark members as fresh.
+
+    Args:
+        member_rows (list): Member row dictionaries that were uploaded
+        now (datetime.datetime): Fetch time to record (default: now, UTC)
+        downgraded: Tables merged insert-only (see
+                    bigquery_upload.upload_all_tables); if members or
+                    memberships are among them, the members' updates were
+                    dropped and they are not marked, so they are fetched again
+    """
+    if not MEMBER_FRESHNESS or not member_rows:
+        return
+    if {"members", "memberships"} & set(downgraded):
+        log("Members were merged insert-only, not marking them as fetched")
+        return
+
+    fetched_at = (now or _now()).isoformat()
+
+    def apply(last_fetched):
+        for row in member_rows:
+            last_fetched[row.get("member_id")] = fetched_at
+        return last_fetched
+
+    state_store.update(tenants.scoped(STATE_NAMESPACE), apply)
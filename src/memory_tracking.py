@@ -0,0 +1,208 @@
+"""
+Optional per-stage memory accounting.
+
+Enabled with MEMORY_TRACKING=rss (cheap RSS sampling) or
+MEMORY_TRACKING=tracemalloc (additionally traces Python allocations, which
+slows the run down noticeably), `--memory` on the CLI or `?memory=rss` on the
+HTTP trigger. A run_stats listener samples memory at every stage boundary
+(and on progress updates at most every MEMORY_SAMPLE_SECONDS) and records
+per stage:
+
+- the peak resident set size (RSS) seen while the stage was running
+- the peak traced Python allocations (tracemalloc mode)
+- the bytes held in memory by the row buffers of each table
+- the top MEMORY_TOP_N allocation sites at the end of the stage
+  (tracemalloc mode)
+
+The peak is reported against the function memory limit (FUNCTION_MEMORY_MB,
+set by the Cloud Functions runtime), and a warning is logged as soon as RSS
+exceeds MEMORY_WARN_FRACTION of it.
+"""
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+from dotenv import load_dotenv
+
+import row_buffer
+from logger import log, error
+
+load_dotenv()
+
+MEMORY_TRACKING_MODES = ("rss", "tracemalloc")
+FUNCTION_MEMORY_MB = int(os.getenv("FUNCTION_MEMORY_MB", "0")) or None
+MEMORY_WARN_FRACTION = float(os.getenv("MEMORY_WARN_FRACTION", "0.8"))
+MEMORY_TOP_N = int(os.getenv("MEMORY_TOP_N", "10"))
+MEMORY_SAMPLE_SECONDS = float(os.getenv("MEMORY_SAMPLE_SECONDS", "1.0"))
+
+MB = 1024 * 1024
+
+
+def mode(flag=None):
+    """
+    Return the requested tracking mode ('rss', 'tracemalloc') or None.
+
+    Args:
+        flag: Explicit request (CLI flag or query parameter), overrides the
+              MEMORY_TRACKING environment variable when not None; 'true'/'1'
+              select rss mode
+    """
+    value = str(flag if flag is not None else os.getenv("MEMORY_TRACKING", "")).lower()
+    if value in ("true", "1", "yes"):
+        return "rss"
+    return value if value in MEMORY_TRACKING_MODES else None
+
+
+def current_rss():
+    """Return the current resident set size in bytes (peak RSS if unavailable)."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Return the peak resident set size of the process in bytes."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _mb(value):
+    return round(value / MB, 1)
+
+
+class MemoryTracker:
+    """RunStats listener recording memory usage per stage."""
+
+    def __init__(self, tracking_mode="rss", limit_mb=None):
+        self.tracemalloc = tracking_mode == "tracemalloc"
+        self.limit_mb = limit_mb or FUNCTION_MEMORY_MB
+        self.stages = {}
+        self.peak = 0
+        self.peak_stage = None
+        self.warned = False
+        self.last_sample = 0.0
+        self.started_tracemalloc = False
+        self.finished = False
+        if self.tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+    def _stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {"peak_rss_mb": 0.0}
+        return self.stages[name]
+
+    def sample(self, stats, ending_stage=None):
+        """Attribute the memory since the last sample to all running stages."""
+        rss = current_rss()
+        open_stages = list(stats.stage_stack) + ([ending_stage] if ending_stage else [])
+        open_stages = open_stages or ["(run)"]
+        traced_peak = None
+        if self.tracemalloc:
+            _, traced_peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+
+        for name in open_stages:
+            entry = self._stage(name)
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"], _mb(rss))
+            if traced_peak is not None:
+                entry["traced_peak_mb"] = max(entry.get("traced_peak_mb", 0.0), _mb(traced_peak))
+
+        if rss > self.peak:
+            self.peak = rss
+            self.peak_stage = open_stages[-1]
+        self._check_limit(rss, open_stages[-1])
+        self.last_sample = time.monotonic()
+
+    def _check_limit(self, rss, stage):
+        if self.warned or not self.limit_mb:
+            return
+        if rss >= self.limit_mb * MB * MEMORY_WARN_FRACTION:
+            self.warned = True
+            error(
+                f"WARNING: memory at {_mb(rss)} MB during stage {stage}, "
+                f"{rss / (self.limit_mb * MB):.0%} of the {self.limit_mb} MB function limit"
+            )
+
+    def _stage_end(self, stats, name):
+        entry = self._stage(name)
+        entry["tables_mb"] = {
+            table_name: _mb(size) for table_name, size in sorted(row_buffer.memory_by_table().items())
+        }
+        if self.tracemalloc:
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ))
+            entry["top_allocations"] = [
+                {"site": str(stat.traceback), "size_mb": _mb(stat.size), "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:MEMORY_TOP_N]
+            ]
+
+    def __call__(self, event, stats, **details):
+        if event == "stage_start":
+            self.sample(stats)
+        elif event == "stage_end":
+            # The stage has already been popped from the stack
+            self.sample(stats, ending_stage=details["stage"])
+            self._stage_end(stats, details["stage"])
+        elif event == "progress":
+            if time.monotonic() - self.last_sample >= MEMORY_SAMPLE_SECONDS:
+                self.sample(stats)
+        elif event == "finish":
+            self.finish(stats)
+
+    def report(self):
+        """Return the JSON-serialisable memory report."""
+        peak = max(self.peak, peak_rss())
+        report = {
+            "mode": "tracemalloc" if self.tracemalloc else "rss",
+            "peak_rss_mb": _mb(peak),
+            "peak_stage": self.peak_stage,
+            "limit_mb": self.limit_mb,
+            "stages": self.stages,
+        }
+        if self.limit_mb:
+            report["peak_fraction_of_limit"] = round(peak / (self.limit_mb * MB), 3)
+        return report
+
+    def finish(self, stats):
+        """Store the report in the run's stats and log it."""
+        if self.finished:
+            return
+        self.finished = True
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+        report = self.report()
+        stats.extra["memory"] = report
+        limit = f" of {self.limit_mb} MB limit" if self.limit_mb else ""
+        log(f"Peak memory: {report['peak_rss_mb']} MB{limit} (stage {report['peak_stage']})")
+        for name, entry in self.stages.items():
+            tables = ", ".join(f"{t}={mb}MB" for t, mb in entry.get("tables_mb", {}).items() if mb)
+            traced = f", traced peak {entry['traced_peak_mb']} MB" if "traced_peak_mb" in entry else ""
+            log(f"  {name:<12} peak RSS {entry['peak_rss_mb']:>8} MB{traced}" + (f" [{tables}]" if tables else ""))
+
+
+def attach(stats, tracking_mode="rss", limit_mb=None):
+    """
+    Start tracking memory for a run.
+
+    Args:
+        stats (run_stats.RunStats): The run's stats collector
+        tracking_mode: 'rss' or 'tracemalloc'
+        limit_mb: Function memory limit (default: FUNCTION_MEMORY_MB)
+
+    Returns:
+        MemoryTracker: The registered listener; its report is stored in
+                       stats.extra['memory'] when the run finishes
+    """
+    tracker = MemoryTracker(tracking_mode, limit_mb)
+    stats.add_listener(tracker)
+    tracker.sample(stats)
+    return tracker
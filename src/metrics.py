@@ -0,0 +1,303 @@
+"""
+In-process metrics registry with OpenMetrics text exposition.
+
+Collected metrics:
+- myclub_requests_total{tenant,endpoint,status}: MyClub API requests (http_client)
+- myclub_request_duration_seconds{endpoint}: MyClub API latency histogram
+- pipeline_retries_total{kind}: quarantined entities retried
+- pipeline_cache_hits_total{cache}: lookups answered without an API request
+  (e.g. members skipped by member_freshness, cached metadata)
+- pipeline_rows_fetched_total{tenant,table} / pipeline_rows_merged_total{tenant,table}
+- bigquery_job_duration_seconds{job_type}: BigQuery job latency histogram
+- bigquery_bytes_processed_total{job_type}
+- bigquery_bytes_estimated_total{job_type} / bigquery_bytes_billed_total{job_type}:
+  dry-run estimates and billed bytes of queries run under the cost guard
+- pipeline_stage_duration_seconds{stage}: run_stats stage durations
+- pipeline_resources_total{resource,outcome}: process-level resource
+  lookups (created, reused, rebuilt, cache hit/miss; see resources)
+- pipeline_runs_total{tenant} / pipeline_last_run_timestamp_seconds{tenant}
+- pipeline_tenant_failures_total{tenant}: failed club runs (tenant_runs)
+- pipeline_run_lock_conflicts_total{tenant}: runs refused because another
+  run held the lock (run_lock)
+
+Endpoint labels are URL paths with numeric IDs replaced by ':id' to keep the
+number of series bounded. The tenant label is the active club (see tenants),
+'default' for single-club deployments. The registry is exposed by the `metrics` HTTP entry
+point in main.py and, when PUSHGATEWAY_URL is set, pushed to a
+Prometheus pushgateway-compatible sink at the end of every run. Each Cloud
+Functions instance keeps its own registry, so prefer the push for scheduled
+runs.
+"""
+import bisect
+import os
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from dotenv import load_dotenv
+
+import run_stats
+import tenants
+from logger import error
+
+load_dotenv()
+
+PUSHGATEWAY_URL = os.getenv("PUSHGATEWAY_URL")
+PUSHGATEWAY_JOB = os.getenv("PUSHGATEWAY_JOB", "ehms_myclub_pipeline")
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base class of labelled metrics."""
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple((name, str(labels[name])) for name in self.labelnames)
+
+    def samples(self):
+        """Yield (suffix, labels, value) tuples."""
+        raise NotImplementedError
+
+    def expose(self):
+        lines = [
+            f"# TYPE {self.name} {self.metric_type}",
+            f"# HELP {self.name} {self.documentation}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing counter."""
+
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in sorted(items):
+            yield "_total", key, value
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in sorted(items):
+            yield "", key, value
+
+
+class Histogram(_Metric):
+    """Cumulative histogram with fixed buckets."""
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            items = [(key, (list(counts), total)) for key, (counts, total) in self.values.items()]
+        for key, (counts, total) in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", key + (("le", _format_value(float(bound))),), cumulative
+            yield "_count", key, cumulative
+            yield "_sum", key, total
+
+
+class Registry:
+    """Collection of metrics exposed together."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def expose(self):
+        """Return the registry in the OpenMetrics text format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    "myclub_requests", "MyClub API requests by tenant, endpoint and HTTP status", ("tenant", "endpoint", "status"))
+REQUEST_DURATION = REGISTRY.histogram(
+    "myclub_request_duration_seconds", "MyClub API request latency", ("endpoint",))
+RETRIES = REGISTRY.counter(
+    "pipeline_retries", "Quarantined entities retried", ("kind",))
+CACHE_HITS = REGISTRY.counter(
+    "pipeline_cache_hits", "Lookups answered without an API request", ("cache",))
+ROWS_FETCHED = REGISTRY.counter(
+    "pipeline_rows_fetched", "Rows extracted per table", ("tenant", "table"))
+ROWS_MERGED = REGISTRY.counter(
+    "pipeline_rows_merged", "Rows written to BigQuery per table", ("tenant", "table"))
+BIGQUERY_JOB_DURATION = REGISTRY.histogram(
+    "bigquery_job_duration_seconds", "BigQuery job latency", ("job_type",))
+BIGQUERY_BYTES_PROCESSED = REGISTRY.counter(
+    "bigquery_bytes_processed", "Bytes processed by BigQuery jobs", ("job_type",))
+BIGQUERY_BYTES_ESTIMATED = REGISTRY.counter(
+    "bigquery_bytes_estimated", "Bytes estimated by dry runs of executed queries", ("job_type",))
+BIGQUERY_BYTES_BILLED = REGISTRY.counter(
+    "bigquery_bytes_billed", "Bytes billed for queries run under the cost guard", ("job_type",))
+STAGE_DURATION = REGISTRY.histogram(
+    "pipeline_stage_duration_seconds", "Pipeline stage durations", ("stage",))
+RESOURCES = REGISTRY.counter(
+    "pipeline_resources", "Process-level resource lookups by outcome", ("resource", "outcome"))
+RUNS = REGISTRY.counter(
+    "pipeline_runs", "Finished pipeline runs", ("tenant",))
+LAST_RUN = REGISTRY.gauge(
+    "pipeline_last_run_timestamp_seconds", "Unix time the last pipeline run finished", ("tenant",))
+TENANT_FAILURES = REGISTRY.counter(
+    "pipeline_tenant_failures", "Failed club runs", ("tenant",))
+RUN_LOCK_CONFLICTS = REGISTRY.counter(
+    "pipeline_run_lock_conflicts", "Runs refused because another run held the lock", ("tenant",))
+
+
+def endpoint_label(url):
+    """Return the URL path with numeric IDs replaced by ':id'."""
+    return _ID_SEGMENT.sub("/:id", urlparse(url).path) or "/"
+
+
+def observe_request(url, status, seconds):
+    """Record a MyClub API request (status is the HTTP status or 'error')."""
+    endpoint = endpoint_label(url)
+    REQUESTS.inc(tenant=tenants.name(), endpoint=endpoint, status=status)
+    REQUEST_DURATION.observe(seconds, endpoint=endpoint)
+
+
+def observe_bigquery_job(job_type, job, seconds):
+    """Record a finished BigQuery job."""
+    BIGQUERY_JOB_DURATION.observe(seconds, job_type=job_type)
+    BIGQUERY_BYTES_PROCESSED.inc(getattr(job, "total_bytes_processed", None) or 0, job_type=job_type)
+
+
+def observe_rows_merged(table_name, count):
+    """Record rows written to a BigQuery table."""
+    ROWS_MERGED.inc(count, tenant=tenants.name(), table=table_name)
+
+
+def run_bigquery_job(job_type, job):
+    """Wait for a BigQuery job, record it and return its result."""
+    started = time.perf_counter()
+    try:
+        return job.result()
+    finally:
+        observe_bigquery_job(job_type, job, time.perf_counter() - started)
+
+
+def push(url=None, job=None):
+    """
+    Push the registry to a pushgateway-compatible sink.
+
+    Args:
+        url: Base URL of the sink (default: PUSHGATEWAY_URL)
+        job: Job label of the pushed group (default: PUSHGATEWAY_JOB)
+    """
+    url = url or PUSHGATEWAY_URL
+    if not url:
+        return
+    response = requests.put(
+        f"{url.rstrip('/')}/metrics/job/{job or PUSHGATEWAY_JOB}",
+        data=REGISTRY.expose().encode("utf-8"),
+        headers={"Content-Type": CONTENT_TYPE},
+        timeout=10,
+    )
+    response.raise_for_status()
+
+
+def _run_listener(event, stats, **details):
+    """RunStats listener feeding stage durations and run totals."""
+    if event == "stage_end":
+        STAGE_DURATION.observe(details["seconds"], stage=details["stage"])
+    elif event == "finish":
+        for table_name, count in stats.rows.items():
+            ROWS_FETCHED.inc(count, tenant=tenants.name(), table=table_name)
+        RUNS.inc(tenant=tenants.name())
+        LAST_RUN.set(stats.finished_at, tenant=tenants.name())
+        try:
+            push()
+        except Exception as e:
+            error(f"Could not push metrics: {e}")
+
+
+run_stats.add_default_listener(_run_listener)
@@ -0,0 +1,265 @@
+"""
+Open-events tracking for incremental runs.
+
+Incremental windows start 7 days before the most recent event in BigQuery
+so that late changes to presences are picked up, which re-fetches every
+event of that buffer on every run although almost all of them are final.
+Instead, every fetched event is remembered in the state store with a
+fingerprint of its details and participations, and marked open while it
+may still change:
+
+- it was fetched for the first time or its fingerprint changed since the
+  previous fetch, or
+- it has unconfirmed participations, or no participations at all.
+
+Later runs still list the whole window (one cheap listing request per
+group), but of the listed events only new and open ones are fetched; known
+closed events are skipped. Open events that have fallen out of the window
+are fetched as well. Known events in the window that are no longer listed
+are reported as cancelled: after the upload, cleanup() deletes their events
+and presences rows from BigQuery and refreshes their attendance aggregate
+keys (see bigquery_upload.delete_events). They stay in the state, flagged,
+until that has succeeded, so a failed cleanup is retried by the next run,
+and are fetched again if they are listed again. Events older than
+OPEN_EVENTS_HORIZON_DAYS age out of the state and are never re-fetched.
+
+Disabled with OPEN_EVENTS=false. Without state (first run, new tenant) every
+listed event is fetched as before.
+"""
+import datetime
+import hashlib
+import json
+import os
+
+from dotenv import load_dotenv
+
+import attendance_aggregates
+import bigquery_upload
+import run_stats
+import state_store
+import tenants
+from logger import log, error
+
+load_dotenv()
+
+OPEN_EVENTS = os.getenv("OPEN_EVENTS", "true").lower() in ("true", "1", "yes")
+OPEN_EVENTS_HORIZON_DAYS = int(os.getenv("OPEN_EVENTS_HORIZON_DAYS", "30"))
+
+STATE_NAMESPACE = "open_events"
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _event_date(starts_at):
+    if not starts_at:
+        return None
+    return datetime.datetime.fromisoformat(str(starts_at)).date()
+
+
+def _within_horizon(entry, horizon, today):
+    # Cancelled events are kept until their rows have been deleted
+    return entry.get("cancelled") or (_event_date(entry.get("starts_at")) or today) >= horizon
+
+
+def fingerprint(event_row, participations):
+    """
+    Return a content fingerprint of an event and its participations.
+
+    Args:
+        event_row (dict): Event row (see event.event)
+        participations (list): (member_id, confirmed) tuples of the event
+    """
+    content = json.dumps(
+        [sorted(event_row.items()), sorted(participations)], default=str, separators=(",", ":")
+    )
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+class OpenEventsTracker:
+    """
+    Chooses which listed events to fetch and records the fetched ones.
+
+    Passed to get_all_presences.get_all_presences_in_date_range as its
+    event_tracker; cleanup() and record() must only be called once the run's
+    rows have been uploaded.
+    """
+
+    def __init__(self, start, end, events=None, today=None):
+        self.start = start
+        self.end = end
+        self.today = today or _now().date()
+        self.horizon = self.today - datetime.timedelta(days=OPEN_EVENTS_HORIZON_DAYS)
+        self.events = {
+            event_id: entry for event_id, entry in (events or {}).items()
+            if _within_horizon(entry, self.horizon, self.today)
+        }
+        self.summary = {
+            "tracked": len(self.events),
+            "listed": 0,
+            "new": 0,
+            "open": 0,
+            "skipped_closed": 0,
+            "open_outside_window": 0,
+            "cancelled": [],
+            "deleted": 0,
+        }
+        # Closed events skipped by select(); rows of them that reach record()
+        # were not fetched (e.g. built from the listing) and are ignored
+        self.skipped = set()
+
+    @classmethod
+    def load(cls, start, end):
+        """Create a tracker for a window from the active tenant's state."""
+        state = state_store.load(tenants.scoped(STATE_NAMESPACE))
+        return cls(start, end, state.get("events"))
+
+    def select(self, listed_ids, listed_groups=None):
+        """
+        Choose the events to fetch from a listing of the window.
+
+        Args:
+            listed_ids (list): Event IDs listed for the window
+            listed_groups (set): Groups whose listings are included (default:
+                                 all groups); known events of other groups
+                                 are never considered cancelled
+
+        Returns:
+            list: Event IDs to fetch
+        """
+        listed = set(listed_ids)
+        selected = []
+        for event_id in listed_ids:
+            entry = self.events.get(event_id)
+            if entry is None:
+                self.summary["new"] += 1
+                selected.append(event_id)
+            elif entry.get("cancelled"):
+                # Listed again before its rows were deleted
+                self.summary["new"] += 1
+                del self.events[event_id]
+                selected.append(event_id)
+            elif entry.get("open"):
+                self.summary["open"] += 1
+                selected.append(event_id)
+            else:
+                self.summary["skipped_closed"] += 1
+                self.skipped.add(event_id)
+
+        for event_id, entry in list(self.events.items()):
+            if event_id in listed or entry.get("cancelled"):
+                continue
+            event_date = _event_date(entry.get("starts_at"))
+            group_listed = listed_groups is None or entry.get("group_id") in listed_groups
+            if group_listed and event_date is not None and self.start < event_date < self.end:
+                # Known event of the window that is no longer listed (the
+                # boundary days are left out in case a bound is exclusive)
+                self.summary["cancelled"].append(event_id)
+                entry["cancelled"] = True
+            elif entry.get("open"):
+                self.summary["open_outside_window"] += 1
+                selected.append(event_id)
+
+        self.summary["listed"] = len(listed)
+        if self.summary["cancelled"]:
+            log(f"{len(self.summary['cancelled'])} known events are no longer listed (cancelled)")
+        log(
+            f"Open events: fetching {len(selected)} of {len(listed)} listed events "
+            f"({self.summary['skipped_closed']} closed events skipped)"
+        )
+        run_stats.current().extra["open_events"] = self.summary
+        return selected
+
+    def cleanup(self, client=None):
+        """
+        Delete the rows of cancelled events from BigQuery.
+
+        Must be called after the upload and before record(). Failures are
+        logged and the events stay flagged for the next run.
+
+        Args:
+            client: BigQuery client instance (default: a new client)
+        """
+        cancelled = sorted(event_id for event_id, entry in self.events.items() if entry.get("cancelled"))
+        if not cancelled:
+            return
+        # The recorded group and start keep the aggregate keys refreshable
+        # once a failed attempt has already deleted the event rows
+        event_keys = [
+            attendance_aggregates.event_key(
+                event_id, self.events[event_id].get("group_id"), self.events[event_id].get("starts_at")
+            )
+            for event_id in cancelled
+        ]
+        try:
+            bigquery_upload.delete_events(
+                cancelled, client=client, event_keys=[key for key in event_keys if key]
+            )
+        except Exception as e:
+            error(f"Could not delete {len(cancelled)} cancelled events, retrying next run: {e}")
+            return
+        for event_id in cancelled:
+            del self.events[event_id]
+        self.summary["deleted"] = len(cancelled)
+
+    def record(self, event_rows, presence_rows, keep_open=False):
+        """
+        Update fingerprints and open flags from the fetched rows and save them.
+
+        Args:
+            event_rows: Event rows of the run (rows of skipped events are ignored)
+            presence_rows: Fetched presence rows
+            keep_open: Mark every recorded event open, e.g. when events or
+                       presences were merged insert-only and their updates
+                       must be fetched and merged again
+        """
+        participations = {}
+        for presence in presence_rows:
+            participations.setdefault(presence["event_id"], []).append(
+                (presence["member_id"], bool(presence.get("confirmed")))
+            )
+
+        now = _now().isoformat()
+        changed = 0
+        for event_row in event_rows:
+            event_id = event_row["event_id"]
+            if event_id in self.skipped:
+                continue
+            event_participations = participations.get(event_id, [])
+            new_fingerprint = fingerprint(event_row, event_participations)
+            previous = self.events.get(event_id)
+            is_changed = previous is None or previous.get("fingerprint") != new_fingerprint
+            changed += is_changed
+            self.events[event_id] = {
+                "fingerprint": new_fingerprint,
+                "starts_at": event_row.get("starts_at"),
+                "group_id": event_row.get("group_id"),
+                "open": (
+                    keep_open
+                    or is_changed
+                    or not event_participations
+                    or not all(confirmed for _, confirmed in event_participations)
+                ),
+                "checked_at": now,
+                "changed_at": now if is_changed else previous.get("changed_at"),
+            }
+
+        # Events older than the horizon are final
+        self.events = {
+            event_id: entry for event_id, entry in self.events.items()
+            if _within_horizon(entry, self.horizon, self.today)
+        }
+        self.summary["changed"] = changed
+        self.summary["tracked"] = len(self.events)
+        self.summary["still_open"] = sum(
+            1 for entry in self.events.values() if entry.get("open") and not entry.get("cancelled")
+        )
+        state_store.save(tenants.scoped(STATE_NAMESPACE), {"events": self.events})
+
+
+def tracker(start, end):
+    """Return an OpenEventsTracker for the window, or None if disabled."""
+    if not OPEN_EVENTS:
+        return None
+    return OpenEventsTracker.load(start, end)
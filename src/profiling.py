@@ -0,0 +1,251 @@
+"""
+Opt-in CPU profiling of pipeline runs.
+
+Enabled with PROFILE=true, `--profile` on the CLI or `?profile=1` on the HTTP
+trigger. The run is wrapped in the deterministic cProfile profiler with one
+profile per pipeline stage (the profiler is switched whenever a run_stats
+stage starts or ends), which yields a per-stage breakdown:
+
+- listing: group listings (events_in_group / courses_in_group)
+- detail_fetch: time spent in MyClub requests of the detail stages
+- transform: the rest of the detail stages (JSON decoding, row building)
+- validation / merge: the BigQuery phases (staging / swap in rebuild mode)
+
+The combined and per-stage profiles are saved as .prof files to
+PROFILE_OUTPUT (a local directory or a gs://bucket/prefix path, which needs
+google-cloud-storage), and the top PROFILE_TOP_N functions are logged.
+"""
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import tempfile
+
+from dotenv import load_dotenv
+
+import run_stats
+from logger import log, error
+
+load_dotenv()
+
+PROFILE_OUTPUT = os.getenv("PROFILE_OUTPUT", os.path.join(tempfile.gettempdir(), "ehms_profiles"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "20"))
+
+# Breakdown category of each run_stats stage
+STAGE_CATEGORIES = {
+    "listing": "listing",
+    "events": "detail_fetch",
+    "courses": "detail_fetch",
+    "members": "detail_fetch",
+    "metadata": "detail_fetch",
+    "validation": "validation",
+    "staging": "validation",
+    "merge": "merge",
+    "swap": "merge",
+}
+
+# Stages whose non-network time is reported as transform
+DETAIL_STAGES = {"events", "courses", "members", "metadata"}
+
+# Time outside any stage
+ROOT_STAGE = "(run)"
+
+
+def enabled(flag=None):
+    """
+    Return True if profiling is requested.
+
+    Args:
+        flag: Explicit request (e.g. CLI flag or query parameter), overrides
+              the PROFILE environment variable when not None
+    """
+    if flag is not None:
+        return str(flag).lower() in ("true", "1", "yes")
+    return os.getenv("PROFILE", "").lower() in ("true", "1", "yes")
+
+
+class StageProfiler:
+    """
+    RunStats listener keeping one cProfile profile per stage.
+
+    Only one profiler can be active at a time, so entering a stage pauses the
+    enclosing stage's profiler and leaving it resumes it again.
+    """
+
+    def __init__(self):
+        self.profiles = {}
+        self.stack = []
+
+    def _profile(self, stage):
+        if stage not in self.profiles:
+            self.profiles[stage] = cProfile.Profile()
+        return self.profiles[stage]
+
+    def start(self):
+        """Start profiling the time outside of any stage."""
+        profile = self._profile(ROOT_STAGE)
+        self.stack.append(profile)
+        profile.enable()
+
+    def stop(self):
+        """Stop profiling."""
+        while self.stack:
+            self.stack.pop().disable()
+
+    def __call__(self, event, stats, **details):
+        if not self.stack:
+            return
+        if event == "stage_start":
+            self.stack[-1].disable()
+            profile = self._profile(details["stage"])
+            self.stack.append(profile)
+            profile.enable()
+        elif event == "stage_end":
+            self.stack.pop().disable()
+            if self.stack:
+                self.stack[-1].enable()
+
+    def stage_stats(self):
+        """Return pstats.Stats per stage."""
+        return {
+            stage: pstats.Stats(profile)
+            for stage, profile in self.profiles.items()
+            if profile.getstats()
+        }
+
+    def combined_stats(self):
+        """Return pstats.Stats of all stages combined."""
+        combined = None
+        for stats in self.stage_stats().values():
+            if combined is None:
+                combined = stats
+            else:
+                combined.add(stats)
+        return combined
+
+
+def _request_seconds(stats):
+    """Cumulative time spent inside http_client.get in a profile."""
+    total = 0.0
+    for (filename, _, name), (_, _, _, cumtime, _) in stats.stats.items():
+        if name == "get" and os.path.basename(filename) == "http_client.py":
+            total += cumtime
+    return total
+
+
+def breakdown(stage_stats):
+    """
+    Compute the per-category time breakdown of a profiled run.
+
+    Args:
+        stage_stats (dict): stage name -> pstats.Stats
+
+    Returns:
+        dict: category -> seconds (exclusive of nested stages)
+    """
+    result = {}
+    for stage, stats in stage_stats.items():
+        seconds = stats.total_tt
+        category = STAGE_CATEGORIES.get(stage, "other")
+        if stage in DETAIL_STAGES:
+            network = min(_request_seconds(stats), seconds)
+            result["detail_fetch"] = result.get("detail_fetch", 0.0) + network
+            result["transform"] = result.get("transform", 0.0) + seconds - network
+        else:
+            result[category] = result.get(category, 0.0) + seconds
+    return {category: round(seconds, 3) for category, seconds in result.items()}
+
+
+def top_functions(stats, limit=None):
+    """Return the top functions by cumulative time as printable text."""
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit or PROFILE_TOP_N)
+    return stream.getvalue()
+
+
+def _upload_to_bucket(local_path, destination):
+    from google.cloud import storage
+
+    bucket_name, _, prefix = destination[len("gs://"):].partition("/")
+    blob_name = f"{prefix.rstrip('/')}/{os.path.basename(local_path)}".lstrip("/")
+    storage.Client().bucket(bucket_name).blob(blob_name).upload_from_filename(local_path)
+    return f"gs://{bucket_name}/{blob_name}"
+
+
+def save(profiler, output=None):
+    """
+    Save the combined and per-stage profiles.
+
+    Args:
+        profiler (StageProfiler): The finished profiler
+        output: Local directory or gs:// path (default: PROFILE_OUTPUT)
+
+    Returns:
+        list: Paths (or gs:// URIs) of the saved .prof files
+    """
+    output = output or PROFILE_OUTPUT
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    local_dir = tempfile.mkdtemp(prefix="ehms_profile_") if output.startswith("gs://") else output
+    os.makedirs(local_dir, exist_ok=True)
+
+    files = []
+    combined = profiler.combined_stats()
+    if combined is not None:
+        path = os.path.join(local_dir, f"run-{timestamp}.prof")
+        combined.dump_stats(path)
+        files.append(path)
+    for stage, stats in profiler.stage_stats().items():
+        safe_stage = stage.strip("()")
+        path = os.path.join(local_dir, f"run-{timestamp}-{safe_stage}.prof")
+        stats.dump_stats(path)
+        files.append(path)
+
+    if output.startswith("gs://"):
+        files = [_upload_to_bucket(path, output) for path in files]
+    return files
+
+
+def profiled_call(fn, stats=None, output=None, **kwargs):
+    """
+    Run a pipeline function under the stage profiler.
+
+    Args:
+        fn: Pipeline function accepting a `stats` keyword (e.g. initialise.run)
+        stats (run_stats.RunStats): Stats collector for this run (default: new one)
+        output: Where to save the profiles (default: PROFILE_OUTPUT)
+        **kwargs: Arguments for fn
+
+    Returns:
+        dict: The run's summary with an added 'profile' entry holding the
+              per-stage breakdown and the saved profile paths
+    """
+    stats = stats or run_stats.RunStats()
+    profiler = StageProfiler()
+    stats.add_listener(profiler)
+
+    profiler.start()
+    try:
+        summary = fn(stats=stats, **kwargs)
+    finally:
+        profiler.stop()
+        profile_summary = {"breakdown": breakdown(profiler.stage_stats())}
+        try:
+            profile_summary["files"] = save(profiler, output)
+        except Exception as e:
+            error(f"Could not save profile: {e}")
+        stats.extra["profile"] = profile_summary
+
+        log("Profile breakdown (seconds):")
+        for category, seconds in profile_summary["breakdown"].items():
+            log(f"  {category:<14} {seconds:>10.3f}")
+        combined = profiler.combined_stats()
+        if combined is not None:
+            log(f"Top {PROFILE_TOP_N} functions by cumulative time:")
+            log(top_functions(combined))
+        if profile_summary.get("files"):
+            log(f"Profiles saved to: {', '.join(profile_summary['files'])}")
+
+    summary["profile"] = profile_summary
+    return summary
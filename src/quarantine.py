@@ -0,0 +1,191 @@
+"""
+Failure quarantine and retry queue for individual MyClub entities.
+
+When fetching a single event, course or member fails (HTTP error, timeout,
+malformed JSON), its ID is recorded in the state store together with the
+error and the number of attempts, and the run continues with the remaining
+entities. Quarantined IDs are retried by later runs with exponential
+backoff. If the share of failures in a fetch loop exceeds
+QUARANTINE_MAX_FAILURE_RATE (and more than QUARANTINE_MIN_FAILURES entities
+failed), the run is aborted as before.
+"""
+import datetime
+import json
+import os
+
+import requests
+from dotenv import load_dotenv
+
+import http_client
+import metrics
+import run_stats
+import state_store
+import tenants
+from logger import log, error
+
+load_dotenv()
+
+QUARANTINE_MAX_FAILURE_RATE = float(os.getenv("QUARANTINE_MAX_FAILURE_RATE", "0.05"))
+QUARANTINE_MIN_FAILURES = int(os.getenv("QUARANTINE_MIN_FAILURES", "5"))
+QUARANTINE_BACKOFF_MINUTES = float(os.getenv("QUARANTINE_BACKOFF_MINUTES", "60"))
+QUARANTINE_MAX_BACKOFF_DAYS = float(os.getenv("QUARANTINE_MAX_BACKOFF_DAYS", "7"))
+
+STATE_NAMESPACE = "quarantine"
+
+# Errors that quarantine an entity; anything else (e.g. a missing token)
+# still aborts the run.
+QUARANTINABLE_ERRORS = (
+    requests.exceptions.RequestException,
+    json.JSONDecodeError,
+    http_client.NoDataReturned,
+)
+
+
+class FailureRateExceeded(RuntimeError):
+    """Raised when too many entities of a fetch loop failed."""
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _key(kind, entity_id):
+    return f"{kind}:{entity_id}"
+
+
+def _run_summary():
+    return run_stats.current().extra.setdefault(
+        "quarantine", {"failed": [], "retried": 0, "recovered": 0, "total_quarantined": 0}
+    )
+
+
+def backoff(attempts):
+    """Delay before the next retry after `attempts` failed attempts."""
+    minutes = QUARANTINE_BACKOFF_MINUTES * 2 ** max(attempts - 1, 0)
+    return min(
+        datetime.timedelta(minutes=minutes),
+        datetime.timedelta(days=QUARANTINE_MAX_BACKOFF_DAYS),
+    )
+
+
+def record_failure(kind, entity_id, exc):
+    """
+    Quarantine an entity whose fetch failed.
+
+    Args:
+        kind (str): Entity kind ('event', 'course' or 'member')
+        entity_id: The entity ID
+        exc (Exception): The error raised by the fetch
+    """
+    now = _now()
+    key = _key(kind, entity_id)
+
+    def apply(quarantined):
+        entry = quarantined.get(key) or {
+            "kind": kind,
+            "entity_id": str(entity_id),
+            "attempts": 0,
+            "first_failed_at": now.isoformat(),
+        }
+        entry["attempts"] += 1
+        entry["error"] = f"{type(exc).__name__}: {exc}"
+        entry["last_failed_at"] = now.isoformat()
+        entry["next_retry_at"] = (now + backoff(entry["attempts"])).isoformat()
+        quarantined[key] = entry
+        return quarantined
+
+    quarantined = state_store.update(tenants.scoped(STATE_NAMESPACE), apply)
+    error(f"Quarantined {kind} {entity_id} (attempt {quarantined[key]['attempts']}): {exc}")
+
+    summary = _run_summary()
+    summary["failed"].append({"kind": kind, "entity_id": str(entity_id), "error": quarantined[key]["error"]})
+    summary["total_quarantined"] = len(quarantined)
+
+
+def release(kind, entity_ids):
+    """
+    Release entities from quarantine after successful fetches.
+
+    Args:
+        kind (str): Entity kind ('event', 'course' or 'member')
+        entity_ids (list): IDs fetched successfully in this run
+    """
+    keys = {_key(kind, entity_id) for entity_id in entity_ids}
+    if not keys & set(state_store.load(tenants.scoped(STATE_NAMESPACE))):
+        return
+
+    released = []
+
+    def apply(quarantined):
+        for key in keys & set(quarantined):
+            released.append(quarantined.pop(key)["entity_id"])
+        return quarantined
+
+    quarantined = state_store.update(tenants.scoped(STATE_NAMESPACE), apply)
+    log(f"Released {len(released)} {kind}(s) from quarantine")
+
+    summary = _run_summary()
+    summary["recovered"] += len(released)
+    summary["total_quarantined"] = len(quarantined)
+
+
+def due_for_retry(kind, now=None):
+    """
+    Return quarantined IDs of a kind whose backoff has elapsed.
+
+    Args:
+        kind (str): Entity kind ('event', 'course' or 'member')
+        now (datetime.datetime): Current time (default: now, UTC)
+
+    Returns:
+        list: Entity ID strings to retry in this run
+    """
+    now = now or _now()
+    due = [
+        entry["entity_id"]
+        for entry in state_store.load(tenants.scoped(STATE_NAMESPACE)).values()
+        if entry["kind"] == kind and datetime.datetime.fromisoformat(entry["next_retry_at"]) <= now
+    ]
+    if due:
+        log(f"Retrying {len(due)} quarantined {kind}(s)")
+        _run_summary()["retried"] += len(due)
+        metrics.RETRIES.inc(len(due), kind=kind)
+    return due
+
+
+def check_failure_rate(kind, failed, total):
+    """
+    Abort the run if too many entities of a fetch loop failed.
+
+    Args:
+        kind (str): Entity kind
+        failed (int): Number of failed fetches so far
+        total (int): Number of entities the loop fetches
+
+    Raises:
+        FailureRateExceeded: If failed exceeds both QUARANTINE_MIN_FAILURES and
+                             QUARANTINE_MAX_FAILURE_RATE of total
+    """
+    if failed > QUARANTINE_MIN_FAILURES and failed > QUARANTINE_MAX_FAILURE_RATE * total:
+        raise FailureRateExceeded(
+            f"{failed} of {total} {kind} fetches failed, above the "
+            f"{QUARANTINE_MAX_FAILURE_RATE:.0%} failure-rate threshold"
+        )
+
+
+def quarantined_entities():
+    """Return all quarantined entries."""
+    return list(state_store.load(tenants.scoped(STATE_NAMESPACE)).values())
+
+
+def report():
+    """
+    Add the quarantine state to the current run's summary and return it.
+
+    Returns:
+        dict: Failures, retries and recoveries of this run plus the total
+              number of quarantined entities
+    """
+    summary = _run_summary()
+    summary["total_quarantined"] = len(state_store.load(tenants.scoped(STATE_NAMESPACE)))
+    return summary
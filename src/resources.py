@@ -0,0 +1,196 @@
+"""
+Process-level registry of expensive resources reused across invocations.
+
+Cloud Functions keeps module state alive between warm invocations of the
+same instance, so the BigQuery credentials and client, the pooled HTTP
+session and small metadata lookups (groups, categories, venues) are built
+lazily once per instance and handed out to every later run:
+
+- Owners register a factory, and optionally a health check and a close
+  function, under a name (e.g. bigquery_upload registers 'bigquery_client').
+- `get(name)` builds the resource on first use. A resource that has been
+  idle for RESOURCE_HEALTH_CHECK_SECONDS is health-checked before it is
+  handed out again and rebuilt if the check fails.
+- `cached(name, fn)` memoises metadata lookups per tenant for
+  METADATA_CACHE_SECONDS (0 disables the cache).
+
+Every lookup is counted as created, reused, rebuilt or a cache hit/miss, in
+the metrics registry (pipeline_resources_total) and in the 'resources' entry
+of each run's summary.
+"""
+import copy
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import metrics
+import run_stats
+import tenants
+from logger import log, error
+
+load_dotenv()
+
+RESOURCE_HEALTH_CHECK_SECONDS = float(os.getenv("RESOURCE_HEALTH_CHECK_SECONDS", "300"))
+METADATA_CACHE_SECONDS = float(os.getenv("METADATA_CACHE_SECONDS", "300"))
+
+
+class Registry:
+    """Lazily built, health-checked resources shared by the whole process."""
+
+    def __init__(self):
+        self.factories = {}
+        self.resources = {}
+        self.last_checked = {}
+        self.counts = {}
+        self.lock = threading.RLock()
+        self.created_at = time.time()
+
+    def register(self, name, factory, health_check=None, close=None):
+        """
+        Register how to build a resource.
+
+        Args:
+            name: Resource name
+            factory: Callable returning a new instance
+            health_check: Callable receiving the instance and returning False
+                          (or raising) if it must be rebuilt
+            close: Callable receiving an instance that is discarded
+        """
+        with self.lock:
+            self.factories[name] = (factory, health_check, close)
+
+    def _count(self, name, outcome):
+        counts = self.counts.setdefault(name, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+        metrics.RESOURCES.inc(resource=name, outcome=outcome)
+
+    def _healthy(self, name, resource, health_check):
+        try:
+            return health_check(resource) is not False
+        except Exception as e:
+            error(f"Health check of {name} failed: {e}")
+            return False
+
+    def get(self, name):
+        """
+        Return the shared instance of a resource, building it if needed.
+
+        Raises:
+            KeyError: If no factory is registered under `name`
+        """
+        with self.lock:
+            factory, health_check, close = self.factories[name]
+            now = time.monotonic()
+            if name in self.resources:
+                resource = self.resources[name]
+                idle = now - self.last_checked.get(name, now)
+                if health_check is None or idle < RESOURCE_HEALTH_CHECK_SECONDS:
+                    self.last_checked[name] = now
+                    self._count(name, "reused")
+                    return resource
+                if self._healthy(name, resource, health_check):
+                    self.last_checked[name] = now
+                    self._count(name, "reused")
+                    return resource
+                log(f"Rebuilding {name} after a failed health check")
+                self._discard(name, close)
+                outcome = "rebuilt"
+            else:
+                outcome = "created"
+
+            resource = factory()
+            self.resources[name] = resource
+            self.last_checked[name] = now
+            self._count(name, outcome)
+            return resource
+
+    def _discard(self, name, close):
+        resource = self.resources.pop(name)
+        self.last_checked.pop(name, None)
+        if close is not None:
+            try:
+                close(resource)
+            except Exception as e:
+                error(f"Could not close {name}: {e}")
+
+    def reset(self, name=None):
+        """Discard one resource (or all of them); the next get() rebuilds it."""
+        with self.lock:
+            for resource_name in [name] if name else list(self.resources):
+                if resource_name in self.resources:
+                    self._discard(resource_name, self.factories[resource_name][2])
+
+    def snapshot(self):
+        """Return the lookup counts per resource and the instance age."""
+        with self.lock:
+            return {
+                "instance_age_seconds": round(time.time() - self.created_at, 3),
+                "counts": {name: dict(counts) for name, counts in self.counts.items()},
+            }
+
+
+REGISTRY = Registry()
+
+
+def register(name, factory, health_check=None, close=None):
+    """Register a resource factory on the process registry (see Registry.register)."""
+    REGISTRY.register(name, factory, health_check, close)
+
+
+def get(name):
+    """Return the shared instance of a registered resource."""
+    return REGISTRY.get(name)
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def cached(name, fn, ttl=None):
+    """
+    Return fn() from the per-tenant metadata cache.
+
+    Callers receive a copy, so they can't modify the cached value.
+
+    Args:
+        name: Cache entry name (e.g. 'groups')
+        fn: Callable computing the value on a miss
+        ttl: Seconds the value stays valid (default: METADATA_CACHE_SECONDS)
+    """
+    ttl = METADATA_CACHE_SECONDS if ttl is None else ttl
+    if ttl <= 0:
+        return fn()
+
+    key = (tenants.name(), name)
+    now = time.monotonic()
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and now - entry[0] < ttl:
+            with REGISTRY.lock:
+                REGISTRY._count(f"cache.{name}", "hit")
+            metrics.CACHE_HITS.inc(cache=name)
+            return copy.deepcopy(entry[1])
+
+    value = fn()
+    with _cache_lock:
+        _cache[key] = (time.monotonic(), copy.deepcopy(value))
+    with REGISTRY.lock:
+        REGISTRY._count(f"cache.{name}", "miss")
+    return value
+
+
+def clear_cache():
+    """Drop all cached metadata."""
+    with _cache_lock:
+        _cache.clear()
+
+
+def _run_listener(event, stats, **details):
+    """Add the reuse counts to every run's summary."""
+    if event == "finish":
+        stats.extra["resources"] = REGISTRY.snapshot()
+
+
+run_stats.add_default_listener(_run_listener)
@@ -0,0 +1,190 @@
+"""
+Memory-bounded row buffers that spill to disk.
+
+A RowBuffer collects the rows of one table. Once the rows held in memory
+exceed the buffer's budget (ROW_BUFFER_MEMORY_MB), they are written to a
+compact NDJSON segment in a temporary directory and dropped from memory.
+Iterating a buffer streams the spilled segments followed by the in-memory
+tail, so peak memory stays flat regardless of the window size.
+"""
+import json
+import os
+import sys
+import tempfile
+import weakref
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROW_BUFFER_MEMORY_MB = float(os.getenv("ROW_BUFFER_MEMORY_MB", "32"))
+ROW_BUFFER_DIR = os.getenv("ROW_BUFFER_DIR") or None
+
+# Number of rows used to estimate the in-memory size of a table's rows
+SIZE_SAMPLE_ROWS = 100
+
+# Buffers still alive, for memory reporting
+_live_buffers = weakref.WeakSet()
+
+
+def _row_size(row):
+    """Approximate in-memory size of a row dictionary in bytes."""
+    return sys.getsizeof(row) + sum(
+        sys.getsizeof(key) + sys.getsizeof(value) for key, value in row.items()
+    )
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class RowBuffer:
+    """
+    Append-only row container with a memory budget.
+
+    Supports len(), iteration and truthiness like the lists it replaces.
+    """
+
+    def __init__(self, table_name, memory_budget_mb=None, spill_dir=None):
+        self.table_name = table_name
+        self.memory_budget = int((memory_budget_mb or ROW_BUFFER_MEMORY_MB) * 1024 * 1024)
+        self.spill_dir = spill_dir or ROW_BUFFER_DIR
+        self.rows = []
+        self.segments = []
+        self.spilled_rows = 0
+        self._sampled_bytes = 0
+        self._sampled_rows = 0
+        self._finalizer = weakref.finalize(self, _remove_files, self.segments)
+        _live_buffers.add(self)
+
+    @classmethod
+    def from_segments(cls, table_name, paths):
+        """
+        Wrap existing NDJSON files as a buffer without reading them into memory.
+
+        The buffer takes ownership of the files: close() deletes them.
+
+        Args:
+            table_name: Table the rows belong to
+            paths (list): NDJSON files, one row per line
+        """
+        buffer = cls(table_name)
+        for path in paths:
+            with open(path, "rb") as f:
+                buffer.spilled_rows += sum(1 for line in f if line.strip())
+            buffer.segments.append(path)
+        return buffer
+
+    def __len__(self):
+        return self.spilled_rows + len(self.rows)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        for path in list(self.segments):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+        yield from list(self.rows)
+
+    def __repr__(self):
+        return (
+            f"RowBuffer({self.table_name!r}, rows={len(self)}, "
+            f"segments={len(self.segments)})"
+        )
+
+    @property
+    def bytes_per_row(self):
+        """Estimated in-memory size of one row, sampled from the first rows."""
+        if not self._sampled_rows:
+            return 0
+        return self._sampled_bytes / self._sampled_rows
+
+    @property
+    def memory_bytes(self):
+        """Estimated bytes held in memory by the buffered rows."""
+        return int(len(self.rows) * self.bytes_per_row)
+
+    def append(self, row):
+        """Add a row, spilling to disk if the memory budget is exceeded."""
+        if self._sampled_rows < SIZE_SAMPLE_ROWS:
+            self._sampled_bytes += _row_size(row)
+            self._sampled_rows += 1
+        self.rows.append(row)
+        if self.memory_bytes > self.memory_budget:
+            self.spill()
+
+    def extend(self, rows):
+        """Add several rows."""
+        for row in rows:
+            self.append(row)
+
+    def spill(self):
+        """Write the in-memory rows to a new NDJSON segment."""
+        if not self.rows:
+            return
+        fd, path = tempfile.mkstemp(
+            prefix=f"ehms_{self.table_name}_", suffix=".ndjson", dir=self.spill_dir
+        )
+        self.segments.append(path)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for row in self.rows:
+                f.write(json.dumps(row, separators=(",", ":")))
+                f.write("\n")
+        self.spilled_rows += len(self.rows)
+        self.rows = []
+
+    def segment_paths(self):
+        """Spill the in-memory tail and return all NDJSON segment paths."""
+        self.spill()
+        return list(self.segments)
+
+    def close(self):
+        """Delete the spilled segments and drop all rows."""
+        _remove_files(self.segments)
+        self.segments.clear()
+        self.rows = []
+        self.spilled_rows = 0
+
+
+def iter_chunks(rows, chunk_size):
+    """
+    Yield lists of at most chunk_size rows from a list or RowBuffer.
+
+    Args:
+        rows: List of row dictionaries or a RowBuffer
+        chunk_size (int): Maximum rows per chunk
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def close_all(data_dict):
+    """Release the spilled segments of every RowBuffer in a table dict."""
+    for rows in data_dict.values():
+        if isinstance(rows, RowBuffer):
+            rows.close()
+
+
+def memory_by_table():
+    """
+    Return the estimated bytes held in memory by live buffers, per table.
+
+    Returns:
+        dict: table name -> bytes of in-memory rows (spilled rows excluded)
+    """
+    usage = {}
+    for buffer in list(_live_buffers):
+        usage[buffer.table_name] = usage.get(buffer.table_name, 0) + buffer.memory_bytes
+    return usage
@@ -0,0 +1,371 @@
+"""
+Lease-based lock preventing overlapping pipeline runs.
+
+Cloud Scheduler retries and manual triggers can start a pipeline while
+another run for the same club is still going, doubling the MyClub API load
+and repeating the same MERGEs. Every run started through jobs.run_params
+therefore holds a lease on the active club (see tenants) for its whole
+duration:
+
+- the lease expires RUN_LOCK_LEASE_SECONDS after it was last renewed, so a
+  crashed or killed run never blocks the pipeline for longer than that
+- a heartbeat thread renews it every RUN_LOCK_HEARTBEAT_SECONDS
+- a run that finds an unexpired lease of another run raises AlreadyRunning,
+  carrying the holder (owner, job_id, acquired_at, expires_at), so the
+  caller can report 'already_running' or attach to the holder's job
+- a run whose lease could not be renewed (it expired and another run took
+  it) raises LeaseLost at its next stage or progress update, before its
+  MERGEs overlap with the new holder's; the Lease is a RunStats listener
+
+Backends (RUN_LOCK):
+- file (default): the state store (STATE_DIR), guarded by its flock; the
+  local stand-in, which only spans instances sharing STATE_DIR
+- bigquery: the RUN_LOCK_TABLE table of the club's dataset, taken with a
+  MERGE, for deployments with several instances
+- off: no locking
+"""
+import contextlib
+import contextvars
+import datetime
+import os
+import threading
+import uuid
+
+from dotenv import load_dotenv
+
+import metrics
+import state_store
+import tenants
+from logger import log, error
+
+load_dotenv()
+
+RUN_LOCK = os.getenv("RUN_LOCK", "file").lower()
+RUN_LOCK_LEASE_SECONDS = int(os.getenv("RUN_LOCK_LEASE_SECONDS", "300"))
+RUN_LOCK_HEARTBEAT_SECONDS = float(os.getenv("RUN_LOCK_HEARTBEAT_SECONDS", "60"))
+RUN_LOCK_TABLE = os.getenv("RUN_LOCK_TABLE", "pipeline_locks")
+
+BACKENDS = ("file", "bigquery", "off")
+
+STATE_NAMESPACE = "run_lock"
+
+
+class AlreadyRunning(RuntimeError):
+    """Raised when another run holds the lease."""
+
+    def __init__(self, holder):
+        self.holder = holder
+        super().__init__(
+            f"Pipeline already running for {holder.get('lock_name')} "
+            f"(job {holder.get('job_id') or 'n/a'}, lease until {holder.get('expires_at')})"
+        )
+
+
+class LeaseLost(RuntimeError):
+    """Raised when a running pipeline's lease was taken over by another run."""
+
+    def __init__(self, lock_name):
+        self.lock_name = lock_name
+        super().__init__(f"Run lock for {lock_name} was lost; stopping the run")
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _is_live(holder, now=None):
+    return bool(holder) and datetime.datetime.fromisoformat(holder["expires_at"]) > (now or _now())
+
+
+class FileLockStore:
+    """Leases kept in the state store, one namespace per club."""
+
+    def acquire(self, lock_name, owner, job_id, lease_seconds):
+        """Take the lease unless a live one exists; return the holder afterwards."""
+        def apply(holder):
+            now = _now()
+            if _is_live(holder, now) and holder["owner"] != owner:
+                return holder
+            return {
+                "lock_name": lock_name,
+                "owner": owner,
+                "job_id": job_id,
+                "acquired_at": now.isoformat(),
+                "heartbeat_at": now.isoformat(),
+                "expires_at": (now + datetime.timedelta(seconds=lease_seconds)).isoformat(),
+            }
+        return state_store.update(tenants.scoped(STATE_NAMESPACE), apply)
+
+    def renew(self, lock_name, owner, lease_seconds):
+        """Extend the lease; return False if it is no longer held by `owner`."""
+        renewed = []
+
+        def apply(holder):
+            if holder.get("owner") == owner:
+                now = _now()
+                holder["heartbeat_at"] = now.isoformat()
+                holder["expires_at"] = (now + datetime.timedelta(seconds=lease_seconds)).isoformat()
+                renewed.append(True)
+            return holder
+        state_store.update(tenants.scoped(STATE_NAMESPACE), apply)
+        return bool(renewed)
+
+    def release(self, lock_name, owner):
+        """Drop the lease if it is held by `owner`."""
+        with state_store.exclusive():
+            if state_store.load(tenants.scoped(STATE_NAMESPACE)).get("owner") == owner:
+                state_store.delete(tenants.scoped(STATE_NAMESPACE))
+
+    def holder(self, lock_name):
+        """Return the live lease, or None."""
+        holder = state_store.load(tenants.scoped(STATE_NAMESPACE))
+        return holder if _is_live(holder) else None
+
+
+class BigQueryLockStore:
+    """
+    Leases kept in a BigQuery table of the club's dataset.
+
+    The lease is taken with a MERGE that only inserts a missing row or takes
+    over an expired one. Concurrent inserts can't be excluded by BigQuery
+    DML, so every taker reads the live rows back and only the earliest
+    (acquired_at, owner) keeps the lease; the others delete their row.
+    """
+
+    def __init__(self):
+        self.table_ready = set()
+
+    def _client(self):
+        import bigquery_upload
+        return bigquery_upload.initialize_bigquery_client()
+
+    def _table(self, client):
+        import bigquery_upload
+        from google.cloud import bigquery
+        from google.cloud.exceptions import NotFound
+
+        dataset_name = bigquery_upload.dataset_id()
+        table_id = f"{bigquery_upload.GCP_PROJECT_ID}.{dataset_name}.{RUN_LOCK_TABLE}"
+        if table_id not in self.table_ready:
+            bigquery_upload.create_dataset_if_not_exists(client)
+            try:
+                client.get_table(table_id)
+            except NotFound:
+                schema = [
+                    bigquery.SchemaField("lock_name", "STRING", mode="REQUIRED"),
+                    bigquery.SchemaField("owner", "STRING", mode="REQUIRED"),
+                    bigquery.SchemaField("job_id", "STRING"),
+                    bigquery.SchemaField("acquired_at", "TIMESTAMP"),
+                    bigquery.SchemaField("heartbeat_at", "TIMESTAMP"),
+                    bigquery.SchemaField("expires_at", "TIMESTAMP"),
+                ]
+                client.create_table(bigquery.Table(table_id, schema=schema), exists_ok=True)
+                log(f"Created table {RUN_LOCK_TABLE}")
+            self.table_ready.add(table_id)
+        return table_id
+
+    def _run(self, client, query, **params):
+        from google.cloud import bigquery
+
+        types = {"lease_seconds": "INT64"}
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter(name, types.get(name, "STRING"), value)
+            for name, value in params.items()
+        ])
+        job = client.query(query, job_config=job_config)
+        rows = metrics.run_bigquery_job("lock", job)
+        return job, rows
+
+    def acquire(self, lock_name, owner, job_id, lease_seconds):
+        """Take the lease unless a live one exists; return the holder afterwards."""
+        client = self._client()
+        table_id = self._table(client)
+        self._run(client, f"""
+            MERGE `{table_id}` AS target
+            USING (SELECT @lock_name AS lock_name) AS source
+            ON target.lock_name = source.lock_name
+            WHEN MATCHED AND target.expires_at <= CURRENT_TIMESTAMP() THEN
+                UPDATE SET owner = @owner, job_id = @job_id, acquired_at = CURRENT_TIMESTAMP(),
+                           heartbeat_at = CURRENT_TIMESTAMP(),
+                           expires_at = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @lease_seconds SECOND)
+            WHEN NOT MATCHED THEN
+                INSERT (lock_name, owner, job_id, acquired_at, heartbeat_at, expires_at)
+                VALUES (@lock_name, @owner, @job_id, CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP(),
+                        TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @lease_seconds SECOND))
+        """, lock_name=lock_name, owner=owner, job_id=job_id, lease_seconds=lease_seconds)
+        holder = self.holder(lock_name, client)
+        if holder and holder["owner"] != owner:
+            # Lost a concurrent insert: drop our row, if any
+            self.release(lock_name, owner, client)
+        return holder
+
+    def renew(self, lock_name, owner, lease_seconds):
+        """Extend the lease; return False if it is no longer held by `owner`."""
+        client = self._client()
+        job, _ = self._run(client, f"""
+            UPDATE `{self._table(client)}`
+            SET heartbeat_at = CURRENT_TIMESTAMP(),
+                expires_at = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @lease_seconds SECOND)
+            WHERE lock_name = @lock_name AND owner = @owner
+        """, lock_name=lock_name, owner=owner, lease_seconds=lease_seconds)
+        return bool(getattr(job, "num_dml_affected_rows", 0))
+
+    def release(self, lock_name, owner, client=None):
+        """Drop the lease if it is held by `owner`."""
+        client = client or self._client()
+        self._run(client, f"""
+            DELETE FROM `{self._table(client)}` WHERE lock_name = @lock_name AND owner = @owner
+        """, lock_name=lock_name, owner=owner)
+
+    def holder(self, lock_name, client=None):
+        """Return the live lease, or None."""
+        client = client or self._client()
+        _, rows = self._run(client, f"""
+            SELECT lock_name, owner, job_id, acquired_at, heartbeat_at, expires_at
+            FROM `{self._table(client)}`
+            WHERE lock_name = @lock_name AND expires_at > CURRENT_TIMESTAMP()
+            ORDER BY acquired_at, owner
+            LIMIT 1
+        """, lock_name=lock_name)
+        for row in rows:
+            return {
+                "lock_name": row.lock_name,
+                "owner": row.owner,
+                "job_id": row.job_id,
+                "acquired_at": row.acquired_at.isoformat(),
+                "heartbeat_at": row.heartbeat_at.isoformat(),
+                "expires_at": row.expires_at.isoformat(),
+            }
+        return None
+
+
+_stores = {}
+
+
+def store():
+    """Return the lock store of RUN_LOCK, or None if locking is off."""
+    if RUN_LOCK not in BACKENDS:
+        raise ValueError(f"Invalid RUN_LOCK: {RUN_LOCK}. Allowed backends: {BACKENDS}")
+    if RUN_LOCK == "off":
+        return None
+    if RUN_LOCK not in _stores:
+        _stores[RUN_LOCK] = FileLockStore() if RUN_LOCK == "file" else BigQueryLockStore()
+    return _stores[RUN_LOCK]
+
+
+class Lease:
+    """
+    A held run lease renewed by a heartbeat thread until it is released.
+
+    Attached to the run's RunStats as a listener (see jobs.run_params), it
+    stops the run with LeaseLost at the first stage or progress update after
+    the lease was lost.
+
+    Args:
+        lock_store: FileLockStore or BigQueryLockStore
+        job_id: ID of the job holding the lease, reported to other runs
+        lease_seconds: Lease duration (default: RUN_LOCK_LEASE_SECONDS)
+        heartbeat_seconds: Renewal interval (default: RUN_LOCK_HEARTBEAT_SECONDS)
+    """
+
+    def __init__(self, lock_store, job_id=None, lease_seconds=None, heartbeat_seconds=None):
+        self.store = lock_store
+        self.lock_name = tenants.name()
+        self.owner = uuid.uuid4().hex
+        self.job_id = job_id
+        self.lease_seconds = lease_seconds or RUN_LOCK_LEASE_SECONDS
+        self.heartbeat_seconds = heartbeat_seconds or RUN_LOCK_HEARTBEAT_SECONDS
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        """
+        Take the lease and start the heartbeat.
+
+        Raises:
+            AlreadyRunning: If another run holds a live lease
+        """
+        holder = self.store.acquire(self.lock_name, self.owner, self.job_id, self.lease_seconds)
+        if not holder or holder["owner"] != self.owner:
+            metrics.RUN_LOCK_CONFLICTS.inc(tenant=self.lock_name)
+            raise AlreadyRunning(holder or {"lock_name": self.lock_name})
+        log(f"Acquired run lock for {self.lock_name} (lease {self.lease_seconds}s)")
+        # The heartbeat runs in the caller's context (active tenant, dataset)
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(
+            target=context.run, args=(self._heartbeat,), name=f"run-lock-{self.lock_name}", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat_seconds):
+            try:
+                if not self.store.renew(self.lock_name, self.owner, self.lease_seconds):
+                    self.lost = True
+                    error(f"Run lock for {self.lock_name} was lost; another run may have started")
+                    return
+            except Exception as e:
+                # Keep trying: the lease only lapses after lease_seconds
+                error(f"Could not renew the run lock for {self.lock_name}: {e}")
+
+    def check(self):
+        """
+        Raise if the lease was lost.
+
+        Raises:
+            LeaseLost: If the heartbeat could not renew the lease
+        """
+        if self.lost:
+            raise LeaseLost(self.lock_name)
+
+    def __call__(self, event, stats, **details):
+        # Not on stage_end: it is notified while a stage is unwinding
+        if event in ("stage_start", "progress"):
+            self.check()
+
+    def release(self):
+        """Stop the heartbeat and drop the lease."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.lost:
+            return
+        try:
+            self.store.release(self.lock_name, self.owner)
+        except Exception as e:
+            error(f"Could not release the run lock for {self.lock_name}: {e}")
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+def hold(job_id=None):
+    """
+    Return a context manager holding the active club's run lease.
+
+    It yields the Lease, or None if locking is off.
+
+    Args:
+        job_id: ID of the job the run belongs to, if any
+
+    Raises:
+        AlreadyRunning: On entering, if another run holds the lease
+    """
+    lock_store = store()
+    if lock_store is None:
+        return contextlib.nullcontext()
+    return Lease(lock_store, job_id=job_id)
+
+
+def holder():
+    """Return the live lease of the active club (see AlreadyRunning), or None."""
+    lock_store = store()
+    if lock_store is None:
+        return None
+    return lock_store.holder(tenants.name())
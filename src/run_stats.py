@@ -0,0 +1,126 @@
+"""
+Per-run stage timings and progress counters for the EHMS MyClub API pipeline.
+
+Each pipeline run owns a RunStats instance. Stages are timed with the
+`stage()` context manager and long loops report their progress with
+`progress()`. Listeners (e.g. the async job store) are notified of every
+stage change and progress update, and when the run finishes. Default
+listeners (e.g. metrics) are attached to every new RunStats.
+"""
+import contextvars
+import time
+from contextlib import contextmanager
+
+import tracing
+
+
+class RunStats:
+    """
+    Collects stage durations, progress counters and row counts for one run.
+
+    Listeners are called as listener(event, stats, **details) where event is
+    one of 'stage_start', 'stage_end', 'progress' or 'finish'.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.stages = {}
+        self.stage_stack = []
+        self.progress_counts = {}
+        self.rows = {}
+        self.extra = {}
+        self.listeners = list(_default_listeners)
+
+    def add_listener(self, listener):
+        """Register a callback notified of stage and progress events."""
+        self.listeners.append(listener)
+
+    def _notify(self, event, **details):
+        for listener in self.listeners:
+            listener(event, self, **details)
+
+    @property
+    def current_stage(self):
+        """Name of the innermost running stage, or None."""
+        return self.stage_stack[-1] if self.stage_stack else None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a pipeline stage. Durations of repeated stages accumulate.
+
+        Each stage is also recorded as a 'stage.<name>' tracing span.
+        """
+        self.stage_stack.append(name)
+        self._notify("stage_start", stage=name)
+        stage_start = time.perf_counter()
+        try:
+            with tracing.span(f"stage.{name}"):
+                yield
+        finally:
+            elapsed = time.perf_counter() - stage_start
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            self.stage_stack.pop()
+            self._notify("stage_end", stage=name, seconds=elapsed)
+
+    def progress(self, name, current, total):
+        """Record progress of a loop (e.g. events processed out of total)."""
+        self.progress_counts[name] = {"current": current, "total": total}
+        self._notify("progress", stage=name, current=current, total=total)
+
+    def set_rows(self, data_dict):
+        """Record the number of rows per table about to be uploaded."""
+        self.rows = {table_name: len(rows) for table_name, rows in data_dict.items()}
+
+    def finish(self):
+        """Mark the run as finished."""
+        self.finished_at = time.time()
+        self._notify("finish")
+
+    def summary(self):
+        """Return a JSON-serialisable performance summary of the run."""
+        end = self.finished_at or time.time()
+        summary = {
+            "duration_seconds": round(end - self.started_at, 3),
+            "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            "progress": dict(self.progress_counts),
+            "rows": dict(self.rows),
+        }
+        summary.update(self.extra)
+        return summary
+
+
+_current = contextvars.ContextVar("run_stats", default=None)
+
+_default_listeners = []
+
+
+def add_default_listener(listener):
+    """Register a listener attached to every RunStats created afterwards."""
+    _default_listeners.append(listener)
+
+
+def activate(stats=None):
+    """Make `stats` (or a new RunStats) the current run's stats and return it."""
+    stats = stats or RunStats()
+    _current.set(stats)
+    return stats
+
+
+def current():
+    """Return the current run's stats, creating one if no run is active."""
+    stats = _current.get()
+    if stats is None:
+        stats = activate()
+    return stats
+
+
+def stage(name):
+    """Time a stage on the current run's stats."""
+    return current().stage(name)
+
+
+def progress(name, current_count, total):
+    """Record loop progress on the current run's stats."""
+    current().progress(name, current_count, total)
@@ -0,0 +1,128 @@
+"""
+Small JSON state store for pipeline bookkeeping that must outlive a run.
+
+State is kept as one JSON document per namespace under STATE_DIR (default: a
+directory in the system temp dir, which is the only writable location on
+Cloud Functions). Point STATE_DIR at a mounted bucket or persistent volume to
+share state between instances.
+
+Read-modify-write cycles (update) hold an flock on STATE_DIR/state.lock as
+well as the in-process lock, so processes sharing STATE_DIR (e.g. fan-out
+workers recording quarantine failures) don't lose each other's changes.
+"""
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+load_dotenv()
+
+STATE_DIR = os.getenv("STATE_DIR", os.path.join(tempfile.gettempdir(), "ehms_state"))
+
+LOCK_FILE_NAME = "state.lock"
+
+_lock = threading.RLock()
+_lock_depth = 0
+
+
+def _path(namespace):
+    return os.path.join(STATE_DIR, f"{namespace}.json")
+
+
+@contextmanager
+def exclusive():
+    """
+    Hold the store lock across threads and processes sharing STATE_DIR.
+
+    Reentrant within a thread; without fcntl (Windows) only the in-process
+    lock is taken.
+    """
+    global _lock_depth
+    with _lock:
+        if _lock_depth or fcntl is None:
+            _lock_depth += 1
+            try:
+                yield
+            finally:
+                _lock_depth -= 1
+            return
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(os.path.join(STATE_DIR, LOCK_FILE_NAME), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            _lock_depth += 1
+            try:
+                yield
+            finally:
+                _lock_depth -= 1
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load(namespace, default=None):
+    """
+    Load the state stored under a namespace.
+
+    Args:
+        namespace: State name, may contain '/' for sub-directories (e.g. 'jobs/<id>')
+        default: Value returned when nothing is stored yet (default: {})
+
+    Returns:
+        The stored JSON value, or `default`
+    """
+    path = _path(namespace)
+    with _lock:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {} if default is None else default
+
+
+def save(namespace, data):
+    """Atomically replace the state stored under a namespace."""
+    path = _path(namespace)
+    with _lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, default=str)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def update(namespace, fn, default=None):
+    """
+    Read-modify-write a namespace under the store lock.
+
+    Args:
+        namespace: State name
+        fn: Callable receiving the current state and returning the new state
+        default: Initial state if nothing is stored yet
+
+    Returns:
+        The new state
+    """
+    with exclusive():
+        data = fn(load(namespace, default))
+        save(namespace, data)
+        return data
+
+
+def delete(namespace):
+    """Remove the state stored under a namespace, if any."""
+    with exclusive():
+        try:
+            os.remove(_path(namespace))
+        except FileNotFoundError:
+            pass
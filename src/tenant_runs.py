@@ -0,0 +1,175 @@
+"""
+Concurrent runs of several clubs (tenants) in one invocation.
+
+run_tenants runs the pipeline of every configured club (see tenants) that is
+due according to its schedule_minutes, up to TENANT_CONCURRENCY clubs at a
+time in worker threads. Each club runs with its own base URL, token,
+BigQuery dataset, rate limit, state and RunStats, and a failing club is
+recorded and reported without affecting the others. The time of the last
+successful run of each club is kept in the state store under
+'tenant_schedule'.
+"""
+import argparse
+import concurrent.futures
+import contextvars
+import datetime
+import os
+import time
+import traceback
+
+from dotenv import load_dotenv
+
+import jobs
+import metrics
+import run_lock
+import state_store
+import tenants
+import tracing
+from logger import log, error
+
+load_dotenv()
+
+TENANT_CONCURRENCY = int(os.getenv("TENANT_CONCURRENCY", "4"))
+
+SCHEDULE_NAMESPACE = "tenant_schedule"
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def is_due(tenant, schedule, now=None):
+    """
+    Return True if a club's last successful run is older than its schedule.
+
+    Args:
+        tenant (tenants.Tenant): The club
+        schedule (dict): The stored 'tenant_schedule' state
+        now (datetime.datetime): Current UTC time (default: now)
+    """
+    last_success = (schedule.get(tenant.name) or {}).get("last_success_at")
+    if not tenant.schedule_minutes or not last_success:
+        return True
+    elapsed = (now or _now()) - datetime.datetime.fromisoformat(last_success)
+    return elapsed >= datetime.timedelta(minutes=tenant.schedule_minutes)
+
+
+def _record_run(name, status, error_message=None):
+    def apply(schedule):
+        entry = schedule.setdefault(name, {})
+        entry["last_run_at"] = _now().isoformat()
+        entry["last_status"] = status
+        entry["last_error"] = error_message
+        if status == "succeeded":
+            entry["last_success_at"] = entry["last_run_at"]
+        return schedule
+    state_store.update(SCHEDULE_NAMESPACE, apply)
+
+
+def run_tenant(tenant):
+    """
+    Run the pipeline of one club and record the outcome.
+
+    Never raises: a failure is logged, counted and returned.
+
+    Args:
+        tenant (tenants.Tenant): The club
+
+    Returns:
+        dict: 'status' ('succeeded', 'failed' or 'already_running'),
+              'duration_seconds' and the run's 'summary' or 'error'
+    """
+    started = time.monotonic()
+    with tenants.activate(tenant), tracing.span("tenant_run", tenant=tenant.name):
+        log(f"[{tenant.name}] Starting pipeline")
+        try:
+            summary = jobs.run_params(tenant.params())
+        except run_lock.AlreadyRunning as e:
+            # Not a failure: the club's previous run is still going
+            log(f"[{tenant.name}] {e}")
+            return {
+                "status": "already_running",
+                "duration_seconds": round(time.monotonic() - started, 3),
+                "error": str(e),
+            }
+        except Exception as e:
+            error(f"[{tenant.name}] Pipeline failed: {e}")
+            traceback.print_exc()
+            metrics.TENANT_FAILURES.inc(tenant=tenant.name)
+            _record_run(tenant.name, "failed", str(e))
+            return {
+                "status": "failed",
+                "duration_seconds": round(time.monotonic() - started, 3),
+                "error": str(e),
+            }
+        log(f"[{tenant.name}] Pipeline completed")
+        _record_run(tenant.name, "succeeded")
+        return {
+            "status": "succeeded",
+            "duration_seconds": round(time.monotonic() - started, 3),
+            "summary": summary,
+        }
+
+
+def run_tenants(names=None, force=False, concurrency=None):
+    """
+    Run the pipelines of all due clubs concurrently.
+
+    Args:
+        names (list): Only run these clubs (default: all configured clubs)
+        force (bool): Ignore the schedules and run every selected club
+        concurrency (int): Clubs run at the same time (default: TENANT_CONCURRENCY)
+
+    Returns:
+        dict: 'tenants' (name -> result of run_tenant) and 'skipped' (names
+              of clubs that were not due)
+
+    Raises:
+        ValueError: If no tenants are configured or a name is unknown
+    """
+    configured = tenants.load_tenants()
+    if not configured:
+        raise ValueError("No tenants configured (set TENANTS_FILE or TENANTS)")
+    selected = [tenants.get_tenant(name) for name in names] if names else list(configured.values())
+
+    schedule = state_store.load(SCHEDULE_NAMESPACE)
+    now = _now()
+    due = [tenant for tenant in selected if force or is_due(tenant, schedule, now)]
+    skipped = [tenant.name for tenant in selected if tenant not in due]
+    if skipped:
+        log(f"Not due yet: {', '.join(skipped)}")
+    if not due:
+        return {"tenants": {}, "skipped": skipped}
+
+    concurrency = max(1, min(concurrency or TENANT_CONCURRENCY, len(due)))
+    log(f"Running {len(due)} clubs, {concurrency} at a time")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="tenant") as executor:
+        # Every club runs in its own copy of the context (active tenant, run
+        # stats, current span), which also hands the trace on to the threads
+        futures = {
+            tenant.name: executor.submit(contextvars.copy_context().run, run_tenant, tenant)
+            for tenant in due
+        }
+        results = {name: future.result() for name, future in futures.items()}
+
+    failed = [name for name, result in results.items() if result["status"] == "failed"]
+    if failed:
+        error(f"Failed clubs: {', '.join(failed)}")
+    return {"tenants": results, "skipped": skipped}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipelines of all configured clubs")
+    parser.add_argument("--tenant", help="Comma-separated tenant names to run (default: all)")
+    parser.add_argument("--force", action="store_true", help="Run even if a club is not due yet")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help=f"Clubs run at the same time (default: {TENANT_CONCURRENCY})")
+    args = parser.parse_args()
+
+    outcome = run_tenants(
+        names=[name.strip() for name in args.tenant.split(",") if name.strip()] if args.tenant else None,
+        force=args.force,
+        concurrency=args.concurrency,
+    )
+    for tenant_name, result in outcome["tenants"].items():
+        log(f"{tenant_name}: {result['status']} in {result['duration_seconds']}s")
@@ -0,0 +1,239 @@
+"""
+Per-club (tenant) configuration for serving several MyClub clubs from one
+deployment.
+
+Tenants are read from the JSON file TENANTS_FILE or the inline JSON value
+TENANTS, a list of objects:
+
+    [{"name": "ehms", "token_env": "MC_TOKEN", "dataset": "ehms_myclub",
+      "schedule_minutes": 1440},
+     {"name": "partner", "base_url": "https://partner.myclub.fi/api/",
+      "token_env": "PARTNER_MC_TOKEN", "dataset": "partner_myclub",
+      "requests_per_second": 2, "interval": 30}]
+
+- name: unique tenant name (letters, digits, '_' and '-')
+- token / token_env: the MyClub API token, or the name of the environment
+  variable holding it (preferred, keeps secrets out of the file)
+- base_url: MyClub API base URL (default: MC_BASE_URL)
+- dataset: BigQuery dataset of the club (default: BIGQUERY_DATASET_ID)
+- schedule_minutes: minimum minutes between runs of the club (default: 0,
+  every invocation), see tenant_runs
+- requests_per_second: rate limit of the club's API requests (default:
+  TENANT_REQUESTS_PER_SECOND, 0 = unlimited)
+- interval, mode and any other pipeline parameter (see jobs.run_params)
+
+The tenant of the running code is kept in a context variable: fetchers read
+their base URL and token through `base_url()` and `token()`, BigQuery uploads
+their dataset through `dataset()`, and state is kept per tenant through
+`scoped()`. Without an active tenant the single-club configuration
+(MC_TOKEN, MC_BASE_URL, BIGQUERY_DATASET_ID) is used.
+"""
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TENANTS_FILE = os.getenv("TENANTS_FILE")
+MC_BASE_URL = os.getenv("MC_BASE_URL", "https://ehms.myclub.fi/api/")
+TENANT_REQUESTS_PER_SECOND = float(os.getenv("TENANT_REQUESTS_PER_SECOND", "0"))
+
+DEFAULT_TENANT = "default"
+
+# Keys of a tenant definition that are not pipeline parameters
+CONFIG_KEYS = ("name", "base_url", "token", "token_env", "dataset", "schedule_minutes", "requests_per_second")
+
+_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class RateLimiter:
+    """Spaces requests evenly to at most `rate` per second across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next request may be sent."""
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Tenant:
+    """Configuration of one club."""
+
+    def __init__(self, name, base_url=None, token=None, dataset=None, schedule_minutes=0,
+                 requests_per_second=None, params=None):
+        self.name = name
+        self.base_url = base_url or MC_BASE_URL
+        if not self.base_url.endswith("/"):
+            self.base_url += "/"
+        self.token = token
+        self.dataset = dataset
+        self.schedule_minutes = schedule_minutes or 0
+        if requests_per_second is None:
+            requests_per_second = TENANT_REQUESTS_PER_SECOND
+        self.requests_per_second = requests_per_second
+        self.limiter = RateLimiter(requests_per_second)
+        self.pipeline_params = dict(params or {})
+
+    @property
+    def is_default(self):
+        return self.name == DEFAULT_TENANT
+
+    def params(self):
+        """Return the pipeline parameters of the club's runs (see jobs.run_params)."""
+        return dict(self.pipeline_params)
+
+    def __repr__(self):
+        return f"Tenant({self.name!r})"
+
+
+def from_dict(config):
+    """
+    Build a Tenant from its JSON definition.
+
+    Raises:
+        ValueError: If the name is missing or invalid or no token is configured
+    """
+    name = str(config.get("name") or "")
+    if not _NAME.match(name) or name == DEFAULT_TENANT:
+        raise ValueError(f"Invalid tenant name: {name!r}")
+
+    token = config.get("token")
+    if not token and config.get("token_env"):
+        token = os.getenv(config["token_env"])
+    if not token:
+        raise ValueError(f"No MyClub token configured for tenant {name} (token or token_env)")
+
+    return Tenant(
+        name,
+        base_url=config.get("base_url"),
+        token=token,
+        dataset=config.get("dataset"),
+        schedule_minutes=int(config.get("schedule_minutes") or 0),
+        requests_per_second=(
+            float(config["requests_per_second"]) if config.get("requests_per_second") is not None else None
+        ),
+        params={key: value for key, value in config.items() if key not in CONFIG_KEYS},
+    )
+
+
+_tenants = None
+_tenants_lock = threading.Lock()
+
+
+def load_tenants():
+    """
+    Return the configured tenants (cached after the first call).
+
+    Returns:
+        dict: name -> Tenant, empty if no tenants are configured
+
+    Raises:
+        ValueError: If the configuration is invalid
+    """
+    global _tenants
+    with _tenants_lock:
+        if _tenants is None:
+            if TENANTS_FILE:
+                with open(TENANTS_FILE, "r", encoding="utf-8") as f:
+                    configs = json.load(f)
+            else:
+                configs = json.loads(os.getenv("TENANTS") or "[]")
+            loaded = {}
+            for config in configs:
+                tenant = from_dict(config)
+                if tenant.name in loaded:
+                    raise ValueError(f"Duplicate tenant name: {tenant.name}")
+                loaded[tenant.name] = tenant
+            _tenants = loaded
+        return _tenants
+
+
+def get_tenant(name):
+    """
+    Return a configured tenant by name.
+
+    Raises:
+        ValueError: If no such tenant is configured
+    """
+    if name == DEFAULT_TENANT:
+        return _default
+    tenant = load_tenants().get(name)
+    if tenant is None:
+        raise ValueError(f"Unknown tenant: {name}")
+    return tenant
+
+
+# The single-club configuration; its token is read from MC_TOKEN on use
+_default = Tenant(DEFAULT_TENANT)
+
+_current = contextvars.ContextVar("tenant", default=None)
+
+
+def current():
+    """Return the active tenant (the single-club configuration if none is active)."""
+    return _current.get() or _default
+
+
+@contextmanager
+def activate(tenant):
+    """
+    Make a tenant the active one for the duration of a block.
+
+    Args:
+        tenant: Tenant or tenant name
+    """
+    if not isinstance(tenant, Tenant):
+        tenant = get_tenant(tenant)
+    token = _current.set(tenant)
+    try:
+        yield tenant
+    finally:
+        _current.reset(token)
+
+
+def name():
+    """Return the name of the active tenant."""
+    return current().name
+
+
+def base_url():
+    """Return the MyClub API base URL of the active tenant (ends with '/')."""
+    return current().base_url
+
+
+def token():
+    """Return the MyClub API token of the active tenant, or None if unset."""
+    tenant = current()
+    return tenant.token if tenant.token else os.getenv("MC_TOKEN")
+
+
+def dataset(default=None):
+    """Return the BigQuery dataset of the active tenant, or `default`."""
+    return current().dataset or default
+
+
+def scoped(namespace):
+    """Return a state_store namespace private to the active tenant."""
+    tenant = current()
+    return namespace if tenant.is_default else f"tenants/{tenant.name}/{namespace}"
+
+
+def wait_for_request():
+    """Apply the active tenant's rate limit before an API request."""
+    current().limiter.wait()
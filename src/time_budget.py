@@ -0,0 +1,265 @@
+"""
+Deadline-aware incremental runs that size the window to a time budget.
+
+Instead of a fixed interval, run_budgeted fits as much work as possible into
+TIME_BUDGET_SECONDS (set it somewhat below the Cloud Function timeout):
+
+1. Historical rates (events per day, seconds per event and listing seconds
+   per slice) are kept in the state store and used to estimate how long a
+   window takes to extract.
+2. The window starting at the usual watermark (see initialise.compute_window)
+   is split into slices of TIME_BUDGET_SLICE_DAYS, and as many whole slices
+   as fit into the extraction share of the budget are planned.
+3. Slices are extracted one by one. A slice is only started if its estimate
+   fits into the remaining time, and a run_stats listener aborts it once the
+   extraction deadline has passed.
+4. Only completely extracted slices are uploaded, so the watermark (the most
+   recent event in BigQuery) only advances to the last fully processed day.
+   The rates are updated from every completed slice.
+"""
+import argparse
+import datetime
+import os
+import time
+
+from dotenv import load_dotenv
+
+import bigquery_upload
+import categories
+import get_all_presences
+import groups
+import initialise
+import member_freshness
+import row_buffer
+import run_stats
+import state_store
+import tenants
+from logger import log
+
+load_dotenv()
+
+TIME_BUDGET_SECONDS = int(os.getenv("TIME_BUDGET_SECONDS", "480"))
+TIME_BUDGET_SLICE_DAYS = int(os.getenv("TIME_BUDGET_SLICE_DAYS", "7"))
+# Share of the budget reserved for metadata and the BigQuery upload
+TIME_BUDGET_UPLOAD_FRACTION = float(os.getenv("TIME_BUDGET_UPLOAD_FRACTION", "0.25"))
+# Longest window planned in one run
+TIME_BUDGET_MAX_DAYS = int(os.getenv("TIME_BUDGET_MAX_DAYS", "365"))
+
+RATES_NAMESPACE = "time_budget_rates"
+
+# Conservative guesses used until the first slice has been measured
+DEFAULT_RATES = {
+    "events_per_day": 20.0,
+    "seconds_per_event": 0.5,
+    "listing_seconds": 30.0,
+}
+
+# Weight of the newest measurement in the moving averages
+RATE_SMOOTHING = 0.3
+
+
+class DeadlineReached(Exception):
+    """Raised inside the extraction when the extraction deadline has passed."""
+
+
+class DeadlineGuard:
+    """
+    RunStats listener aborting the extraction at a deadline.
+
+    Checked on every progress update (i.e. after every listed group and
+    fetched entity) while armed.
+    """
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.armed = False
+
+    def __call__(self, event, stats, **details):
+        if self.armed and event == "progress" and time.monotonic() > self.deadline:
+            raise DeadlineReached(f"Extraction deadline reached during stage {stats.current_stage}")
+
+
+def load_rates():
+    """Return the stored extraction rates, falling back to DEFAULT_RATES."""
+    return {**DEFAULT_RATES, **state_store.load(tenants.scoped(RATES_NAMESPACE))}
+
+
+def update_rates(rates, days, events, seconds, listing_seconds):
+    """
+    Fold the measurements of a completed slice into the rates and store them.
+
+    Args:
+        rates (dict): Current rates (see load_rates)
+        days (int): Length of the slice in days
+        events (int): Number of events extracted
+        seconds (float): Total extraction time of the slice
+        listing_seconds (float): Part of `seconds` spent listing the groups
+
+    Returns:
+        dict: The updated rates
+    """
+    def smooth(key, value):
+        rates[key] = (1 - RATE_SMOOTHING) * rates[key] + RATE_SMOOTHING * value
+
+    smooth("listing_seconds", listing_seconds)
+    if days > 0:
+        smooth("events_per_day", events / days)
+    if events > 0:
+        smooth("seconds_per_event", max(seconds - listing_seconds, 0.0) / events)
+    rates["samples"] = rates.get("samples", 0) + 1
+    state_store.save(tenants.scoped(RATES_NAMESPACE), rates)
+    return rates
+
+
+def estimate_slice_seconds(days, rates):
+    """Estimate the extraction time of a slice of `days` days."""
+    return rates["listing_seconds"] + days * rates["events_per_day"] * rates["seconds_per_event"]
+
+
+def plan_slices(start, max_end, seconds, rates, slice_days=None):
+    """
+    Split the window into slices and keep as many as fit into `seconds`.
+
+    At least one slice is always planned so that every run makes progress.
+
+    Args:
+        start (datetime.date): Window start
+        max_end (datetime.date): Latest possible window end
+        seconds (float): Time available for the extraction
+        rates (dict): Extraction rates (see load_rates)
+        slice_days (int): Slice length (default: TIME_BUDGET_SLICE_DAYS)
+
+    Returns:
+        list: (slice_start, slice_end) date tuples in chronological order
+    """
+    slice_days = slice_days or TIME_BUDGET_SLICE_DAYS
+    slices = []
+    planned = 0.0
+    slice_start = start
+    while slice_start < max_end:
+        slice_end = min(slice_start + datetime.timedelta(days=slice_days), max_end)
+        estimate = estimate_slice_seconds((slice_end - slice_start).days, rates)
+        if slices and (planned + estimate > seconds or (slice_end - start).days > TIME_BUDGET_MAX_DAYS):
+            break
+        slices.append((slice_start, slice_end))
+        planned += estimate
+        slice_start = slice_end
+    return slices
+
+
+def run_budgeted(budget_seconds=None, stats=None):
+    """
+    Run an incremental update sized to a time budget.
+
+    Args:
+        budget_seconds (int): Time budget of the run (default: TIME_BUDGET_SECONDS)
+        stats (run_stats.RunStats): Stats collector for this run (default: new one)
+
+    Returns:
+        dict: Performance summary of the run, with a 'time_budget' entry
+              describing the planned and completed slices
+    """
+    stats = run_stats.activate(stats)
+    budget_seconds = float(budget_seconds or TIME_BUDGET_SECONDS)
+    started = time.monotonic()
+    extract_deadline = started + budget_seconds * (1 - TIME_BUDGET_UPLOAD_FRACTION)
+    guard = DeadlineGuard(extract_deadline)
+    stats.add_listener(guard)
+
+    client = bigquery_upload.initialize_bigquery_client()
+    start, max_end = initialise.compute_window(TIME_BUDGET_MAX_DAYS, client=client)
+    rates = load_rates()
+    slices = plan_slices(start, max_end, extract_deadline - time.monotonic(), rates)
+    planned_end = slices[-1][1] if slices else start
+    log(f"Time budget {budget_seconds:.0f}s: planned {len(slices)} slices from {start} to {planned_end}")
+
+    results = []
+    fetched_members = set()
+    stopped_early = False
+    for slice_start, slice_end in slices:
+        days = (slice_end - slice_start).days
+        if results and estimate_slice_seconds(days, rates) > extract_deadline - time.monotonic():
+            log(f"Not enough time left for {slice_start} to {slice_end}, stopping")
+            stopped_early = True
+            break
+
+        slice_started = time.monotonic()
+        listing_before = stats.stages.get("listing", 0.0)
+        guard.armed = True
+        try:
+            result = get_all_presences.get_all_presences_in_date_range(
+                slice_start, slice_end, exclude_member_ids=fetched_members
+            )
+        except DeadlineReached:
+            log(f"Deadline reached while extracting {slice_start} to {slice_end}, slice discarded")
+            stopped_early = True
+            break
+        finally:
+            guard.armed = False
+
+        slice_data = dict(zip(get_all_presences.RESULT_TABLES, result))
+        results.append(slice_data)
+        fetched_members.update(row["member_id"] for row in slice_data["members"])
+        update_rates(
+            rates, days, len(slice_data["events"]),
+            time.monotonic() - slice_started,
+            stats.stages.get("listing", 0.0) - listing_before,
+        )
+
+    processed_until = slices[len(results) - 1][1] if results else None
+    stats.extra["window"] = {
+        "start": start.isoformat(),
+        "end": processed_until.isoformat() if processed_until else None,
+    }
+    stats.extra["time_budget"] = {
+        "budget_seconds": budget_seconds,
+        "planned_slices": len(slices),
+        "completed_slices": len(results),
+        "planned_end": planned_end.isoformat(),
+        "stopped_early": stopped_early,
+    }
+
+    if not results:
+        log("No slice completed within the time budget, nothing uploaded")
+        stats.finish()
+        return stats.summary()
+
+    with stats.stage("metadata"):
+        _categories = categories.categories()
+        _groups = groups.get_group_ids()
+
+    data_to_upload = {"categories": _categories, "groups": _groups}
+    for table_name in get_all_presences.RESULT_TABLES:
+        data_to_upload[table_name] = initialise.combine_rows(
+            table_name, *[slice_data[table_name] for slice_data in results]
+        )
+    for slice_data in results:
+        row_buffer.close_all(slice_data)
+
+    stats.set_rows(data_to_upload)
+    log(f"Uploading {len(results)} complete slices up to {processed_until}")
+    with stats.stage("upload"):
+        try:
+            downgraded = bigquery_upload.upload_all_tables(data_to_upload, client=client)
+            member_freshness.mark_fetched(data_to_upload["members"], downgraded=downgraded)
+        finally:
+            row_buffer.close_all(data_to_upload)
+
+    stats.finish()
+    return stats.summary()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run an incremental update sized to a time budget"
+    )
+    parser.add_argument(
+        "budget",
+        type=int,
+        nargs="?",
+        default=TIME_BUDGET_SECONDS,
+        help=f"Time budget in seconds (default: {TIME_BUDGET_SECONDS})"
+    )
+    args = parser.parse_args()
+
+    run_budgeted(budget_seconds=args.budget)
@@ -0,0 +1,171 @@
+"""
+Lightweight tracing spans in the style of OpenTelemetry.
+
+Spans are opened with the `span()` context manager and nest through a
+context variable, so every span knows its trace and parent. Finished spans
+are exported as one JSON object per line to the collector selected by
+TRACE_EXPORTER:
+
+- unset / 'none': tracing disabled, span() only yields a no-op span
+- 'console': spans are logged to stdout
+- 'file': spans are appended to TRACE_FILE (default: ehms_traces.jsonl in the
+  system temp dir)
+
+Trace context is carried between processes as a W3C `traceparent` value
+(00-<trace id>-<span id>-<flags>): main.run_pipeline continues the trace of
+the incoming request, and the trace is handed on to async jobs and fan-out
+workers.
+"""
+import contextvars
+import json
+import os
+import re
+import secrets
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+from logger import log, error
+
+load_dotenv()
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(tempfile.gettempdir(), "ehms_traces.jsonl"))
+
+_TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+_current_span = contextvars.ContextVar("tracing_span", default=None)
+_export_lock = threading.Lock()
+
+
+class Span:
+    """A timed operation within a trace."""
+
+    def __init__(self, name, trace_id, parent_span_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = "OK"
+        self.status_message = None
+
+    def set_attribute(self, key, value):
+        """Attach an attribute (e.g. an entity ID or a size) to the span."""
+        self.attributes[key] = value
+
+    @property
+    def traceparent(self):
+        """W3C traceparent value identifying this span."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start_ns,
+            "end_time_unix_nano": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3) if self.end_ns else None,
+            "attributes": self.attributes,
+            "status": {"code": self.status, "message": self.status_message},
+        }
+
+
+class _NoopSpan:
+    """Span yielded while tracing is disabled."""
+
+    traceparent = None
+
+    def set_attribute(self, key, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def enabled():
+    """Return True if spans are recorded and exported."""
+    return TRACE_EXPORTER in ("console", "file")
+
+
+def parse_traceparent(value):
+    """
+    Parse a W3C traceparent value.
+
+    Returns:
+        tuple: (trace_id, parent_span_id), or None if the value is missing or
+               malformed
+    """
+    match = _TRACEPARENT.match((value or "").strip().lower())
+    if not match or set(match.group(1)) == {"0"} or set(match.group(2)) == {"0"}:
+        return None
+    return match.group(1), match.group(2)
+
+
+def current_traceparent():
+    """Return the traceparent of the current span, or None."""
+    current = _current_span.get()
+    return current.traceparent if current is not None else None
+
+
+def export(finished_span):
+    """Send a finished span to the configured collector."""
+    line = json.dumps(finished_span.to_dict(), default=str)
+    if TRACE_EXPORTER == "console":
+        log(f"[trace] {line}")
+    elif TRACE_EXPORTER == "file":
+        with _export_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(TRACE_FILE)), exist_ok=True)
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+@contextmanager
+def span(name, traceparent=None, **attributes):
+    """
+    Record a span around a block.
+
+    Args:
+        name: Span name (e.g. 'myclub.event', 'bigquery.merge_rows')
+        traceparent: Remote parent (W3C traceparent) used when no span is
+                     active in this context, e.g. from an incoming request
+        **attributes: Span attributes
+
+    Yields:
+        Span: The span (a no-op span while tracing is disabled). An exception
+              leaving the block marks the span as failed.
+    """
+    if not enabled():
+        yield _NOOP_SPAN
+        return
+
+    parent = _current_span.get()
+    remote = parse_traceparent(traceparent) if parent is None else None
+    if parent is not None:
+        current = Span(name, parent.trace_id, parent.span_id, attributes)
+    elif remote is not None:
+        current = Span(name, remote[0], remote[1], attributes)
+    else:
+        current = Span(name, secrets.token_hex(16), None, attributes)
+
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "ERROR"
+        current.status_message = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(token)
+        try:
+            export(current)
+        except Exception as e:
+            error(f"Could not export span {name}: {e}")
@@ -10,12 +10,41 @@ This will delete all data from the following tables:
 - memberships
 - presences
 
-Use with caution - this operation cannot be undone!
+The attendance aggregate table (attendance_monthly) is rebuilt afterwards,
+which leaves it empty, so dashboards don't keep reading stale aggregates.
+
+Use with caution - a plain truncation cannot be undone! With --snapshot,
+BigQuery table snapshots of all tables are taken first, and `restore`
+clones them back. Snapshots are zero-copy (only data changed afterwards is
+billed as storage) and are created concurrently, all as of one shared
+point in time so the set is consistent, so a reset and its rollback take
+seconds instead of an export/reload cycle:
+
+    python src/truncate_tables.py --snapshot      # snapshot, then truncate
+    python src/truncate_tables.py snapshot        # snapshot only
+    python src/truncate_tables.py list            # list the snapshots
+    python src/truncate_tables.py restore 20240101T120000
+
+Snapshots are named <table>__snapshot_<label> in the pipeline dataset and
+expire after SNAPSHOT_EXPIRATION_DAYS.
 """
 
+import argparse
+import datetime
+import os
+import re
+
+from dotenv import load_dotenv
+
 import bigquery_upload
+import metrics
 from logger import log, error
 
+load_dotenv()
+
+SNAPSHOT_EXPIRATION_DAYS = int(os.getenv("SNAPSHOT_EXPIRATION_DAYS", "7"))
+
+SNAPSHOT_SEPARATOR = "__snapshot_"
 
 TABLES_TO_TRUNCATE = [
     "categories",
@@ -28,13 +57,175 @@ TABLES_TO_TRUNCATE = [
 ]
 
 
-def truncate_all_tables():
-    """Truncate all data tables in BigQuery."""
+def _table_ref(table_name):
+    return f"{bigquery_upload.GCP_PROJECT_ID}.{bigquery_upload.dataset_id()}.{table_name}"
+
+
+def snapshot_name(table_name, label):
+    """Return the name of a table's snapshot with the given label."""
+    return f"{table_name}{SNAPSHOT_SEPARATOR}{label}"
+
+
+def _run_concurrently(client, job_type, queries):
+    """
+    Submit one query job per table and wait for all of them.
+
+    The jobs are all submitted before the first one is awaited, so BigQuery
+    runs them concurrently.
+
+    Args:
+        client: BigQuery client instance
+        job_type: Job type recorded in the metrics
+        queries (dict): table_name -> query
+
+    Returns:
+        dict: table_name -> error message of the failed tables
+    """
+    jobs = {}
+    failed = {}
+    for table_name, query in queries.items():
+        try:
+            jobs[table_name] = client.query(query)
+        except Exception as e:
+            failed[table_name] = str(e)
+    for table_name, job in jobs.items():
+        try:
+            metrics.run_bigquery_job(job_type, job)
+        except Exception as e:
+            failed[table_name] = str(e)
+    return failed
+
+
+def snapshot_all_tables(client=None, label=None):
+    """
+    Take snapshots of all tables concurrently.
+
+    All tables are cloned as of the same BigQuery timestamp (FOR SYSTEM_TIME
+    AS OF), so the snapshots are consistent with each other although their
+    jobs run at slightly different moments.
+
+    Args:
+        client: BigQuery client instance (default: the shared client)
+        label: Snapshot label (default: the snapshot time in UTC, YYYYMMDDTHHMMSS)
+
+    Returns:
+        str: The label of the snapshots
+
+    Raises:
+        ValueError: If the label is not a valid table name suffix
+        RuntimeError: If any table could not be snapshotted
+    """
+    client = client or bigquery_upload.initialize_bigquery_client()
+    if label is not None and not re.fullmatch(r"[A-Za-z0-9_]+", label):
+        raise ValueError(f"Invalid snapshot label {label!r} (letters, digits and underscores only)")
+
+    # The server's clock, so the timestamp is never in the future for BigQuery
+    rows = metrics.run_bigquery_job("snapshot", client.query("SELECT CURRENT_TIMESTAMP() AS now"))
+    snapshot_time = list(rows)[0].now.astimezone(datetime.timezone.utc)
+    label = label or snapshot_time.strftime("%Y%m%dT%H%M%S")
+
+    log(f"Taking snapshots '{label}' of {len(TABLES_TO_TRUNCATE)} tables as of {snapshot_time.isoformat()}...")
+    queries = {
+        table_name: f"""
+            CREATE SNAPSHOT TABLE `{_table_ref(snapshot_name(table_name, label))}`
+            CLONE `{_table_ref(table_name)}` FOR SYSTEM_TIME AS OF TIMESTAMP '{snapshot_time.isoformat(sep=" ")}'
+            OPTIONS (expiration_timestamp = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL {SNAPSHOT_EXPIRATION_DAYS} DAY))
+        """
+        for table_name in TABLES_TO_TRUNCATE
+    }
+    failed = _run_concurrently(client, "snapshot", queries)
+    for table_name in TABLES_TO_TRUNCATE:
+        if table_name in failed:
+            error(f"  ✗ Error snapshotting {table_name}: {failed[table_name]}")
+        else:
+            log(f"  ✓ Snapshotted {table_name}")
+    if failed:
+        raise RuntimeError(f"Could not snapshot {', '.join(sorted(failed))}")
+    log(f"Snapshots expire in {SNAPSHOT_EXPIRATION_DAYS} days; restore with "
+        f"`python src/truncate_tables.py restore {label}`")
+    return label
+
+
+def list_snapshots(client=None):
+    """
+    List the snapshots in the pipeline dataset.
+
+    Args:
+        client: BigQuery client instance (default: the shared client)
+
+    Returns:
+        dict: label -> sorted names of the snapshotted tables
+    """
+    client = client or bigquery_upload.initialize_bigquery_client()
+    snapshots = {}
+    for table in client.list_tables(bigquery_upload.dataset_id()):
+        if table.table_type != "SNAPSHOT" or SNAPSHOT_SEPARATOR not in table.table_id:
+            continue
+        table_name, label = table.table_id.split(SNAPSHOT_SEPARATOR, 1)
+        snapshots.setdefault(label, []).append(table_name)
+    return {label: sorted(names) for label, names in sorted(snapshots.items())}
+
+
+def restore_all_tables(label, client=None):
+    """
+    Replace all tables with clones of their snapshots.
+
+    The tables are restored concurrently. If the attendance aggregates are
+    enabled, the aggregate table is rebuilt from the restored presences.
+
+    Args:
+        label: Label of the snapshots to restore
+        client: BigQuery client instance (default: the shared client)
+
+    Raises:
+        ValueError: If the snapshots are incomplete
+        RuntimeError: If any table could not be restored
+    """
+    client = client or bigquery_upload.initialize_bigquery_client()
+    available = list_snapshots(client).get(label, [])
+    missing = [table_name for table_name in TABLES_TO_TRUNCATE if table_name not in available]
+    if missing:
+        raise ValueError(f"Snapshot '{label}' is missing tables: {', '.join(missing)}")
+
+    log(f"Restoring {len(TABLES_TO_TRUNCATE)} tables from snapshots '{label}'...")
+    queries = {
+        table_name: f"""
+            CREATE OR REPLACE TABLE `{_table_ref(table_name)}`
+            CLONE `{_table_ref(snapshot_name(table_name, label))}`
+        """
+        for table_name in TABLES_TO_TRUNCATE
+    }
+    failed = _run_concurrently(client, "restore", queries)
+    for table_name in TABLES_TO_TRUNCATE:
+        if table_name in failed:
+            error(f"  ✗ Error restoring {table_name}: {failed[table_name]}")
+        else:
+            log(f"  ✓ Restored {table_name}")
+    if failed:
+        raise RuntimeError(f"Could not restore {', '.join(sorted(failed))}")
+
+    import attendance_aggregates
+    if attendance_aggregates.ATTENDANCE_AGGREGATES:
+        attendance_aggregates.rebuild(client)
+    log("\nRestore completed!")
+
+
+def truncate_all_tables(snapshot=False, label=None):
+    """
+    Truncate all data tables in BigQuery.
+
+    Args:
+        snapshot (bool): Snapshot all tables first; nothing is truncated if
+                         any snapshot fails
+        label: Snapshot label (see snapshot_all_tables)
+    """
     client = bigquery_upload.initialize_bigquery_client()
 
     log("WARNING: This will delete ALL data from the following tables:")
     for table_name in TABLES_TO_TRUNCATE:
         log(f"  - {table_name}")
+    if snapshot:
+        log("Snapshots are taken first, so the tables can be restored.")
 
     confirmation = input("\nType 'DELETE ALL DATA' to confirm: ")
 
@@ -42,10 +233,17 @@ def truncate_all_tables():
         log("Aborted - no data was deleted")
         return
 
+    if snapshot:
+        try:
+            snapshot_all_tables(client, label)
+        except Exception as e:
+            error(f"Aborted - no data was deleted: {e}")
+            return
+
     log("\nTruncating tables...")
 
     for idx, table_name in enumerate(TABLES_TO_TRUNCATE, 1):
-        table_ref = f"{bigquery_upload.GCP_PROJECT_ID}.{bigquery_upload.BIGQUERY_DATASET_ID}.{table_name}"
+        table_ref = _table_ref(table_name)
 
         try:
             query = f"TRUNCATE TABLE `{table_ref}`"
@@ -55,8 +253,39 @@ def truncate_all_tables():
         except Exception as e:
             error(f"  [{idx}/{len(TABLES_TO_TRUNCATE)}] ✗ Error truncating {table_name}: {e}")
 
+    import attendance_aggregates
+    if attendance_aggregates.ATTENDANCE_AGGREGATES:
+        try:
+            attendance_aggregates.rebuild(client)
+        except Exception as e:
+            error(f"  ✗ Error rebuilding {attendance_aggregates.ATTENDANCE_AGGREGATE_TABLE}: {e}")
+
     log("\nTruncation completed!")
 
 
 if __name__ == "__main__":
-    truncate_all_tables()
+    parser = argparse.ArgumentParser(description="Truncate, snapshot or restore the BigQuery tables")
+    parser.add_argument("command", nargs="?", default="truncate",
+                        choices=("truncate", "snapshot", "list", "restore"))
+    parser.add_argument("label", nargs="?", help="Snapshot label (required for restore)")
+    parser.add_argument("--snapshot", action="store_true", help="Truncate: snapshot all tables first")
+    args = parser.parse_args()
+
+    if args.command == "truncate":
+        truncate_all_tables(snapshot=args.snapshot, label=args.label)
+    elif args.command == "snapshot":
+        snapshot_all_tables(label=args.label)
+    elif args.command == "list":
+        snapshots = list_snapshots()
+        if not snapshots:
+            log("No snapshots")
+        for snapshot_label, table_names in snapshots.items():
+            log(f"{snapshot_label}: {', '.join(table_names)}")
+    else:
+        if not args.label:
+            parser.error("restore needs a snapshot label (see `list`)")
+        confirmation = input(f"\nType 'RESTORE' to replace all tables with snapshots '{args.label}': ")
+        if confirmation != "RESTORE":
+            log("Aborted - no table was restored")
+        else:
+            restore_all_tables(args.label)
@@ -4,6 +4,9 @@ import event
 
 import datetime
 import requests
+import http_client
+import tenants
+import listing_decoder
 import json
 import os
 
@@ -34,12 +37,12 @@ def upcoming_events_in_non_EHMS_venue():
 
     log(f"Fetching events from {start} to {end}")
 
-    myclub_token = os.getenv("MC_TOKEN")
+    myclub_token = tenants.token()
     if not myclub_token:
         raise ValueError("MC_TOKEN environment variable is required but not set")
 
     headers = {"X-myClub-token": myclub_token}
-    base_url = "https://ehms.myclub.fi/api/"
+    base_url = tenants.base_url()
     full_url = f"{base_url}events/"
 
     params = {
@@ -49,20 +52,20 @@ def upcoming_events_in_non_EHMS_venue():
         "end_date": end
     }
 
+    response = None
     try:
-        response = requests.get(full_url, headers=headers, params=params, timeout=30)
+        response = http_client.get(full_url, headers=headers, params=params, timeout=30, stream=True)
         response.raise_for_status()
-        content = response.json()
-
+        # Decode the listing incrementally, keeping only the fields we need
         events_list = []
-        for c in content:
-            event_data = c.get("event")
-            if event_data:
-                events_list.append([
-                    str(event_data.get("id")),
-                    event_data.get("name"),
-                    event_data.get("starts_at")
-                ])
+        for event_data in listing_decoder.iter_response(
+            response, "event", ("id", "name", "starts_at")
+        ):
+            events_list.append([
+                str(event_data.get("id")),
+                event_data.get("name"),
+                event_data.get("starts_at")
+            ])
 
         return events_list
 
@@ -78,6 +81,10 @@ def upcoming_events_in_non_EHMS_venue():
     except json.JSONDecodeError as e:
         error(f"Invalid JSON response for upcoming events: {e}")
         raise
+    finally:
+        # Release the streamed connection even if decoding stopped early
+        if response is not None:
+            response.close()
 
 
 if __name__ == "__main__":